@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Decoding pipeline benchmark, on synthetic captures (see iti1480a.synthetic).
+
+The pipeline is built one stage longer at a time, so each stage time is the
+difference with the pipeline ending with the stage before it. Throughput
+(MB/s) is for the whole pipeline up to that stage, and event rate is the
+number of items the stage produced per second of that pipeline.
+"display" stage is iti1480a-display rendering, and "stats" stage is
+iti1480a-display --stats, both on top of "transaction".
+
+Results can be appended to a history file (one JSON record per line) along
+with interpreter, machine fingerprint and git revision, and compared against
+a baseline record: a stage regresses when it got slower by more than the
+tolerance, widened by the run-to-run spread measured on both sides.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from iti1480a.parser import ReorderedStream, Packetiser, \
+    TransactionAggregator, PipeAggregator, Endpoint0TransferAggregator, \
+    BaseAggregator, NoopAggregator, ParsingDone
+from iti1480a.display import HumanReadable
+from iti1480a.stats import Statistics
+from iti1480a.synthetic import SCENARIO_DICT, generateString
+
+CHUNK_SIZE = 16 * 1024
+REPEAT = 3
+COUNT = 2000
+# Relative slowdown tolerated, in addition to measurement noise.
+TOLERANCE = 0.1
+# How many times the observed run-to-run spread is considered noise.
+NOISE_FACTOR = 2
+
+class CountingAggregator(BaseAggregator):
+    """
+    Pipeline end, counting received items.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def push(self, *args, **kw):
+        self.count += 1
+
+    def __call__(self, *args, **kw):
+        self.count += 1
+
+def _buildReorder(sink):
+    return ReorderedStream(sink)
+
+def _buildPacketiser(sink):
+    return ReorderedStream(Packetiser(sink, sink))
+
+def _buildTransaction(sink):
+    return ReorderedStream(Packetiser(TransactionAggregator(sink, sink), sink))
+
+def _buildPipe(sink):
+    return ReorderedStream(Packetiser(TransactionAggregator(
+        PipeAggregator(sink, sink, lambda address: sink,
+            lambda address, endpoint: sink),
+        sink,
+    ), sink))
+
+def _buildTransfer(sink):
+    def newPipe(address, endpoint):
+        if endpoint == 0:
+            return Endpoint0TransferAggregator(sink, sink)
+        return sink
+    return ReorderedStream(Packetiser(TransactionAggregator(
+        PipeAggregator(sink, sink, lambda address: sink, newPipe),
+        sink,
+    ), sink))
+
+def _buildDisplay(sink):
+    human_readable = HumanReadable(sink, 0)
+    return ReorderedStream(Packetiser(
+        TransactionAggregator(human_readable, human_readable.push),
+        human_readable.push,
+    ))
+
+def _buildStatistics(sink):
+    statistics = Statistics()
+    statistics_push = statistics.push
+    def push(*args):
+        sink()
+        statistics_push(*args)
+    return ReorderedStream(Packetiser(
+        TransactionAggregator(NoopAggregator(push), push),
+        push,
+    ))
+
+# Stage name, pipeline builder, name of the stage it adds time to.
+STAGE_LIST = (
+    ('reorder', _buildReorder, None),
+    ('packetiser', _buildPacketiser, 'reorder'),
+    ('transaction', _buildTransaction, 'packetiser'),
+    ('pipe', _buildPipe, 'transaction'),
+    ('transfer', _buildTransfer, 'pipe'),
+    ('display', _buildDisplay, 'transaction'),
+    ('stats', _buildStatistics, 'transaction'),
+)
+
+def runPipeline(data, build, chunk_size=CHUNK_SIZE):
+    """
+    Decode data with pipeline returned by build.
+    Returns elapsed time and number of items pipeline produced.
+    """
+    sink = CountingAggregator()
+    stream = build(sink)
+    push = stream.push
+    start = time.time()
+    try:
+        for offset in xrange(0, len(data), chunk_size):
+            push(data[offset:offset + chunk_size])
+    except ParsingDone:
+        pass
+    stream.stop()
+    return time.time() - start, sink.count
+
+def benchmark(data, repeat=REPEAT, chunk_size=CHUNK_SIZE):
+    """
+    Benchmark all stages on given capture data.
+    Returns a list of (stage name, result dict), in STAGE_LIST order.
+    Each stage time is the best of repeat runs.
+    """
+    size = len(data)
+    time_dict = {}
+    result = []
+    for name, build, previous in STAGE_LIST:
+        run_list = sorted(
+            runPipeline(data, build, chunk_size) for _ in xrange(repeat)
+        )
+        elapsed, count = run_list[0]
+        time_dict[name] = elapsed
+        result.append((name, {
+            'time': elapsed,
+            # Relative difference between slowest and fastest runs.
+            'spread': (
+                (run_list[-1][0] - elapsed) / elapsed if elapsed else 0
+            ),
+            # Stage cost can be lost in measurement noise.
+            'self_time': max(elapsed - time_dict.get(previous, 0), 0),
+            'mb_per_s': size / elapsed / 1e6 if elapsed else 0,
+            'events': count,
+            'events_per_s': count / elapsed if elapsed else 0,
+        }))
+    return result
+
+def getGitRevision():
+    """
+    Return git revision of the source tree this module comes from, or None.
+    """
+    try:
+        process = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w'),
+        )
+    except OSError:
+        return None
+    revision = process.communicate()[0].strip()
+    if process.returncode:
+        return None
+    return revision
+
+def getEnvironment():
+    """
+    Describe where benchmark runs, so results are only compared with similar
+    runs.
+    """
+    machine = {
+        'node': platform.node(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.system(),
+        'cpu_count': multiprocessing.cpu_count(),
+    }
+    return {
+        'interpreter': '%s %s' % (
+            platform.python_implementation(),
+            platform.python_version(),
+        ),
+        'machine': machine,
+        'fingerprint': hashlib.sha1(
+            json.dumps(machine, sort_keys=True),
+        ).hexdigest()[:16],
+        'revision': getGitRevision(),
+    }
+
+def loadBaseline(path, environment=None):
+    """
+    Load a baseline record from path, which is either a single record or a
+    history file. From history, the latest record with the same interpreter
+    and machine fingerprint as environment is returned, falling back to the
+    latest record.
+    """
+    with open(path) as infile:
+        data = infile.read()
+    try:
+        return json.loads(data)
+    except ValueError:
+        pass
+    record_list = [json.loads(x) for x in data.splitlines() if x.strip()]
+    if not record_list:
+        raise ValueError('No record in %r' % (path, ))
+    if environment is not None:
+        for record in reversed(record_list):
+            if (
+                record['interpreter'] == environment['interpreter'] and
+                record['fingerprint'] == environment['fingerprint']
+            ):
+                return record
+    return record_list[-1]
+
+def compare(baseline, current, write, tolerance=TOLERANCE,
+        noise_factor=NOISE_FACTOR):
+    """
+    Write a per-stage comparison of current results against baseline ones.
+    Returns the list of regressed (capture, stage) pairs.
+    """
+    for key in ('interpreter', 'fingerprint'):
+        if baseline[key] != current[key]:
+            write('Warning: baseline %s differs: %s (current: %s)\n' % (
+                key, baseline[key], current[key],
+            ))
+    write('Baseline revision: %s, current revision: %s\n' % (
+        baseline['revision'], current['revision'],
+    ))
+    write('%-14s %-12s %10s %10s %8s %8s\n' % (
+        'Capture', 'Stage', 'Base MB/s', 'MB/s', 'Change', 'Allowed',
+    ))
+    regression_list = []
+    base_result_dict = baseline['results']
+    for name, capture in sorted(current['results'].iteritems()):
+        try:
+            base_capture = base_result_dict[name]
+        except KeyError:
+            write('%-14s not in baseline\n' % (name, ))
+            continue
+        if base_capture['size'] != capture['size']:
+            write('%-14s size differs from baseline, skipped\n' % (name, ))
+            continue
+        for stage, _, _ in STAGE_LIST:
+            try:
+                base_stage = base_capture['stages'][stage]
+                current_stage = capture['stages'][stage]
+            except KeyError:
+                continue
+            if not base_stage['time']:
+                continue
+            change = current_stage['time'] / base_stage['time'] - 1
+            allowed = tolerance + noise_factor * max(
+                base_stage.get('spread', 0),
+                current_stage['spread'],
+            )
+            if change > allowed:
+                status = 'REGRESSION'
+                regression_list.append((name, stage))
+            elif change < -allowed:
+                status = 'faster'
+            else:
+                status = ''
+            write('%-14s %-12s %10.2f %10.2f %+7.1f%% %7.1f%% %s\n' % (
+                name,
+                stage,
+                base_stage['mb_per_s'],
+                current_stage['mb_per_s'],
+                change * 100,
+                allowed * 100,
+                status,
+            ))
+    return regression_list
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(
+        usage='%prog [options] [scenario [...]]\nScenarios: ' +
+        ', '.join(sorted(SCENARIO_DICT)) + '\nDefault: all',
+    )
+    parser.add_option(
+        '-n', '--count', type='int', default=COUNT,
+        help='Number of scenario repetitions. Default: %default',
+    )
+    parser.add_option(
+        '-r', '--repeat', type='int', default=REPEAT,
+        help='Number of runs per stage, best is kept. Default: %default',
+    )
+    parser.add_option(
+        '--chunk-size', type='int', default=CHUNK_SIZE,
+        help='Amount of data pushed at a time. Default: %default',
+    )
+    parser.add_option(
+        '-i', '--infile', action='append', default=[],
+        help='Also benchmark this capture file (uncompressed). Can be '
+        'repeated.',
+    )
+    parser.add_option(
+        '-j', '--json',
+        help='Also write results to this file, as JSON ("-" for stdout)',
+    )
+    parser.add_option(
+        '--history',
+        help='Append results to this file, one JSON record per line, with '
+        'interpreter, machine fingerprint and git revision',
+    )
+    parser.add_option(
+        '-b', '--baseline',
+        help='Compare results against this record (as written by --json) or '
+        'history file, and exit with status 2 if any stage regressed. '
+        'Requires --repeat of at least 2.',
+    )
+    parser.add_option(
+        '--tolerance', type='float', default=TOLERANCE,
+        help='Relative slowdown allowed on top of measurement noise. '
+        'Default: %default',
+    )
+    parser.add_option(
+        '--noise-factor', type='float', default=NOISE_FACTOR,
+        help='Multiplier applied to run-to-run spread to get the noise '
+        'allowance. Default: %default',
+    )
+    (options, args) = parser.parse_args()
+    for scenario in args:
+        if scenario not in SCENARIO_DICT:
+            parser.print_help(sys.stderr)
+            sys.exit(1)
+    if options.baseline and options.repeat < 2:
+        # A single run has no spread, so any noise would be a regression.
+        print >>sys.stderr, '--baseline requires --repeat of at least 2, ' \
+            'to measure noise'
+        sys.exit(1)
+    record = getEnvironment()
+    if options.baseline:
+        # Before history gets appended to, as it may be the same file.
+        try:
+            baseline = loadBaseline(options.baseline, record)
+        except (IOError, ValueError), exc:
+            print >>sys.stderr, 'Could not load --baseline %r: %s' % (
+                options.baseline,
+                exc,
+            )
+            sys.exit(1)
+    source_list = [
+        (scenario, lambda scenario=scenario: generateString(
+            scenario, options.count,
+        ))
+        for scenario in (args or sorted(SCENARIO_DICT))
+    ]
+    for path in options.infile:
+        source_list.append((path, lambda path=path: open(path, 'rb').read()))
+    json_result = {}
+    write = sys.stderr.write if options.json == '-' else sys.stdout.write
+    write('%-14s %-12s %10s %10s %10s %12s\n' % (
+        'Capture', 'Stage', 'Size (MB)', 'Self (s)', 'MB/s', 'Events/s',
+    ))
+    for name, getData in source_list:
+        data = getData()
+        result = benchmark(data, options.repeat, options.chunk_size)
+        json_result[name] = {
+            'size': len(data),
+            'stages': dict(result),
+        }
+        for stage, stage_result in result:
+            write('%-14s %-12s %10.2f %10.3f %10.2f %12.0f\n' % (
+                name,
+                stage,
+                len(data) / 1e6,
+                stage_result['self_time'],
+                stage_result['mb_per_s'],
+                stage_result['events_per_s'],
+            ))
+    record['time'] = time.time()
+    record['count'] = options.count
+    record['results'] = json_result
+    if options.json:
+        if options.json == '-':
+            dump = sys.stdout
+        else:
+            dump = open(options.json, 'w')
+        json.dump(record, dump, sort_keys=True, indent=2)
+        dump.write('\n')
+        if dump is not sys.stdout:
+            dump.close()
+    if options.history:
+        with open(options.history, 'a') as history:
+            json.dump(record, history, sort_keys=True)
+            history.write('\n')
+    if options.baseline:
+        if compare(
+                    baseline,
+                    record,
+                    write,
+                    options.tolerance,
+                    options.noise_factor,
+                ):
+            sys.exit(2)
+
+if __name__ == '__main__':
+    main()
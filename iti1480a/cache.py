@@ -0,0 +1,210 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+On-disk cache of decoded transactions, so reopening a capture skips
+decoding.
+
+What TransactionAggregator and Packetiser produce is recorded, in order,
+along with the channel it was produced on, while a capture is decoded. On
+later opens, these records are replayed to the same consumers.
+
+Cache file name is made of capture content hash and parser version (a hash
+of parser source), so cache entries are never reused for a modified
+capture or parser.
+File starts with a header (magic, parser version, capture hash) followed by
+blocks, each being a 32-bit little-endian length and a zlib-compressed
+marshal dump of a list of records.
+
+Cache directory is ITI1480A_CACHE_DIR environment variable if set (caching
+is disabled when it is empty), $XDG_CACHE_HOME/iti1480a otherwise.
+"""
+import errno
+import hashlib
+import marshal
+import os
+from struct import pack, unpack
+import zlib
+from iti1480a import parser
+
+MAGIC = 'ITI1480C\x01'
+# Records per block.
+BLOCK_LENGTH = 4096
+HASH_READ_SIZE = 1024 * 1024
+
+# Where recorded data came from.
+CHANNEL_TRANSACTION = 0 # TransactionAggregator's to_next
+CHANNEL_TRANSACTION_ERROR = 1 # TransactionAggregator's to_top
+CHANNEL_PACKETISER = 2 # Packetiser's to_top
+
+def _getCacheDir():
+    try:
+        return os.environ['ITI1480A_CACHE_DIR'] or None
+    except KeyError:
+        return os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+                os.path.expanduser('~/.cache'),
+            'iti1480a',
+        )
+CACHE_DIR = _getCacheDir()
+
+def _getParserVersion():
+    path = parser.__file__
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    with open(path, 'rb') as source:
+        return hashlib.sha1(MAGIC + source.read()).hexdigest()
+PARSER_VERSION = _getParserVersion()
+
+def getCaptureHash(path):
+    """
+    Return hash of capture file content.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as capture:
+        while True:
+            data = capture.read(HASH_READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def _getHeader(capture_hash):
+    return MAGIC + PARSER_VERSION + capture_hash
+
+def getCachePath(capture_path, cache_dir=CACHE_DIR):
+    """
+    Return cache file path for given capture (which may not exist), and
+    capture hash.
+    """
+    capture_hash = getCaptureHash(capture_path)
+    return os.path.join(
+        cache_dir,
+        '%s-%s.cache' % (capture_hash, PARSER_VERSION[:16]),
+    ), capture_hash
+
+class _RecordingAggregator(object):
+    """
+    Aggregator proxy recording pushes.
+    """
+    def __init__(self, record, aggregator):
+        self.push = record
+        self.stop = aggregator.stop
+
+class CacheRecorder(object):
+    """
+    Record decoding pipeline output to a cache file.
+    File is written under a temporary name, and only gets its final name
+    on commit.
+    """
+    def __init__(self, path, capture_hash):
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        self._path = path
+        self._temp_path = '%s.%i.tmp' % (path, os.getpid())
+        self._file = open(self._temp_path, 'wb')
+        self._file.write(_getHeader(capture_hash))
+        self._record_list = []
+
+    def wrap(self, channel, push):
+        """
+        Return a wrapper for given callable, recording its calls on given
+        channel.
+        """
+        append = self._record_list.append
+        def wrapper(*args):
+            append((channel, args))
+            if len(self._record_list) >= BLOCK_LENGTH:
+                self._flush()
+            return push(*args)
+        return wrapper
+
+    def wrapAggregator(self, channel, aggregator):
+        """
+        Return a proxy for given aggregator, recording its pushes on given
+        channel.
+        """
+        return _RecordingAggregator(
+            self.wrap(channel, aggregator.push),
+            aggregator,
+        )
+
+    def _flush(self):
+        record_list = self._record_list
+        if record_list:
+            block = zlib.compress(marshal.dumps(record_list))
+            self._file.write(pack('<I', len(block)) + block)
+            del record_list[:]
+
+    def commit(self):
+        """
+        Decoding reached the end of capture, make cache file available.
+        """
+        self._flush()
+        self._file.close()
+        os.rename(self._temp_path, self._path)
+
+    def abort(self):
+        """
+        Decoding did not complete, discard cache file.
+        """
+        self._file.close()
+        os.unlink(self._temp_path)
+
+def _iterBlocks(infile):
+    with infile:
+        while True:
+            length = infile.read(4)
+            if not length:
+                break
+            for record in marshal.loads(zlib.decompress(
+                        infile.read(unpack('<I', length)[0]),
+                    )):
+                yield record
+
+def iterCache(path, capture_hash):
+    """
+    Return an iterator over (channel, args) records from given cache file.
+    Raises ValueError if file is not a cache for given capture and current
+    parser.
+    """
+    infile = open(path, 'rb')
+    header = _getHeader(capture_hash)
+    if infile.read(len(header)) != header:
+        infile.close()
+        raise ValueError('Not a cache for this capture and parser')
+    return _iterBlocks(infile)
+
+def openCache(capture_path, cache_dir=CACHE_DIR):
+    """
+    Look given capture up in cache.
+    Returns a 2-tuple:
+    - iterator over cached records, None on cache miss
+    - on cache miss, a CacheRecorder to fill cache while decoding, None if
+      cache cannot be written to
+    """
+    cache_path, capture_hash = getCachePath(capture_path, cache_dir)
+    try:
+        return iterCache(cache_path, capture_hash), None
+    except (IOError, ValueError):
+        pass
+    try:
+        return None, CacheRecorder(cache_path, capture_hash)
+    except (IOError, OSError):
+        return None, None
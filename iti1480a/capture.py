@@ -21,6 +21,12 @@ from struct import pack, unpack
 import time
 import signal
 import errno
+from iti1480a.compressed import CompressedWriter, CODEC_NAME_DICT, FRAME_SIZE
+from iti1480a.clock import ClockLog, CLOCK_INTERVAL
+from iti1480a.ring import RingWriter, RING_SIZE
+from iti1480a.fakedevice import FakeUSBContext
+from iti1480a.metrics import CaptureMetrics, MetricsExporter, FORMAT_LIST, \
+    FORMAT_JSON, EXPORT_INTERVAL
 
 VENDOR_ID = 0x16C0
 DEVICE_ID = 0x07A9
@@ -42,13 +48,75 @@ def getDeviceHandle(context, vendor_id, device_id, usb_device=None):
             usb_device + (vendor_id, device_id),
         )
 
+def parseUSBDevice(value):
+    """
+    Parse a "bus.dev" device designation into a 2-tuple of integers.
+    None is passed through.
+    """
+    if value is None:
+        return None
+    usb_device = value.split('.')
+    assert len(usb_device) == 2
+    return (int(usb_device[0]), int(usb_device[1]))
+
+# Number and size of concurrently-submitted capture data transfers.
+TRANSFER_COUNT = 64
+TRANSFER_SIZE = 0x8000
+
+def submitTransferList(handle, callback, count=TRANSFER_COUNT,
+        size=TRANSFER_SIZE):
+    """
+    Submit capture data reading transfers on given device handle.
+    callback (usb1.USBTransferHelper)
+    Returns the list of submitted transfers.
+    """
+    reader_list = []
+    append = reader_list.append
+    for _ in xrange(count):
+        data_reader = handle.getTransfer()
+        data_reader.setBulk(
+            0x82,
+            size,
+            callback=callback,
+        )
+        data_reader.submit()
+        append(data_reader)
+    return reader_list
+
+# Number of concurrently-submitted transfers during asynchronous firmware
+# upload.
+UPLOAD_TRANSFER_COUNT = 16
+
+class FirmwareUploadError(Exception):
+    """
+    Raised when an asynchronous firmware upload transfer fails.
+    """
+    pass
+
 class BaseUSBAnalyzer(object):
+    # XXX: inferred, not documented: FPGA I/O pins have weak pull-ups until
+    # configured, so status reads all ones on an unconfigured FPGA.
+    STATUS_UNCONFIGURED = 0xff
+
     def __init__(self, usb_handle):
         self._handle = usb_handle
 
     def _afterFPGAConfigureStart(self):
         pass
 
+    def _setFPGAConfigureWrite(self, transfer, data, callback):
+        """
+        Setup given transfer to send given firmware chunk.
+        """
+        raise NotImplementedError
+
+    def isFPGAConfigured(self):
+        """
+        Whether FPGA firmware is already loaded (ex: by a previous capture
+        session).
+        """
+        return self.getStatus() != self.STATUS_UNCONFIGURED
+
     def sendFirmware(self, firmware_file):
         read = firmware_file.read
         write = self.writeCommand
@@ -66,6 +134,67 @@ class BaseUSBAnalyzer(object):
             )
         write(self.COMMAND_FPGA, self.COMMAND_FPGA_CONFIGURE_STOP)
 
+    def sendFirmwareAsync(self, context, firmware_file,
+            transfer_count=UPLOAD_TRANSFER_COUNT, progress=None):
+        """
+        Upload FPGA firmware, keeping several transfers in flight instead of
+        waiting for each chunk to be acknowledged before sending the next.
+
+        context (usb1.USBContext)
+            Context device handle belongs to, to handle transfer events.
+        firmware_file (file-ish object)
+        transfer_count (int)
+            Number of concurrently-submitted transfers.
+        progress (callable)
+            Called with the number of bytes sent so far after each chunk.
+
+        Returns upload duration, in seconds.
+        """
+        read = firmware_file.read
+        chunk_len = self.COMMAND_DATA_LEN
+        write = self.writeCommand
+        error_list = []
+        sent = [0]
+        def submitNext(transfer):
+            conf_data = read(chunk_len)
+            if conf_data:
+                self._setFPGAConfigureWrite(transfer, conf_data, onTransfer)
+                transfer.submit()
+        def onTransfer(transfer):
+            if transfer.getStatus() != usb1.TRANSFER_COMPLETED:
+                error_list.append(transfer.getStatus())
+                return
+            sent[0] += transfer.getUserData()
+            if progress is not None:
+                progress(sent[0])
+            if not error_list:
+                submitNext(transfer)
+
+        start = time.time()
+        write(self.COMMAND_FPGA, self.COMMAND_FPGA_CONFIGURE_START)
+        self._afterFPGAConfigureStart()
+        transfer_list = [
+            self._handle.getTransfer() for _ in xrange(transfer_count)
+        ]
+        for transfer in transfer_list:
+            submitNext(transfer)
+        while any(x.isSubmitted() for x in transfer_list):
+            try:
+                context.handleEvents()
+            except usb1.USBErrorInterrupted:
+                pass
+        for transfer in transfer_list:
+            transfer.close()
+        if error_list:
+            raise FirmwareUploadError(
+                'Transfer failed with status %r after %i bytes' % (
+                    error_list[0],
+                    sent[0],
+                ),
+            )
+        write(self.COMMAND_FPGA, self.COMMAND_FPGA_CONFIGURE_STOP)
+        return time.time() - start
+
     def stopCapture(self):
         self.writeCommand(self.COMMAND_STOP)
 
@@ -90,13 +219,28 @@ class CompatibleUSBAnalyzer(BaseUSBAnalyzer):
     COMMAND_FPGA_CONFIGURE_WRITE = '\x01'
     COMMAND_FPGA_CONFIGURE_STOP = '\x02'
 
-    def writeCommand(self, command, sub_command='\x00', data=''):
+    def _getCommand(self, command, sub_command='\x00', data=''):
         data_len = len(data)
         if data_len < self.COMMAND_DATA_LEN:
             data = data + '\x00' * (self.COMMAND_DATA_LEN - data_len)
         to_write = ''.join((command, sub_command, data, pack('B', data_len)))
         assert len(to_write) == 64, repr(to_write)
-        self._handle.bulkWrite(1, to_write)
+        return to_write
+
+    def writeCommand(self, command, sub_command='\x00', data=''):
+        self._handle.bulkWrite(1, self._getCommand(command, sub_command, data))
+
+    def _setFPGAConfigureWrite(self, transfer, data, callback):
+        transfer.setBulk(
+            1,
+            self._getCommand(
+                self.COMMAND_FPGA,
+                self.COMMAND_FPGA_CONFIGURE_WRITE,
+                data,
+            ),
+            callback=callback,
+            user_data=len(data),
+        )
 
     def readCommand(self, length, command, sub_command='\x00'):
         self.writeCommand(command, sub_command)
@@ -138,6 +282,17 @@ class CompliantUSBAnalyzer(BaseUSBAnalyzer):
             data,
         )
 
+    def _setFPGAConfigureWrite(self, transfer, data, callback):
+        transfer.setControl(
+            usb1.TYPE_VENDOR | usb1.RECIPIENT_DEVICE,
+            self.VENDOR_COMMAND,
+            (self.COMMAND_FPGA << 8) | self.COMMAND_FPGA_CONFIGURE_WRITE,
+            0,
+            data,
+            callback=callback,
+            user_data=len(data),
+        )
+
     def readCommand(self, length, command, sub_command=0, index=0):
         return self._handle.controlRead(
             usb1.TYPE_VENDOR | usb1.RECIPIENT_DEVICE,
@@ -303,6 +458,50 @@ class CompliantUSBAnalyzer(BaseUSBAnalyzer):
     def xpoke(self, address, data):
         self.writeCommand(self.COMMAND_MEMORY, self.COMMAND_MEMORY_EXTERNAL, data, address)
 
+def uploadFirmware(context, analyzer, path, skip_loaded=False,
+        verbose=False):
+    """
+    Upload FPGA firmware from given path, unless skip_loaded is true and
+    FPGA looks already configured.
+    As the unconfigured status value is inferred rather than documented, a
+    warning is always printed when upload is skipped.
+    """
+    if skip_loaded and analyzer.isFPGAConfigured():
+        sys.stderr.write(
+            'Warning: FPGA status (0x%02x) suggests firmware is already '
+            'loaded, skipping upload. This check is heuristic: if nothing '
+            'gets captured, retry without -k.\n' % (analyzer.getStatus(), )
+        )
+        return
+    firmware_file = open(path, 'rb')
+    if verbose:
+        total = os.fstat(firmware_file.fileno()).st_size
+        # Progress is reported per (possibly tiny) chunk: only print when
+        # percentage changes.
+        last_percent = [None]
+        def progress(sent):
+            percent = sent * 100 / total if total else 100
+            if percent != last_percent[0]:
+                last_percent[0] = percent
+                sys.stderr.write('Uploading firmware: %3i%%\r' % (percent, ))
+    else:
+        progress = None
+    duration = analyzer.sendFirmwareAsync(
+        context,
+        firmware_file,
+        progress=progress,
+    )
+    if verbose:
+        if duration:
+            rate = ' (%.02f kB/s)' % (total / duration / 1024, )
+        else:
+            # Clock too coarse for such a short upload.
+            rate = ''
+        sys.stderr.write('\nFirmware uploaded in %.03fs%s\n' % (
+            duration,
+            rate,
+        ))
+
 def USBAnalyzer(handle):
     # Free Software firmware exposes an incompatible, standard-compliant
     # configuration.
@@ -311,6 +510,22 @@ def USBAnalyzer(handle):
         return CompliantUSBAnalyzer(handle)
     return CompatibleUSBAnalyzer(handle)
 
+class TeeWriter(object):
+    """
+    Write the same data to several file-ish objects.
+    """
+    def __init__(self, stream_list):
+        self._stream_list = stream_list
+        self._write_list = [x.write for x in stream_list]
+
+    def write(self, data):
+        for write in self._write_list:
+            write(data)
+
+    def close(self):
+        for stream in self._stream_list:
+            stream.close()
+
 class TransferDumpCallback(object):
     __slots__ = (
         'write',
@@ -320,31 +535,64 @@ class TransferDumpCallback(object):
         'last_measure',
         'verbose',
         'stop_condition',
+        'clock_log',
+        'offset',
+        'metrics',
         '__call__',
     )
 
-    def __init__(self, stream, verbose=False):
+    def __init__(self, stream, verbose=False, clock_log=None, metrics=None):
+        """
+        stream (file-ish object)
+            Where capture data is written.
+        verbose (bool)
+            Print capture speed to stderr.
+        clock_log (iti1480a.clock.ClockLog, None)
+            If given, host time is recorded along with received data size.
+        metrics (iti1480a.metrics.CaptureMetrics, None)
+            If given, transfer and write statistics are recorded.
+        """
         self.write = stream.write
+        self.metrics = metrics
         self.transfer_end_count = 0
         self.capture_size = 0
+        self.clock_log = clock_log
+        self.offset = 0
         self.next_measure = time.time()
         self.last_measure = (None, None)
         self.verbose = verbose
+        # Even items: FIFO overflow, odd items: user request.
         self.stop_condition = (
             '\xf0\x41', '\xf1\x41',
             '\x41\xf0', '\x41\xf1',
         )
         self.__call__ = self.real_call
+        if metrics is not None:
+            self.write = metrics.wrapWrite(self.write)
+            self.__call__ = self.measured_call
 
     def noop_call(self, transfer):
         return False
 
+    def measured_call(self, transfer):
+        start = time.time()
+        result = self.real_call(transfer)
+        self.metrics.recordTransfer(
+            transfer.getActualLength(),
+            time.time() - start,
+        )
+        return result
+
     def real_call(self, transfer):
         size = transfer.getActualLength()
         if not size:
             return True
         data = transfer.getBuffer()[:size]
         if data[-2:] in self.stop_condition:
+            if self.metrics is not None:
+                self.metrics.captureStopped(
+                    data[-2:] in self.stop_condition[::2],
+                )
             self.transfer_end_count += 1
             result = self.transfer_end_count < 2
             if not result:
@@ -376,6 +624,11 @@ class TransferDumpCallback(object):
                         sys.stderr.write('\nSpeed: %.02f %sB/s\n' % (
                             speed, suffix))
                 sys.stderr.write('Capture size: %i\r' % (cap_size, ))
+        if self.clock_log is not None:
+            # Recorded before writing, so a live reader always finds the
+            # record of data it reads.
+            self.offset += size
+            self.clock_log.record(self.offset)
         try:
             self.write(data)
         except IOError, exc:
@@ -392,13 +645,94 @@ def main():
         help='Path to firmware file to upload',
     )
     parser.add_option(
-        '-d', '--device',
-        help='USB device to use, in "bus.dev" format',
+        '-d', '--device', action='append',
+        help='USB device to use, in "bus.dev" format. Repeat to capture '
+        'from several analysers, in which case as many --out must be given.',
     )
     parser.add_option(
-        '-o', '--out',
+        '-o', '--out', action='append',
         help='File to write dump data to. Default: stdout',
     )
+    parser.add_option(
+        '-r', '--ring',
+        help='Also stream dump data to a shared-memory ring created at this '
+        'path (preferably on a tmpfs), for iti1480a-display --ring. Data is '
+        'not written to stdout unless --out is given.',
+    )
+    parser.add_option(
+        '--ring-size', type='int', default=RING_SIZE,
+        help='Ring capacity, in bytes. Default: %default',
+    )
+    parser.add_option(
+        '-c', '--clock', action='store_true',
+        help='Record host time along with capture data offsets in a file '
+        'named after --out with a ".clock" suffix, so captures from '
+        'several analysers can be aligned.',
+    )
+    parser.add_option(
+        '--clock-file',
+        help='Like --clock, but record to this file. Allows recording when '
+        'capturing a single analyser without --out (to stdout or --ring), '
+        'ex: for iti1480a-display --latency.',
+    )
+    parser.add_option(
+        '--clock-interval', type='float', default=CLOCK_INTERVAL,
+        help='Minimum delay between --clock records, in seconds. 0 to '
+        'record each transfer, for iti1480a-display --latency (with '
+        '--clock-file when writing to stdout). '
+        'Default: %default',
+    )
+    parser.add_option(
+        '-m', '--metrics',
+        help='Periodically export capture health metrics to this file',
+    )
+    parser.add_option(
+        '--metrics-format', choices=FORMAT_LIST, default=FORMAT_JSON,
+        help='Metrics file format: %s. Default: %%default' % (
+            ', '.join(FORMAT_LIST),
+        ),
+    )
+    parser.add_option(
+        '--metrics-interval', type='float', default=EXPORT_INTERVAL,
+        help='Delay between metrics exports, in seconds. Default: %default',
+    )
+    parser.add_option(
+        '-z', '--compress', choices=sorted(CODEC_NAME_DICT),
+        help='Compress dump data on the fly with given codec (%s)' % (
+            ', '.join(sorted(CODEC_NAME_DICT)),
+        ),
+    )
+    parser.add_option(
+        '--frame-size', type='int', default=FRAME_SIZE,
+        help='Amount of raw data per independently-compressed frame. '
+        'Default: %default',
+    )
+    parser.add_option(
+        '-k', '--skip-loaded-firmware', action='store_true',
+        help='Do not upload firmware if FPGA looks already configured. '
+        'Heuristic: the unconfigured status value is inferred, not '
+        'documented, so a warning is printed when upload is skipped.',
+    )
+    parser.add_option(
+        '--fake-device',
+        help='Instead of a real analyser, capture from a simulated one '
+        'streaming this capture file. Useful to benchmark capture without '
+        'hardware. Firmware content is ignored (ex: -f /dev/null).',
+    )
+    parser.add_option(
+        '--fake-rate', type='float', default=0,
+        help='Simulated analyser data rate, in bytes per second. 0 to send '
+        'data as fast as it is fetched. Default: %default',
+    )
+    parser.add_option(
+        '--fake-jitter', type='float', default=0,
+        help='Maximum random delay added to each simulated transfer '
+        'completion, in seconds. Default: %default',
+    )
+    parser.add_option(
+        '--fake-compliant', action='store_true',
+        help='Simulate an analyser running the Free Software firmware',
+    )
     parser.add_option(
         '-v', '--verbose', action='store_true',
         help='Print informative messages to stderr',
@@ -407,88 +741,197 @@ def main():
     if options.firmware is None:
         parser.print_help(sys.stderr)
         sys.exit(1)
-    if options.device is None:
-        usb_device = None
+    usb_device_list = [parseUSBDevice(x) for x in options.device or [None]]
+    out_list = options.out or [None]
+    if len(out_list) != len(usb_device_list):
+        print >>sys.stderr, 'There must be as many --out as --device'
+        sys.exit(1)
+    if options.clock_file is not None:
+        if len(out_list) != 1:
+            print >>sys.stderr, '--clock-file supports a single analyser'
+            sys.exit(1)
+    elif options.clock and None in out_list:
+        print >>sys.stderr, '--clock requires --out or --clock-file'
+        sys.exit(1)
+    if options.ring is not None and len(out_list) != 1:
+        print >>sys.stderr, '--ring supports a single analyser'
+        sys.exit(1)
+    verbose = options.verbose
+    if options.metrics is None:
+        metrics_exporter = None
     else:
-        usb_device = options.device.split('.')
-        assert len(usb_device) == 2
-        usb_device = (int(usb_device[0]), int(usb_device[1]))
-    if options.out is None:
-        out_file = os.fdopen(sys.stdout.fileno(), 'w', 0)
+        metrics_exporter = MetricsExporter(
+            options.metrics,
+            format=options.metrics_format,
+            interval=options.metrics_interval,
+        )
+    if options.fake_device is None:
+        context = usb1.USBContext()
     else:
-        out_file = open(options.out, 'wb', 0)
-    verbose = options.verbose
-    with usb1.USBContext() as context:
-        handle = getDeviceHandle(context, VENDOR_ID, DEVICE_ID, usb_device)
-        if handle is None:
-            print >>sys.stderr, 'ITI1480A USB Analyzer not found'
-            sys.exit(1)
-        handle.claimInterface(0)
-        analyzer = USBAnalyzer(handle)
-        analyzer.sendFirmware(open(options.firmware, 'rb'))
-
-        # Call queue: process received signals synchronously.
-        # Asynchronous processing is tricky because capture stop and pause need to
-        # communicate with the analyzer, and complex tricks are needed when libusb
-        # event handling happens "in parallel" (handleEvents + sighandler triggered
-        # at the wrong time).
-        call_queue = []
-        def exit():
-            if verbose:
-                sys.stderr.write('\nExiting...\n')
-            analyzer.stopCapture()
-        def pause():
-            analyzer.pauseCapture()
-            if verbose:
-                sys.stderr.write('\nCapture paused')
-            os.kill(os.getpid(), signal.SIGSTOP)
-            analyzer.continueCapture()
-            if verbose:
-                sys.stderr.write('Capture resumed\n')
-
-        # Install signal handlers
-        for sig in (signal.SIGINT, signal.SIGTERM):
-            signal.signal(sig, lambda sig, stack: call_queue.append(exit))
-        signal.signal(signal.SIGTSTP, lambda sig, stack: call_queue.append(pause))
-
-        usb_file_data_reader = usb1.USBTransferHelper()
-        transfer_dump_callback = TransferDumpCallback(out_file, verbose=verbose)
-        usb_file_data_reader.setEventCallback(
-            usb1.TRANSFER_COMPLETED,
-            transfer_dump_callback,
+        context = FakeUSBContext(
+            options.fake_device,
+            VENDOR_ID,
+            DEVICE_ID,
+            rate=options.fake_rate,
+            jitter=options.fake_jitter,
+            compliant=options.fake_compliant,
         )
-
-        reader_list = []
-        append = reader_list.append
-        for _ in xrange(64):
-            data_reader = handle.getTransfer()
-            data_reader.setBulk(
-                0x82,
-                0x8000,
-                callback=usb_file_data_reader,
-            )
-            data_reader.submit()
-            append(data_reader)
-
-        if verbose:
-            sys.stderr.write(
-                'Capture started\n'
-                'SIGTSTP (^Z) to pause capture (signals the pause to analyser)\n'
-                'SIGCONT (fg) to unpause\n'
-                'SIGINT (^C) / SIGTERM to gracefuly exit\n'
+    with context:
+        capture_list = []
+        try:
+            for usb_device, out in zip(usb_device_list, out_list):
+                handle = getDeviceHandle(
+                    context,
+                    VENDOR_ID,
+                    DEVICE_ID,
+                    usb_device,
+                )
+                if handle is None:
+                    print >>sys.stderr, 'ITI1480A USB Analyzer not found'
+                    sys.exit(1)
+                handle.claimInterface(0)
+                if out is None:
+                    if options.ring is None:
+                        out_file = os.fdopen(sys.stdout.fileno(), 'w', 0)
+                    else:
+                        out_file = None
+                else:
+                    out_file = open(out, 'wb', 0)
+                if options.compress is not None and out_file is not None:
+                    out_file = CompressedWriter(
+                        out_file,
+                        codec=CODEC_NAME_DICT[options.compress],
+                        frame_size=options.frame_size,
+                    )
+                if options.ring is not None:
+                    ring = RingWriter(options.ring, options.ring_size)
+                    if out_file is None:
+                        out_file = ring
+                    else:
+                        out_file = TeeWriter((out_file, ring))
+                if options.clock_file is not None:
+                    clock_path = options.clock_file
+                elif options.clock:
+                    clock_path = out + '.clock'
+                else:
+                    clock_path = None
+                if clock_path is not None:
+                    # Line-buffered, so it can be followed live.
+                    clock_log = ClockLog(
+                        open(clock_path, 'w', 1),
+                        interval=options.clock_interval,
+                    )
+                else:
+                    clock_log = None
+                if metrics_exporter is None:
+                    metrics = None
+                else:
+                    metrics = CaptureMetrics(
+                        out or '%03i.%03i' % (
+                            handle.getDevice().getBusNumber(),
+                            handle.getDevice().getDeviceAddress(),
+                        ),
+                    )
+                    metrics_exporter.capture_list.append(metrics)
+                capture_list.append((
+                    handle,
+                    USBAnalyzer(handle),
+                    out_file,
+                    clock_log,
+                    metrics,
+                ))
+            for _, analyzer, _, _, _ in capture_list:
+                uploadFirmware(
+                    context,
+                    analyzer,
+                    options.firmware,
+                    skip_loaded=options.skip_loaded_firmware,
+                    verbose=verbose,
+                )
+
+            # Call queue: process received signals synchronously.
+            # Asynchronous processing is tricky because capture stop and pause
+            # need to communicate with the analyzer, and complex tricks are
+            # needed when libusb event handling happens "in parallel"
+            # (handleEvents + sighandler triggered at the wrong time).
+            call_queue = []
+            def exit():
+                if verbose:
+                    sys.stderr.write('\nExiting...\n')
+                for _, analyzer, _, _, _ in capture_list:
+                    analyzer.stopCapture()
+            def pause():
+                for _, analyzer, _, _, _ in capture_list:
+                    analyzer.pauseCapture()
+                if verbose:
+                    sys.stderr.write('\nCapture paused')
+                os.kill(os.getpid(), signal.SIGSTOP)
+                for _, analyzer, _, _, _ in capture_list:
+                    analyzer.continueCapture()
+                if verbose:
+                    sys.stderr.write('Capture resumed\n')
+
+            # Install signal handlers
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, lambda sig, stack: call_queue.append(exit))
+            signal.signal(
+                signal.SIGTSTP,
+                lambda sig, stack: call_queue.append(pause),
             )
 
-        try:
+            # All analysers share the same context, hence the same event
+            # loop. Each has its own transfer pool and output.
+            reader_list = []
+            for handle, _, out_file, clock_log, metrics in capture_list:
+                usb_file_data_reader = usb1.USBTransferHelper()
+                transfer_dump_callback = TransferDumpCallback(
+                    out_file,
+                    verbose=verbose,
+                    clock_log=clock_log,
+                    metrics=metrics,
+                )
+                usb_file_data_reader.setEventCallback(
+                    usb1.TRANSFER_COMPLETED,
+                    transfer_dump_callback,
+                )
+                capture_reader_list = submitTransferList(
+                    handle,
+                    usb_file_data_reader,
+                )
+                if metrics is not None:
+                    metrics.reader_list = capture_reader_list
+                reader_list.extend(capture_reader_list)
+
+            if verbose:
+                sys.stderr.write(
+                    'Capture started\n'
+                    'SIGTSTP (^Z) to pause capture (signals the pause to '
+                    'analyser)\n'
+                    'SIGCONT (fg) to unpause\n'
+                    'SIGINT (^C) / SIGTERM to gracefuly exit\n'
+                )
+
             while any(x.isSubmitted() for x in reader_list):
+                if metrics_exporter is not None:
+                    start = time.time()
                 try:
                     context.handleEvents()
                 except usb1.USBErrorInterrupted:
                     pass
+                if metrics_exporter is not None:
+                    metrics_exporter.recordHandleEvents(time.time() - start)
+                    metrics_exporter.maybeExport()
                 while call_queue:
                     call_queue.pop(0)()
         finally:
-            handle.releaseInterface(0)
+            if metrics_exporter is not None:
+                metrics_exporter.export()
+            for handle, _, out_file, clock_log, _ in capture_list:
+                handle.releaseInterface(0)
+                if options.compress is not None or options.ring is not None:
+                    out_file.close()
+                if clock_log is not None:
+                    clock_log.close()
 
 if __name__ == '__main__':
     main()
-
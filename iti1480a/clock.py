@@ -0,0 +1,98 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Host clock logs, correlating host time with capture data.
+
+Analyser tic counts are relative to the beginning of each capture, so
+captures from different analysers cannot be aligned using tics alone. While
+capturing, host time is recorded along with the amount of capture data
+received so far. Decoding capture data up to these offsets gives the tic
+count reached at that host time.
+
+Log format: one line per record, composed of host time (floating point
+seconds since epoch) and raw capture data offset, separated by a space.
+"""
+import time
+from iti1480a.parser import ReorderedStream, NoopAggregator
+
+# Minimum delay between records, in seconds.
+CLOCK_INTERVAL = 1
+
+class ClockLog(object):
+    def __init__(self, stream, interval=CLOCK_INTERVAL):
+        """
+        stream (file-ish object)
+            Where records are written.
+        interval (float)
+            Minimum delay between records, in seconds. 0 to record on each
+            call.
+        """
+        self._stream = stream
+        self._interval = interval
+        self._next = 0
+
+    def record(self, offset):
+        """
+        Record that capture data up to given offset was received by now.
+        """
+        now = time.time()
+        if now >= self._next:
+            self._next = now + self._interval
+            self._stream.write('%.6f %i\n' % (now, offset))
+
+    def close(self):
+        self._stream.close()
+
+def readClockLog(stream):
+    """
+    Return the list of records in given clock log, as 2-tuples:
+    - host time (float)
+    - capture data offset (int)
+    """
+    result = []
+    append = result.append
+    for line in stream:
+        now, offset = line.split()
+        append((float(now), int(offset)))
+    return result
+
+def iterTicCorrelation(capture, clock_list):
+    """
+    Decode capture to find the tic count reached at each clock log record.
+
+    capture (file-ish object)
+        Raw capture data.
+    clock_list (list)
+        As returned by readClockLog.
+
+    Generated values:
+        2-tuple composed of host time and tic count.
+    """
+    stream = ReorderedStream(NoopAggregator(lambda *args: None))
+    push = stream.push
+    read = capture.read
+    position = 0
+    for now, offset in clock_list:
+        length = offset - position
+        if length < 0:
+            raise ValueError('Clock log offsets are not increasing')
+        data = read(length)
+        if len(data) != length:
+            # Capture is shorter than clock log, likely truncated.
+            break
+        push(data)
+        position = offset
+        yield now, stream.getTic()
@@ -0,0 +1,388 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Compressed capture files.
+
+Raw captures are mostly made of SOF and time-delta packets, and compress very
+well. To keep random access possible, raw data is cut in frames which are
+compressed independently. Each frame starts on a packet boundary, and its
+starting tic count is stored along with it, so decoding can start at any
+frame.
+
+File structure:
+  File header: MAGIC, format version (1 byte), codec (1 byte)
+  Frames, each composed of:
+    Frame header: FRAME_MAGIC, compressed length, raw length, starting tic
+    Compressed data
+  Index (absent if writer did not exit cleanly):
+    INDEX_MAGIC, entry count, then for each frame:
+      raw offset, raw length, starting tic, frame header file offset
+  Trailer: index file offset, TRAILER_MAGIC
+All integers are little-endian.
+
+When index is missing, it is rebuilt by walking frame headers.
+"""
+from bisect import bisect_right
+from struct import pack, unpack, calcsize
+import threading
+import zlib
+from Queue import Queue
+from iti1480a.parser import ReorderedStream, NoopAggregator
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+MAGIC = 'ITI1480Z'
+VERSION = 1
+HEADER_FORMAT = '<8sBB'
+HEADER_LEN = calcsize(HEADER_FORMAT)
+FRAME_MAGIC = 'FR'
+FRAME_HEADER_FORMAT = '<2sIIQ'
+FRAME_HEADER_LEN = calcsize(FRAME_HEADER_FORMAT)
+INDEX_MAGIC = 'IX'
+INDEX_HEADER_FORMAT = '<2sI'
+INDEX_HEADER_LEN = calcsize(INDEX_HEADER_FORMAT)
+INDEX_ENTRY_FORMAT = '<QIQQ'
+INDEX_ENTRY_LEN = calcsize(INDEX_ENTRY_FORMAT)
+TRAILER_MAGIC = 'ITI1480I'
+TRAILER_FORMAT = '<Q8s'
+TRAILER_LEN = calcsize(TRAILER_FORMAT)
+
+CODEC_ZLIB = 0
+CODEC_LZMA = 1
+# Codecs available for writing.
+CODEC_NAME_DICT = {
+    'zlib': CODEC_ZLIB,
+}
+if lzma is not None:
+    CODEC_NAME_DICT['lzma'] = CODEC_LZMA
+
+# Raw data amount per frame. Frames are only cut on packet boundaries, so
+# actual frame size may be slightly larger.
+FRAME_SIZE = 1024 * 1024
+
+class CompressedCaptureError(Exception):
+    """
+    Raised when a compressed capture file is not valid.
+    """
+    pass
+
+def _getCodec(codec):
+    """
+    Return a 2-tuple of compress and decompress functions for given codec.
+    """
+    if codec == CODEC_ZLIB:
+        return (lambda x: zlib.compress(x, 1)), zlib.decompress
+    if codec == CODEC_LZMA:
+        if lzma is None:
+            raise CompressedCaptureError('lzma module not available')
+        return (lambda x: lzma.compress(x, preset=1)), lzma.decompress
+    raise CompressedCaptureError('Unknown codec %r' % (codec, ))
+
+def isCompressed(head):
+    """
+    Tell whether given file head (at least len(MAGIC) bytes) belongs to a
+    compressed capture.
+    """
+    return head[:len(MAGIC)] == MAGIC
+
+class CompressedWriter(object):
+    """
+    File-like object compressing written data in a separate thread.
+    Writes never wait for compression, so this can be used from USB transfer
+    callbacks.
+    """
+    def __init__(self, stream, codec=CODEC_ZLIB, frame_size=FRAME_SIZE):
+        """
+        stream (file-ish object)
+            Where compressed data goes. Must be opened in binary mode.
+        codec (CODEC_ZLIB, CODEC_LZMA)
+        frame_size (int)
+            Amount of raw data per frame.
+        """
+        self._compress, _ = _getCodec(codec)
+        self._stream = stream
+        self._frame_size = frame_size
+        self._offset = HEADER_LEN
+        self._index = []
+        self._error = None
+        stream.write(pack(HEADER_FORMAT, MAGIC, VERSION, codec))
+        self._queue = queue = Queue()
+        self._put = queue.put
+        self._thread = thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._put(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Wait for pending data to be compressed, write index and close
+        underlying stream.
+        """
+        self._put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        stream = self._stream
+        index = self._index
+        index_offset = self._offset
+        write = stream.write
+        write(pack(INDEX_HEADER_FORMAT, INDEX_MAGIC, len(index)))
+        for entry in index:
+            write(pack(INDEX_ENTRY_FORMAT, *entry))
+        write(pack(TRAILER_FORMAT, index_offset, TRAILER_MAGIC))
+        stream.close()
+
+    def _run(self):
+        try:
+            self._compressLoop()
+        except Exception, exc:
+            self._error = exc
+
+    def _compressLoop(self):
+        get = self._queue.get
+        # Only used to track tic count and packet boundaries.
+        tracker = ReorderedStream(NoopAggregator(lambda *args: None))
+        track = tracker.push
+        frame_size = self._frame_size
+        frame_tic = 0
+        raw_offset = 0
+        buf = []
+        buf_len = 0
+        while True:
+            data = get()
+            if data is None:
+                break
+            buf.append(data)
+            buf_len += len(data)
+            track(data)
+            if buf_len >= frame_size and tracker.isAligned():
+                self._writeFrame(raw_offset, ''.join(buf), frame_tic)
+                raw_offset += buf_len
+                frame_tic = tracker.getTic()
+                buf = []
+                buf_len = 0
+        if buf:
+            self._writeFrame(raw_offset, ''.join(buf), frame_tic)
+
+    def _writeFrame(self, raw_offset, data, tic):
+        compressed = self._compress(data)
+        raw_len = len(data)
+        self._index.append((raw_offset, raw_len, tic, self._offset))
+        self._stream.write(
+            pack(FRAME_HEADER_FORMAT, FRAME_MAGIC, len(compressed), raw_len,
+                tic) + compressed,
+        )
+        self._offset += FRAME_HEADER_LEN + len(compressed)
+
+class CompressedReader(object):
+    """
+    File-like object decompressing a compressed capture.
+
+    Sequential reading works on non-seekable streams (ex: pipes).
+    Frame-level random access requires a seekable stream.
+    """
+    def __init__(self, stream, head=''):
+        """
+        stream (file-ish object)
+            Compressed capture, positioned at its beginning.
+        head (string)
+            Bytes already read from stream (ex: to detect file type).
+        """
+        self._stream = stream
+        header = head + stream.read(HEADER_LEN - len(head))
+        if len(header) != HEADER_LEN:
+            raise CompressedCaptureError('Truncated header')
+        magic, version, codec = unpack(HEADER_FORMAT, header)
+        if magic != MAGIC:
+            raise CompressedCaptureError('Bad magic: %r' % (magic, ))
+        if version != VERSION:
+            raise CompressedCaptureError('Unsupported version %i' % (version, ))
+        _, self._decompress = _getCodec(codec)
+        self._frame_list = None
+        self._buf = ''
+        self._eof = False
+
+    def _readFrameHeader(self):
+        """
+        Read frame header at current stream position.
+        Returns None when there is no more frame.
+        """
+        header = self._stream.read(FRAME_HEADER_LEN)
+        if len(header) < FRAME_HEADER_LEN or \
+                header[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+            return None
+        return unpack(FRAME_HEADER_FORMAT, header)[1:]
+
+    def _readNextFrame(self):
+        frame_header = self._readFrameHeader()
+        if frame_header is None:
+            return None
+        compressed_len, raw_len, _ = frame_header
+        compressed = self._stream.read(compressed_len)
+        if len(compressed) != compressed_len:
+            # Writer was interrupted in the middle of a frame.
+            return None
+        data = self._decompress(compressed)
+        if len(data) != raw_len:
+            raise CompressedCaptureError('Frame length mismatch')
+        return data
+
+    def read(self, size=-1):
+        """
+        Read raw capture data sequentially.
+        """
+        chunk_list = [self._buf]
+        available = len(self._buf)
+        while (size < 0 or available < size) and not self._eof:
+            data = self._readNextFrame()
+            if data is None:
+                self._eof = True
+                break
+            chunk_list.append(data)
+            available += len(data)
+        data = ''.join(chunk_list)
+        if size < 0:
+            self._buf = ''
+            return data
+        self._buf = data[size:]
+        return data[:size]
+
+    def close(self):
+        self._stream.close()
+
+    def getFrameList(self):
+        """
+        Return the list of frames, as 4-tuples:
+        - raw offset
+        - raw length
+        - starting tic
+        - file offset of frame header
+        Uses file index when present, otherwise walks frame headers.
+        """
+        if self._frame_list is None:
+            stream = self._stream
+            position = stream.tell()
+            try:
+                frame_list = self._readIndex()
+                if frame_list is None:
+                    frame_list = self._scanFrames()
+            finally:
+                stream.seek(position)
+            self._frame_list = frame_list
+        return self._frame_list
+
+    def _readIndex(self):
+        stream = self._stream
+        stream.seek(0, 2)
+        if stream.tell() < HEADER_LEN + TRAILER_LEN:
+            return None
+        stream.seek(-TRAILER_LEN, 2)
+        index_offset, magic = unpack(TRAILER_FORMAT, stream.read(TRAILER_LEN))
+        if magic != TRAILER_MAGIC:
+            return None
+        stream.seek(index_offset)
+        magic, count = unpack(
+            INDEX_HEADER_FORMAT,
+            stream.read(INDEX_HEADER_LEN),
+        )
+        if magic != INDEX_MAGIC:
+            raise CompressedCaptureError('Bad index magic: %r' % (magic, ))
+        data = stream.read(count * INDEX_ENTRY_LEN)
+        return [
+            unpack(INDEX_ENTRY_FORMAT, data[x:x + INDEX_ENTRY_LEN])
+            for x in xrange(0, len(data), INDEX_ENTRY_LEN)
+        ]
+
+    def _scanFrames(self):
+        stream = self._stream
+        stream.seek(HEADER_LEN)
+        frame_list = []
+        raw_offset = 0
+        while True:
+            file_offset = stream.tell()
+            frame_header = self._readFrameHeader()
+            if frame_header is None:
+                break
+            compressed_len, raw_len, tic = frame_header
+            frame_list.append((raw_offset, raw_len, tic, file_offset))
+            raw_offset += raw_len
+            stream.seek(compressed_len, 1)
+        return frame_list
+
+    def getRawSize(self):
+        """
+        Return uncompressed capture size.
+        """
+        frame_list = self.getFrameList()
+        if not frame_list:
+            return 0
+        raw_offset, raw_len, _, _ = frame_list[-1]
+        return raw_offset + raw_len
+
+    def findFrame(self, tic):
+        """
+        Return the index of the last frame starting at or before given tic.
+        """
+        tic_list = [x[2] for x in self.getFrameList()]
+        return max(bisect_right(tic_list, tic) - 1, 0)
+
+    def readFrame(self, index):
+        """
+        Return raw data of given frame, without altering sequential reading
+        position.
+        """
+        stream = self._stream
+        position = stream.tell()
+        try:
+            stream.seek(self.getFrameList()[index][3])
+            data = self._readNextFrame()
+        finally:
+            stream.seek(position)
+        if data is None:
+            raise CompressedCaptureError('Truncated frame %i' % (index, ))
+        return data
+
+    def seekFrame(self, index):
+        """
+        Move sequential reading position to the beginning of given frame.
+        Returns frame starting tic, to be given to ReorderedStream.
+        """
+        _, _, tic, file_offset = self.getFrameList()[index]
+        self._stream.seek(file_offset)
+        self._buf = ''
+        self._eof = False
+        return tic
+
+def openCapture(path):
+    """
+    Open a capture file for reading, transparently decompressing it if
+    needed.
+    """
+    stream = open(path, 'rb')
+    head = stream.read(len(MAGIC))
+    if isCompressed(head):
+        return CompressedReader(stream, head)
+    stream.seek(0)
+    return stream
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Capture daemon: keeps the analyser opened and its FPGA configured between
+capture sessions, so starting a capture does not involve a firmware upload.
+
+Between sessions, capture is paused on the analyser and received data is
+discarded.
+
+Control protocol, on a local Unix socket: one command per line (shell-like
+quoting), one response line per command, starting with "OK" or "ERROR".
+  start PATH [CODEC]  Start a session, writing data to PATH, optionally
+                      compressed with CODEC (see iti1480a-capture --compress).
+  pause               Pause current session.
+  continue            Resume current session.
+  stop                Terminate current session.
+  status              Describe daemon state.
+  quit                Terminate current session, stop capture and exit.
+"""
+import errno
+import os
+import pipes
+import select
+import shlex
+import signal
+import socket
+import sys
+import tempfile
+import time
+from struct import pack
+import usb1
+from iti1480a.capture import getDeviceHandle, USBAnalyzer, \
+    submitTransferList, parseUSBDevice, uploadFirmware, VENDOR_ID, DEVICE_ID
+from iti1480a.compressed import CompressedWriter, CODEC_NAME_DICT
+from iti1480a.parser import TYPE_EVENT, TYPE_SHIFT, \
+    EVENT_CAPTURE_PAUSED, EVENT_CAPTURE_STOPPED_USER
+
+DEFAULT_SOCKET = os.path.join(
+    tempfile.gettempdir(),
+    'iti1480a-%i.sock' % (os.getuid(), ),
+)
+
+STATE_IDLE = 'idle'
+STATE_CAPTURING = 'capturing'
+STATE_PAUSED = 'paused'
+STATE_STOPPING = 'stopping'
+
+# How long to wait for the analyser to acknowledge pause when stopping a
+# session, in seconds.
+STOP_TIMEOUT = 1
+
+def _getEventPacket(event):
+    """
+    Return an event packet (with a 1-tic increment), in file order.
+    """
+    return pack('<H', ((TYPE_EVENT << TYPE_SHIFT | 1) << 8) | event)
+
+# Appended to session data, so decoders know the capture is over.
+STOP_MARKER = _getEventPacket(EVENT_CAPTURE_STOPPED_USER)
+
+def _endsWithEvent(data, event):
+    """
+    Whether data ends with a single-byte-header event packet for given event.
+    """
+    return len(data) > 1 and ord(data[-2]) == event and \
+        ord(data[-1]) & 0xf0 == TYPE_EVENT << TYPE_SHIFT
+
+class _Poller(object):
+    """
+    select.poll wrapper taking timeout in seconds, as expected by
+    usb1.USBPoller, and ignoring interruptions by signals.
+    """
+    def __init__(self):
+        self._poll = poll = select.poll()
+        self.register = poll.register
+        self.unregister = poll.unregister
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            return self._poll.poll(timeout)
+        except select.error, exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            return []
+
+class CaptureDaemon(object):
+    def __init__(self, context, handle, analyzer, verbose=False):
+        """
+        context (usb1.USBContext)
+        handle (usb1.USBDeviceHandle)
+            Claimed device handle.
+        analyzer (BaseUSBAnalyzer)
+            Analyser, with FPGA firmware already uploaded.
+        """
+        self._context = context
+        self._analyzer = analyzer
+        self._verbose = verbose
+        self._state = STATE_IDLE
+        self._sink = None
+        self._path = None
+        self._written = 0
+        self._stop_deadline = None
+        self._running = True
+        analyzer.pauseCapture()
+        helper = usb1.USBTransferHelper()
+        helper.setEventCallback(usb1.TRANSFER_COMPLETED, self._onTransfer)
+        self._reader_list = submitTransferList(handle, helper)
+        self._command_dict = {
+            'start': self._start,
+            'pause': self._pause,
+            'continue': self._continue,
+            'stop': self._stop,
+            'status': self._status,
+            'quit': self._quit,
+        }
+
+    def _log(self, message):
+        if self._verbose:
+            sys.stderr.write(message + '\n')
+
+    def _onTransfer(self, transfer):
+        size = transfer.getActualLength()
+        if size:
+            sink = self._sink
+            if sink is not None:
+                data = transfer.getBuffer()[:size]
+                sink.write(data)
+                self._written += size
+                if self._state == STATE_STOPPING and \
+                        _endsWithEvent(data, EVENT_CAPTURE_PAUSED):
+                    self._closeSession()
+        return self._running
+
+    def _closeSession(self):
+        sink = self._sink
+        sink.write(STOP_MARKER)
+        sink.close()
+        self._log('Session ended: %s (%i bytes)' % (self._path, self._written))
+        self._sink = self._path = self._stop_deadline = None
+        self._state = STATE_IDLE
+
+    def _start(self, path, codec=None):
+        if self._state != STATE_IDLE:
+            raise ValueError('Session already running')
+        if codec is not None:
+            try:
+                codec = CODEC_NAME_DICT[codec]
+            except KeyError:
+                raise ValueError('Unavailable codec %r' % (codec, ))
+        sink = open(path, 'wb', 0)
+        if codec is not None:
+            sink = CompressedWriter(sink, codec=codec)
+        self._sink = sink
+        self._path = path
+        self._written = 0
+        self._analyzer.continueCapture()
+        self._state = STATE_CAPTURING
+        self._log('Session started: %s' % (path, ))
+
+    def _pause(self):
+        if self._state != STATE_CAPTURING:
+            raise ValueError('Not capturing')
+        self._analyzer.pauseCapture()
+        self._state = STATE_PAUSED
+
+    def _continue(self):
+        if self._state != STATE_PAUSED:
+            raise ValueError('Not paused')
+        self._analyzer.continueCapture()
+        self._state = STATE_CAPTURING
+
+    def _stop(self):
+        if self._state == STATE_CAPTURING:
+            self._analyzer.pauseCapture()
+            self._state = STATE_STOPPING
+            self._stop_deadline = time.time() + STOP_TIMEOUT
+        elif self._state == STATE_PAUSED:
+            # Pause event already received (or lost).
+            self._closeSession()
+        else:
+            raise ValueError('No session running')
+
+    def _status(self):
+        return 'state=%s path=%s written=%i analyzer_status=0x%02x' % (
+            self._state,
+            self._path,
+            self._written,
+            self._analyzer.getStatus(),
+        )
+
+    def _quit(self):
+        if not self._running:
+            return
+        if self._state == STATE_CAPTURING:
+            self._analyzer.pauseCapture()
+        if self._sink is not None:
+            self._closeSession()
+        self._analyzer.stopCapture()
+        self._running = False
+        for transfer in self._reader_list:
+            try:
+                transfer.cancel()
+            except usb1.USBErrorNotFound:
+                # Transfer already completed.
+                pass
+
+    def execute(self, line):
+        """
+        Execute a single command line, and return response line.
+        """
+        try:
+            argument_list = shlex.split(line)
+            if not argument_list:
+                raise ValueError('Empty command')
+            command = argument_list.pop(0)
+            try:
+                method = self._command_dict[command]
+            except KeyError:
+                raise ValueError('Unknown command %r' % (command, ))
+            result = method(*argument_list)
+        except (ValueError, TypeError, KeyError, IOError, usb1.USBError), exc:
+            return 'ERROR %s' % (exc, )
+        if result is None:
+            return 'OK'
+        return 'OK ' + result
+
+    def run(self, listener, call_queue):
+        """
+        Serve commands from given listening socket until "quit" is received.
+        call_queue (list)
+            Callables to execute from the event loop (ex: from signal
+            handlers).
+        """
+        poller = usb1.USBPoller(self._context, _Poller())
+        listener.setblocking(False)
+        listener_fd = listener.fileno()
+        poller.register(listener_fd, select.POLLIN)
+        client_dict = {}
+        try:
+            while self._running or \
+                    any(x.isSubmitted() for x in self._reader_list):
+                for fd, _ in poller.poll(STOP_TIMEOUT):
+                    if fd == listener_fd:
+                        try:
+                            client, _ = listener.accept()
+                        except socket.error, exc:
+                            if exc.args[0] != errno.EAGAIN:
+                                raise
+                            continue
+                        client.setblocking(True)
+                        client_dict[client.fileno()] = [client, '']
+                        poller.register(client.fileno(), select.POLLIN)
+                        continue
+                    client_entry = client_dict[fd]
+                    client = client_entry[0]
+                    data = client.recv(4096)
+                    if not data:
+                        poller.unregister(fd)
+                        del client_dict[fd]
+                        client.close()
+                        continue
+                    client_entry[1] += data
+                    while '\n' in client_entry[1]:
+                        line, client_entry[1] = client_entry[1].split('\n', 1)
+                        response = self.execute(line)
+                        self._log('%r: %s' % (line, response))
+                        try:
+                            client.sendall(response + '\n')
+                        except socket.error, exc:
+                            if exc.args[0] != errno.EPIPE:
+                                raise
+                while call_queue:
+                    call_queue.pop(0)()
+                if self._stop_deadline is not None and \
+                        time.time() > self._stop_deadline:
+                    self._log('Timeout waiting for pause acknowledgement')
+                    self._closeSession()
+        finally:
+            for client, _ in client_dict.itervalues():
+                client.close()
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option(
+        '-f', '--firmware', default='/lib/firmware/ITI1480A.rbf',
+        help='Path to firmware file to upload',
+    )
+    parser.add_option(
+        '-d', '--device',
+        help='USB device to use, in "bus.dev" format',
+    )
+    parser.add_option(
+        '-k', '--skip-loaded-firmware', action='store_true',
+        help='Do not upload firmware if FPGA is already configured',
+    )
+    parser.add_option(
+        '-s', '--socket', default=DEFAULT_SOCKET,
+        help='Unix socket to listen on. Default: %default',
+    )
+    parser.add_option(
+        '-v', '--verbose', action='store_true',
+        help='Print informative messages to stderr',
+    )
+    (options, args) = parser.parse_args()
+    usb_device = parseUSBDevice(options.device)
+    try:
+        os.unlink(options.socket)
+    except OSError, exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(options.socket)
+    listener.listen(5)
+    with usb1.USBContext() as context:
+        handle = getDeviceHandle(context, VENDOR_ID, DEVICE_ID, usb_device)
+        if handle is None:
+            print >>sys.stderr, 'ITI1480A USB Analyzer not found'
+            sys.exit(1)
+        handle.claimInterface(0)
+        try:
+            analyzer = USBAnalyzer(handle)
+            uploadFirmware(
+                context,
+                analyzer,
+                options.firmware,
+                skip_loaded=options.skip_loaded_firmware,
+                verbose=options.verbose,
+            )
+            daemon = CaptureDaemon(
+                context,
+                handle,
+                analyzer,
+                verbose=options.verbose,
+            )
+            # Same reasoning as in iti1480a-capture: execute signal-triggered
+            # actions from the event loop.
+            call_queue = []
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(
+                    sig,
+                    lambda sig, stack: call_queue.append(
+                        lambda: daemon.execute('quit'),
+                    ),
+                )
+            if options.verbose:
+                sys.stderr.write('Listening on %s\n' % (options.socket, ))
+            daemon.run(listener, call_queue)
+        finally:
+            handle.releaseInterface(0)
+            listener.close()
+            os.unlink(options.socket)
+
+def control():
+    from optparse import OptionParser
+    parser = OptionParser(
+        usage='%prog [options] start PATH [CODEC]|pause|continue|stop|'
+        'status|quit',
+    )
+    parser.add_option(
+        '-s', '--socket', default=DEFAULT_SOCKET,
+        help='Daemon Unix socket. Default: %default',
+    )
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    if args[0] == 'start' and len(args) > 1:
+        # Daemon current directory is likely different from ours.
+        args[1] = os.path.abspath(args[1])
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(options.socket)
+    client.sendall(' '.join(pipes.quote(x) for x in args) + '\n')
+    response = ''
+    while '\n' not in response:
+        data = client.recv(4096)
+        if not data:
+            break
+        response += data
+    client.close()
+    response = response.rstrip('\n')
+    print response
+    if not response.startswith('OK'):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
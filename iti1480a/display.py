@@ -15,12 +15,23 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 from iti1480a.parser import *
+from iti1480a.compressed import CompressedReader, isCompressed, MAGIC
+from iti1480a.ring import RingReader, RingOverrun
+from iti1480a.latency import LatencyTracer, ClockFollower
+from iti1480a.stageprofile import profileStage
+from iti1480a.memprofile import profileMemory
+from iti1480a.cache import openCache, CACHE_DIR, CHANNEL_TRANSACTION, \
+    CHANNEL_TRANSACTION_ERROR, CHANNEL_PACKETISER
+from iti1480a.stats import Statistics, INTERVAL
+from iti1480a.readsize import AdaptiveReadSize
+import json
 import signal
 import sys
 import errno
 import select
 import fcntl
 import os
+import time
 
 COLOR_GREEN = '\x1b[32m'
 COLOR_STRONG_GREEN = '\x1b[1;32m'
@@ -240,11 +251,62 @@ class HumanReadable(object):
             result += '\n' + hexdump(packet_data)
         return result
 
-    def stop(self):
+    def flush(self):
+        """
+        Print pending SOF summary, so it does not wait for next non-SOF
+        event.
+        """
         if self._sof_count:
             self._printSOFCount()
 
-CHUNK_SIZE = 16 * 1024
+    def stop(self):
+        self.flush()
+
+class TimeWindow(object):
+    """
+    Only pass through events whose tic is within given bounds.
+    """
+    def __init__(self, to_next, start=None, stop=None):
+        self._to_next = to_next
+        self._start = start
+        self._stop = stop
+
+    def push(self, tic, message_type, data):
+        if tic is not None and (
+                    (self._start is not None and tic < self._start) or
+                    (self._stop is not None and tic > self._stop)
+                ):
+            return
+        self._to_next.push(tic, message_type, data)
+
+    def stop(self):
+        self._to_next.stop()
+
+class StatisticsWriter(object):
+    """
+    Compute statistics instead of rendering, and write them when decoding
+    ends.
+    """
+    def __init__(self, write, as_json, interval):
+        self._write = write
+        self._as_json = as_json
+        self._statistics = statistics = Statistics(interval)
+        self.push = statistics.push
+
+    def flush(self):
+        # Statistics are only written when decoding ends.
+        pass
+
+    def stop(self):
+        statistics = self._statistics
+        if self._as_json:
+            self._write(json.dumps(statistics.asDict(), sort_keys=True) + '\n')
+        else:
+            statistics.report(self._write)
+
+profileStage(HumanReadable, lambda x: x._sof_count)
+profileMemory(HumanReadable)
+
 def main():
     from optparse import OptionParser
     parser = OptionParser()
@@ -260,6 +322,11 @@ def main():
         '-i', '--infile', default='-',
         help='Data source (default: stdin)',
     )
+    parser.add_option(
+        '-r', '--ring',
+        help='Read data from shared-memory ring at this path, as created by '
+        'iti1480a-capture --ring. Overrides --infile.',
+    )
     parser.add_option(
         '-o', '--outfile', default='-',
         help='Data destination (default: stdout)',
@@ -270,10 +337,85 @@ def main():
         'gets closed, so next process (ie, this program) does not know it '
         'should exit.',
     )
+    parser.add_option(
+        '--latency',
+        help='Trace latency from capture to each decoding stage, using this '
+        'clock log (as written by iti1480a-capture -c --clock-interval 0). '
+        'Only the first output of each stage per read chunk is timed. '
+        'Per-stage report is printed on stderr when decoding ends.',
+    )
+    parser.add_option(
+        '--latency-dump',
+        help='Also write per-stage latencies to this file, as JSON',
+    )
     parser.add_option('-f', '--follow', action='store_true',
         help='Ignore SIGINT & SIGTERM so all input is read.')
+    parser.add_option(
+        '-l', '--live', type='float',
+        help='Live output latency target, in milliseconds: output is flushed '
+        'whenever input is idle, and pending SOF summaries are printed and '
+        'output flushed at least this often.',
+    )
+    parser.add_option(
+        '-c', '--cache', action='store_true',
+        help='Read decoded transactions from cache if --infile was decoded '
+        'before by the same parser version, and fill cache otherwise. '
+        'Cache directory is ITI1480A_CACHE_DIR, or $XDG_CACHE_HOME/iti1480a.',
+    )
+    parser.add_option(
+        '--from', dest='start',
+        help='Only display events from this time, in seconds or as displayed '
+        '(ex: 83.456, 01:23.456). On compressed captures, decoding starts '
+        'from the closest preceding frame.',
+    )
+    parser.add_option(
+        '--to', dest='stop',
+        help='Only display events up to this time, and stop decoding after '
+        'it. Same format as --from.',
+    )
+    parser.add_option(
+        '-s', '--stats', type='choice', choices=('table', 'json'),
+        help='Instead of displaying traffic, print per-endpoint statistics '
+        '(transactions, bytes, handshake ratios, CRC errors, throughput) '
+        'when decoding ends, as a table or as JSON.',
+    )
+    parser.add_option(
+        '--stats-interval', type='float', default=INTERVAL,
+        help='Throughput interval for --stats, in seconds (default: '
+        '%default)',
+    )
     (options, args) = parser.parse_args()
-    if options.infile == '-':
+    time_window = {}
+    for name in ('start', 'stop'):
+        value = getattr(options, name)
+        if value is not None:
+            try:
+                time_window[name] = time_to_tic(value)
+            except ValueError, exc:
+                print >>sys.stderr, exc
+                sys.exit(1)
+    start_tic = time_window.get('start')
+    stop_tic = time_window.get('stop')
+    if options.cache and (
+                options.infile == '-' or
+                options.ring or
+                options.tee or
+                options.latency or
+                CACHE_DIR is None
+            ):
+        print >>sys.stderr, '--cache requires --infile and a cache ' \
+            'directory, and cannot be used with --ring, --tee or --latency'
+        sys.exit(1)
+    if options.ring:
+        try:
+            infile = RingReader(options.ring)
+        except (OSError, ValueError), exc:
+            print >>sys.stderr, 'Could not open --ring %r: %s' % (
+                options.ring,
+                exc,
+            )
+            sys.exit(1)
+    elif options.infile == '-':
         infile = sys.stdin
     else:
         try:
@@ -284,15 +426,16 @@ def main():
             )
             sys.exit(1)
     if options.outfile == '-':
-        write = sys.stdout.write
+        outfile = sys.stdout
     else:
         try:
-            write = open(options.outfile, 'w').write
+            outfile = open(options.outfile, 'w')
         except IOError:
             print >>sys.stderr, 'Could not open --outfile %r' % (
                 options.outfile,
             )
             sys.exit(1)
+    write = outfile.write
     if options.tee:
         try:
             raw_write = open(options.tee, 'w').write
@@ -301,62 +444,242 @@ def main():
             sys.exit(1)
     else:
         raw_write = lambda x: None
-    human_readable = HumanReadable(
-        write,
-        options.verbose - options.quiet,
-    )
-    stream = ReorderedStream(
-        Packetiser(
-            TransactionAggregator(
-                human_readable,
-                human_readable.push,
-            ),
-            human_readable.push
+    if options.latency:
+        try:
+            tracer = LatencyTracer(
+                ClockFollower(open(options.latency)),
+                ('reorder', 'packetiser', 'transaction', 'render'),
+            )
+        except IOError:
+            print >>sys.stderr, 'Could not open --latency %r' % (
+                options.latency,
+            )
+            sys.exit(1)
+        wrap = tracer.wrap
+        wrapAggregator = tracer.wrapAggregator
+        write = wrap('render', write)
+    else:
+        tracer = None
+        wrap = wrapAggregator = lambda name, x: x
+    if options.stats:
+        human_readable = StatisticsWriter(
+            write,
+            options.stats == 'json',
+            options.stats_interval,
         )
-    )
-    push = stream.push
+    else:
+        human_readable = HumanReadable(
+            write,
+            options.verbose - options.quiet,
+        )
+    if time_window:
+        output = TimeWindow(human_readable, start_tic, stop_tic)
+    else:
+        output = human_readable
+    transaction_sink = output
+    transaction_top = packetiser_top = output.push
+    if options.cache:
+        record_iterator, recorder = openCache(options.infile)
+        if record_iterator is not None:
+            push = output.push
+            try:
+                # All channels go to the same place.
+                for _, args in record_iterator:
+                    push(*args)
+                output.stop()
+            except IOError, exc:
+                if exc.errno != errno.EPIPE:
+                    raise
+            except KeyboardInterrupt:
+                pass
+            return
+        if recorder is None:
+            print >>sys.stderr, 'Warning: cannot write to cache directory'
+        elif time_window:
+            # Only part of the capture will be decoded.
+            recorder.abort()
+            recorder = None
+        else:
+            transaction_sink = recorder.wrapAggregator(
+                CHANNEL_TRANSACTION,
+                output,
+            )
+            transaction_top = recorder.wrap(
+                CHANNEL_TRANSACTION_ERROR,
+                output.push,
+            )
+            packetiser_top = recorder.wrap(
+                CHANNEL_PACKETISER,
+                output.push,
+            )
+    else:
+        recorder = None
     if options.follow:
         for sig in (signal.SIGINT, signal.SIGTERM):
             signal.signal(sig, signal.SIG_IGN)
-    fcntl.fcntl(
-        infile,
-        fcntl.F_SETFL,
-        fcntl.fcntl(infile, fcntl.F_GETFL) | os.O_NONBLOCK,
+    initial_tic = 0
+    resync = False
+    # Whether data may not start on a packet boundary.
+    stream_resync = False
+    # Whether first data byte must be skipped to start on a word boundary.
+    skip_byte = False
+    if options.ring:
+        # Ring reads wait for data on their own.
+        head = ''
+        if infile.tell():
+            # Capture start was already overwritten, so reading starts at an
+            # arbitrary point.
+            resync = stream_resync = True
+            skip_byte = infile.tell() % 2
+    else:
+        # Read file head before switching to non-blocking mode, to detect
+        # compressed captures.
+        head = infile.read(len(MAGIC))
+        if isCompressed(head):
+            infile = CompressedReader(infile, head)
+            head = ''
+            if start_tic is not None and options.infile != '-':
+                # Frame index gives where to start decoding from.
+                index = infile.findFrame(start_tic)
+                if index:
+                    initial_tic = infile.seekFrame(index)
+                    resync = True
+        else:
+            fcntl.fcntl(
+                infile,
+                fcntl.F_SETFL,
+                fcntl.fcntl(infile, fcntl.F_GETFL) | os.O_NONBLOCK,
+            )
+    packetiser = Packetiser(
+        wrapAggregator('packetiser', TransactionAggregator(
+            wrapAggregator('transaction', transaction_sink),
+            wrap('transaction', transaction_top),
+        )),
+        wrap('packetiser', packetiser_top),
+        resync=resync,
+    )
+    stream = ReorderedStream(
+        wrapAggregator('reorder', packetiser),
+        initial_tic,
+        resync=stream_resync,
     )
+    push = stream.push
     rlist = [infile]
     wlist = elist = []
     read = infile.read
+    read_size = AdaptiveReadSize()
+    # Capture data offset of next chunk, for latency tracing.
+    offset = infile.tell() if options.ring else 0
+    if options.live:
+        live_interval = options.live / 1000.
+        next_flush = time.time() + live_interval
+    else:
+        live_interval = None
+    # Ring reads wait for data on their own, so wait separately to flush
+    # output meanwhile.
+    ring_wait = infile.wait if options.ring and live_interval else None
     try:
+        # File head was already read, process it first.
+        data = head
         while True:
-            try:
-                data = read(CHUNK_SIZE)
-            except IOError, exc:
-                if exc.errno != errno.EAGAIN:
-                    raise
-                # Using select instead of more recent alternatives, because:
-                # - we wait on one file descriptor, which is likely to have a
-                #   very low value (1 or 4), so bad performance is not really
-                #   an issue.
-                # - although this is ITI1480A-*linux*, I do not want to
-                #   alienate BSD users by relying on epoll.
-                # Ignore return value, error is detected by empty read.
-                select.select(rlist, wlist, elist)
-                continue
             if not data:
-                break
+                if ring_wait is not None and \
+                        not ring_wait(max(next_flush - time.time(), 0)):
+                    idle = True
+                else:
+                    idle = False
+                    try:
+                        data = read(read_size.size)
+                    except RingOverrun, exc:
+                        print >>sys.stderr, 'Warning: ring overrun: %s, ' \
+                            'following times are early by lost ' \
+                            'duration' % (exc, )
+                        # Reading continues at an arbitrary point.
+                        stream.resync()
+                        packetiser.resync()
+                        offset = infile.tell()
+                        skip_byte = offset % 2
+                        continue
+                    except IOError, exc:
+                        if exc.errno != errno.EAGAIN:
+                            raise
+                        # Input is idle, decode smaller chunks to output
+                        # events sooner.
+                        read_size.update(0)
+                        if live_interval is None:
+                            # Using select instead of more recent
+                            # alternatives, because:
+                            # - we wait on one file descriptor, which is
+                            #   likely to have a very low value (1 or 4), so
+                            #   bad performance is not really an issue.
+                            # - although this is ITI1480A-*linux*, I do not
+                            #   want to alienate BSD users by relying on
+                            #   epoll.
+                            # Ignore return value, error is detected by empty
+                            # read.
+                            select.select(rlist, wlist, elist)
+                            continue
+                        idle = True
+                    else:
+                        if not data:
+                            break
+                        read_size.update(len(data))
+                        if skip_byte:
+                            data = data[1:]
+                            offset += 1
+                            skip_byte = False
+                            if not data:
+                                continue
+                if idle:
+                    # Show everything decoded so far while waiting.
+                    now = time.time()
+                    if now >= next_flush:
+                        human_readable.flush()
+                        next_flush = now + live_interval
+                    outfile.flush()
+                    if ring_wait is None:
+                        select.select(
+                            rlist, wlist, elist,
+                            max(next_flush - now, 0),
+                        )
+                    continue
             raw_write(data)
+            if tracer is not None:
+                tracer.startChunk(offset)
+                offset += len(data)
             try:
                 push(data)
             except ParsingDone:
                 break
+            if stop_tic is not None and stream.getTic() > stop_tic:
+                break
+            if live_interval is not None:
+                # Input is busy, flush on schedule.
+                now = time.time()
+                if now >= next_flush:
+                    human_readable.flush()
+                    outfile.flush()
+                    next_flush = now + live_interval
+            data = ''
         stream.stop()
     except IOError, exc:
+        if recorder is not None:
+            recorder.abort()
         # Happens when output is piped to a pager, and pager exits before stdin
         # is fully parsed.
         if exc.errno != errno.EPIPE:
             raise
     except KeyboardInterrupt:
-        pass
+        if recorder is not None:
+            recorder.abort()
+    else:
+        if recorder is not None:
+            recorder.commit()
+    if tracer is not None:
+        tracer.report(sys.stderr.write)
+        if options.latency_dump:
+            with open(options.latency_dump, 'w') as dump:
+                tracer.dump(dump)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Columnar export of decoded traffic, for vectorised analysis.
+
+One row per transaction (or per packet), with columns:
+- tic: first packet tic count
+- kind: MESSAGE_TRANSACTION, MESSAGE_INCOMPLETE or MESSAGE_PACKET
+- pid: token PID (packet PID for packets)
+- address, endpoint: token destination, -1 when there is none (SOF...)
+- length: payload length
+- status: handshake PID, 0 when there is none
+- crc_error: whether any packet has a bad CRC or is truncated
+- payload_offset: offset of payload in payload arena file
+
+Payloads are concatenated in payload.bin, so payload of row i is
+payload[payload_offset[i]:payload_offset[i] + length[i]].
+
+In npy format, each column is written to its own .npy file as rows are
+decoded, with the header completed at the end. Capture is read in a single
+pass with constant memory, and numpy is not needed to write them. Columns
+can be loaded with numpy.load(path, mmap_mode='r').
+"""
+import csv
+import errno
+import os
+from struct import pack
+import sys
+from iti1480a.parser import TRANSACTION_DECODER_DICT, TOKEN_TYPE_SSPLIT, \
+    TOKEN_TYPE_CSPLIT, TOKEN_TYPE_PRE_ERR, MESSAGE_TRANSACTION, \
+    MESSAGE_INCOMPLETE, MESSAGE_PACKET, PID_SOF, PID_SPLIT, PID_PRE, \
+    TRANSACTION_TYPE_DICT, crc5, crc16, CRC5_RESIDUAL, CRC16_RESIDUAL
+from iti1480a.iterate import iterTransactions, iterPackets, READ_SIZE
+
+# Column name, numpy type description, struct format.
+COLUMN_LIST = (
+    ('tic', '<u8', 'Q'),
+    ('kind', '|u1', 'B'),
+    ('pid', '|u1', 'B'),
+    ('address', '<i2', 'h'),
+    ('endpoint', '<i2', 'h'),
+    ('length', '<u4', 'I'),
+    ('status', '|u1', 'B'),
+    ('crc_error', '|b1', '?'),
+    ('payload_offset', '<u8', 'Q'),
+)
+PAYLOAD_FILE_NAME = 'payload.bin'
+# Rows buffered before being written.
+FLUSH_ROWS = 64 * 1024
+
+NPY_MAGIC = '\x93NUMPY\x01\x00'
+# Header is written before row count is known, so reserve enough room for
+# any row count.
+NPY_HEADER_SIZE = 128
+
+_SKIPPED_TOKEN_SET = frozenset((
+    TOKEN_TYPE_SSPLIT,
+    TOKEN_TYPE_CSPLIT,
+    TOKEN_TYPE_PRE_ERR,
+))
+_TOKEN_PID_SET = frozenset(
+    pid for pid, token_type in TRANSACTION_TYPE_DICT.iteritems()
+    if token_type in ('IN', 'OUT', 'SETUP', 'PING', 'SOF')
+)
+
+class NpyColumnWriter(object):
+    """
+    Write a 1-dimension .npy file, one value at a time.
+    """
+    def __init__(self, path, descr, struct_format):
+        self._file = open(path, 'wb')
+        self._file.write(self._getHeader(descr, 0))
+        self._descr = descr
+        self._format = struct_format
+        self._buffer = []
+        self._count = 0
+
+    @staticmethod
+    def _getHeader(descr, count):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%i,), }" % (
+            descr,
+            count,
+        )
+        header_length = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+        return NPY_MAGIC + pack('<H', header_length) + header.ljust(
+            header_length - 1,
+        ) + '\n'
+
+    def append(self, value):
+        self._buffer.append(value)
+
+    def flush(self):
+        value_list = self._buffer
+        if value_list:
+            self._file.write(pack(
+                '<%i%s' % (len(value_list), self._format),
+                *value_list
+            ))
+            self._count += len(value_list)
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._file.seek(0)
+        self._file.write(self._getHeader(self._descr, self._count))
+        self._file.close()
+
+class NpyWriter(object):
+    """
+    Write rows as one .npy file per column in given directory.
+    """
+    def __init__(self, directory):
+        self._column_list = [
+            NpyColumnWriter(
+                os.path.join(directory, name + '.npy'),
+                descr,
+                struct_format,
+            )
+            for name, descr, struct_format in COLUMN_LIST
+        ]
+        self._pending = 0
+
+    def writerow(self, row):
+        for column, value in zip(self._column_list, row):
+            column.append(value)
+        self._pending += 1
+        if self._pending >= FLUSH_ROWS:
+            for column in self._column_list:
+                column.flush()
+            self._pending = 0
+
+    def close(self):
+        for column in self._column_list:
+            column.close()
+
+class CSVWriter(object):
+    """
+    Write rows as a CSV file with a header line.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._writer = writer = csv.writer(self._file)
+        writer.writerow([x[0] for x in COLUMN_LIST])
+        self.writerow = writer.writerow
+
+    def close(self):
+        self._file.close()
+
+def iterTransactionRows(source, read_size=READ_SIZE):
+    """
+    Yield (row, payload) for each transaction in capture.
+    row is a tuple of COLUMN_LIST values, with a 0 payload_offset.
+    """
+    for tic, message_type, data in iterTransactions(source, read_size):
+        if message_type not in (MESSAGE_TRANSACTION, MESSAGE_INCOMPLETE):
+            continue
+        pid = 0
+        address = endpoint = -1
+        status = 0
+        crc_error = False
+        payload = ''
+        for token_type, packet in data:
+            try:
+                decoded = TRANSACTION_DECODER_DICT[token_type](packet)
+            except IndexError:
+                # Truncated packet: its fields are unknown.
+                decoded = {'crc_error': True}
+            crc_error = crc_error or decoded.get('crc_error', False)
+            if token_type in _SKIPPED_TOKEN_SET:
+                continue
+            packet_pid = packet[0][1] & 0xf
+            if 'data' in decoded:
+                payload = decoded['data']
+            elif not pid and packet_pid in _TOKEN_PID_SET:
+                pid = packet_pid
+                address = decoded.get('address', -1)
+                endpoint = decoded.get('endpoint', -1)
+            else:
+                status = packet_pid
+        yield (
+            tic, message_type, pid, address, endpoint, len(payload), status,
+            crc_error, 0,
+        ), payload
+
+def iterPacketRows(source, read_size=READ_SIZE):
+    """
+    Yield (row, payload) for each packet in capture.
+    row is a tuple of COLUMN_LIST values, with a 0 payload_offset.
+    """
+    for tic, message_type, packet in iterPackets(source, read_size):
+        if message_type != MESSAGE_PACKET:
+            continue
+        pid = packet[0][1] & 0xf
+        address = endpoint = -1
+        crc_error = False
+        payload = ''
+        if pid in _TOKEN_PID_SET or pid == PID_SPLIT:
+            crc_error = crc5(packet[1:]) != CRC5_RESIDUAL
+            if pid != PID_SOF and pid != PID_SPLIT and len(packet) == 3:
+                address = packet[1][1] & 0x7f
+                endpoint = (packet[1][1] >> 7) | ((packet[2][1] & 0x7) << 1)
+        elif len(packet) > 1 and pid != PID_PRE:
+            crc_error = crc16(packet[1:]) != CRC16_RESIDUAL
+            payload = ''.join(chr(x[1]) for x in packet[1:-2])
+        yield (
+            tic, MESSAGE_PACKET, pid, address, endpoint, len(payload), 0,
+            crc_error, 0,
+        ), payload
+
+def export(row_iterator, writer, payload_file):
+    """
+    Write rows from row_iterator to writer, and their payload to
+    payload_file.
+    Returns the number of rows written.
+    """
+    offset = 0
+    count = 0
+    write = writer.writerow
+    write_payload = payload_file.write
+    for row, payload in row_iterator:
+        if payload:
+            write_payload(payload)
+        write(row[:-1] + (offset, ))
+        offset += len(payload)
+        count += 1
+    return count
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] -i capture -o directory')
+    parser.add_option(
+        '-i', '--infile',
+        help='Capture to export',
+    )
+    parser.add_option(
+        '-o', '--outdir',
+        help='Directory to write columns and payload arena to. Created if '
+        'missing.',
+    )
+    parser.add_option(
+        '-f', '--format', type='choice', choices=('npy', 'csv'),
+        default='npy',
+        help='Output format: npy (one file per column) or csv. Default: '
+        '%default',
+    )
+    parser.add_option(
+        '-p', '--packets', action='store_true',
+        help='Export one row per packet instead of one row per transaction',
+    )
+    (options, args) = parser.parse_args()
+    if args or not options.infile or not options.outdir:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    try:
+        os.makedirs(options.outdir)
+    except OSError, exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    if options.format == 'npy':
+        writer = NpyWriter(options.outdir)
+    else:
+        writer = CSVWriter(os.path.join(
+            options.outdir,
+            ('packets' if options.packets else 'transactions') + '.csv',
+        ))
+    if options.packets:
+        row_iterator = iterPacketRows(options.infile)
+    else:
+        row_iterator = iterTransactionRows(options.infile)
+    with open(os.path.join(options.outdir, PAYLOAD_FILE_NAME), 'wb') as \
+            payload_file:
+        try:
+            count = export(row_iterator, writer, payload_file)
+        finally:
+            writer.close()
+    print >>sys.stderr, '%i rows exported' % (count, )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,493 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Simulated analyser, to exercise capture code without hardware.
+
+Implements the subset of usb1 context, device, handle and transfer API used
+by capture code. The simulated analyser accepts firmware upload commands
+(content is ignored), answers status requests, and streams an existing
+capture file on endpoint 0x82 once FPGA is configured.
+
+Capture data is produced at a fixed rate (or as fast as transfers are
+submitted when rate is 0) into a FIFO of FIFO_SIZE bytes. When host does not
+fetch data fast enough the FIFO overflows and capture stops, just like on
+real hardware. Each transfer completion can be delayed by a random amount, to
+simulate host-side scheduling jitter.
+"""
+from operator import itemgetter
+import random
+import time
+from struct import pack
+import usb1
+from iti1480a.compressed import openCapture
+from iti1480a.parser import TYPE_EVENT, TYPE_SHIFT, EVENT_CAPTURE_PAUSED, \
+    EVENT_CAPTURE_RESUMED, EVENT_CAPTURE_STOPPED_FIFO, \
+    EVENT_CAPTURE_STOPPED_USER
+
+# XXX: actual analyser buffer size is not documented.
+FIFO_SIZE = 8 * 1024 * 1024
+# Longest handleEvents wait when no event is expected, in seconds, so
+# signals get processed.
+MAX_WAIT = 0.1
+
+COMMAND_FPGA = 0
+COMMAND_FPGA_CONFIGURE_START = 0
+COMMAND_FPGA_CONFIGURE_WRITE = 1
+COMMAND_FPGA_CONFIGURE_STOP = 2
+COMMAND_STOP = 1
+COMMAND_STATUS = 2
+COMMAND_PAUSE = 3
+COMMAND_PAUSE_CONTINUE = 0
+COMMAND_PAUSE_PAUSE = 1
+
+STATUS_UNCONFIGURED = 0xff
+STATUS_CONFIGURED = 0x00
+
+def _getEventPacket(event):
+    return pack('<H', ((TYPE_EVENT << TYPE_SHIFT | 1) << 8) | event)
+
+class FakeAnalyzer(object):
+    """
+    Simulated analyser state and capture data production.
+    """
+    def __init__(self, source, rate=0, jitter=0, fifo_size=FIFO_SIZE):
+        """
+        source (file-ish object)
+            Raw capture data to stream.
+        rate (float)
+            Capture data production rate, in bytes per second. 0 to produce
+            data as fast as host fetches it.
+        jitter (float)
+            Maximum random delay added to each transfer completion, in
+            seconds.
+        fifo_size (int)
+            Amount of produced data which can wait for host to fetch it
+            before capture stops.
+        """
+        self._read = source.read
+        self._rate = rate
+        self._jitter = jitter
+        self._fifo_size = fifo_size
+        self._configured = False
+        self._paused = False
+        # Time spent producing data, excluding current production period.
+        self._active = 0
+        self._active_since = None
+        # Amount of source data sent to host.
+        self._sent = 0
+        # Event packets to insert in data stream, as 2-tuples of source data
+        # offset and packet.
+        self._event_list = []
+        # Source data offset at which capture stops.
+        self._stop_offset = None
+        self._stop_entry = None
+        self._stopped = False
+        self._reply = ''
+        self._pending_list = []
+        self._delayed_list = []
+        self._last_due = 0
+
+    def _getProduced(self, now):
+        if not self._rate:
+            return None
+        active = self._active
+        if self._active_since is not None:
+            active += now - self._active_since
+        return int(active * self._rate) & ~1
+
+    def _getAvailable(self, now):
+        """
+        Amount of source data host may receive now, None if unlimited.
+        """
+        produced = self._getProduced(now)
+        if produced is None:
+            # Unlimited, unless paused.
+            result = None if self._active_since is not None else 0
+        else:
+            result = produced - self._sent
+            if self._stop_offset is None and result > self._fifo_size:
+                self._stop(self._sent + self._fifo_size,
+                    EVENT_CAPTURE_STOPPED_FIFO)
+        if self._stop_offset is not None:
+            limit = self._stop_offset - self._sent
+            if result is None or result > limit:
+                result = limit
+        return result
+
+    def _getCurrentOffset(self):
+        produced = self._getProduced(time.time())
+        if produced is None:
+            return self._sent
+        return min(produced, self._sent + self._fifo_size)
+
+    def _stop(self, offset, event):
+        self._stop_offset = offset
+        self._stop_entry = (offset, _getEventPacket(event))
+        self._addEvent(self._stop_entry)
+
+    def _addEvent(self, entry):
+        event_list = self._event_list
+        event_list.append(entry)
+        # Stable: events at the same offset keep their order.
+        event_list.sort(key=itemgetter(0))
+
+    def command(self, command, sub_command, data):
+        now = time.time()
+        if command == COMMAND_FPGA:
+            if sub_command == COMMAND_FPGA_CONFIGURE_START:
+                self._configured = False
+            elif sub_command == COMMAND_FPGA_CONFIGURE_STOP:
+                self._configured = True
+                self._active_since = now
+        elif command == COMMAND_STATUS:
+            self._reply = chr(
+                STATUS_CONFIGURED if self._configured else STATUS_UNCONFIGURED
+            )
+        elif command == COMMAND_STOP:
+            if self._stop_offset is None:
+                self._stop(self._getCurrentOffset(),
+                    EVENT_CAPTURE_STOPPED_USER)
+        elif command == COMMAND_PAUSE:
+            if sub_command == COMMAND_PAUSE_PAUSE and not self._paused:
+                self._addEvent((self._getCurrentOffset(),
+                    _getEventPacket(EVENT_CAPTURE_PAUSED)))
+                if self._active_since is not None:
+                    self._active += now - self._active_since
+                    self._active_since = None
+                self._paused = True
+            elif sub_command == COMMAND_PAUSE_CONTINUE and self._paused:
+                self._addEvent((self._getCurrentOffset(),
+                    _getEventPacket(EVENT_CAPTURE_RESUMED)))
+                if self._configured:
+                    self._active_since = now
+                self._paused = False
+
+    def read(self, length):
+        """
+        Return the reply to last command.
+        """
+        return self._reply[:length]
+
+    def submit(self, transfer):
+        self._pending_list.append(transfer)
+
+    def cancel(self, transfer):
+        if transfer in self._pending_list:
+            self._pending_list.remove(transfer)
+            self._delayed_list.insert(0, (0, transfer, None))
+
+    def _fill(self, now, length):
+        """
+        Return data for a capture transfer of given length, or None if
+        transfer cannot complete yet.
+        """
+        if self._stopped:
+            return self._stop_entry[1]
+        if not self._configured:
+            return None
+        available = self._getAvailable(now)
+        event_list = self._event_list
+        if event_list:
+            until_event = event_list[0][0] - self._sent
+            if available is None or available > until_event:
+                available = until_event
+            # Leave room for event packet.
+            length -= 2
+        elif available is not None and available < length:
+            # Wait for a full transfer worth of data.
+            return None
+        if available is not None:
+            length = min(length, available)
+        data = self._read(length)
+        self._sent += len(data)
+        if len(data) < length and self._stop_offset is None:
+            # End of source data.
+            self._stop(self._sent, EVENT_CAPTURE_STOPPED_USER)
+        if event_list and event_list[0][0] == self._sent:
+            entry = event_list.pop(0)
+            data += entry[1]
+            if entry is self._stop_entry:
+                self._stopped = True
+        return data or None
+
+    def poll(self, now):
+        """
+        Complete due transfers.
+        Returns a 2-tuple: number of completed transfers, and delay before
+        next expected completion (None if unknown).
+        """
+        pending_list = self._pending_list
+        delayed_list = self._delayed_list
+        while pending_list:
+            transfer = pending_list[0]
+            if transfer.endpoint & 0x80:
+                data = self._fill(now, transfer.length)
+                if data is None:
+                    break
+            else:
+                data = transfer.execute(self)
+            pending_list.pop(0)
+            # Bulk transfers complete in submission order.
+            self._last_due = due = max(
+                self._last_due,
+                now + random.uniform(0, self._jitter),
+            )
+            delayed_list.append((due, transfer, data))
+        completed = 0
+        while delayed_list and delayed_list[0][0] <= now:
+            _, transfer, data = delayed_list.pop(0)
+            transfer.complete(data)
+            completed += 1
+        if delayed_list:
+            delay = delayed_list[0][0] - now
+        elif pending_list and self._rate and self._configured and \
+                not self._paused:
+            delay = float(pending_list[0].length) / self._rate
+        else:
+            delay = None
+        return completed, delay
+
+class FakeUSBTransfer(object):
+    """
+    Mimics usb1.USBTransfer.
+    """
+    def __init__(self, analyzer):
+        self._analyzer = analyzer
+        self._submitted = False
+        self._callback = None
+        self._user_data = None
+        self._status = usb1.TRANSFER_COMPLETED
+        self._buffer = ''
+        self.endpoint = None
+        self.length = 0
+        self._setup = None
+
+    def setBulk(self, endpoint, buffer_or_len, callback=None, user_data=None,
+            timeout=0):
+        self._set(endpoint, buffer_or_len, callback, user_data)
+        self._setup = None
+
+    def setControl(self, request_type, request, value, index, buffer_or_len,
+            callback=None, user_data=None, timeout=0):
+        self._set(request_type & 0x80, buffer_or_len, callback, user_data)
+        self._setup = value
+
+    def _set(self, endpoint, buffer_or_len, callback, user_data):
+        if self._submitted:
+            raise ValueError('Cannot alter a submitted transfer')
+        self.endpoint = endpoint
+        if isinstance(buffer_or_len, (int, long)):
+            self.length = buffer_or_len
+            self._buffer = ''
+        else:
+            self.length = len(buffer_or_len)
+            self._buffer = buffer_or_len
+        self._callback = callback
+        self._user_data = user_data
+
+    def execute(self, analyzer):
+        """
+        Execute OUT transfer command on given analyser.
+        """
+        if self._setup is None:
+            _executeBulkCommand(analyzer, self._buffer)
+        else:
+            analyzer.command(self._setup >> 8, self._setup & 0xff,
+                self._buffer)
+        return self._buffer
+
+    def complete(self, data):
+        self._submitted = False
+        if data is None:
+            self._status = usb1.TRANSFER_CANCELLED
+            self._buffer = ''
+        else:
+            self._status = usb1.TRANSFER_COMPLETED
+            self._buffer = data
+        if self._callback is not None:
+            self._callback(self)
+
+    def submit(self):
+        if self._submitted:
+            raise ValueError('Cannot submit a submitted transfer')
+        self._submitted = True
+        self._analyzer.submit(self)
+
+    def cancel(self):
+        self._analyzer.cancel(self)
+
+    def isSubmitted(self):
+        return self._submitted
+
+    def getStatus(self):
+        return self._status
+
+    def getActualLength(self):
+        return len(self._buffer)
+
+    def getBuffer(self):
+        return self._buffer
+
+    def getUserData(self):
+        return self._user_data
+
+    def getEndpoint(self):
+        return self.endpoint
+
+    def close(self):
+        if self._submitted:
+            raise ValueError('Cannot close a submitted transfer')
+
+def _executeBulkCommand(analyzer, data):
+    # Standard-compatible command format: command, sub-command, data padded
+    # to 61 bytes, data length.
+    analyzer.command(ord(data[0]), ord(data[1]), data[2:2 + ord(data[63])])
+
+class FakeUSBConfiguration(object):
+    def __init__(self, descriptor):
+        self._descriptor = descriptor
+
+    def getDescriptor(self):
+        return self._descriptor
+
+class FakeUSBDevice(object):
+    """
+    Mimics usb1.USBDevice.
+    """
+    def __init__(self, context, compliant):
+        self._context = context
+        self._compliant = compliant
+
+    def __getitem__(self, index):
+        if index:
+            raise IndexError(index)
+        # String descriptor 1 names the standard-compliant configuration.
+        return FakeUSBConfiguration(1 if self._compliant else 0)
+
+    def getBusNumber(self):
+        return 0
+
+    def getDeviceAddress(self):
+        return 0
+
+    def getVendorID(self):
+        return self._context.vendor_id
+
+    def getProductID(self):
+        return self._context.device_id
+
+    def open(self):
+        return FakeUSBDeviceHandle(self, self._context.analyzer)
+
+class FakeUSBDeviceHandle(object):
+    """
+    Mimics usb1.USBDeviceHandle.
+    """
+    def __init__(self, device, analyzer):
+        self._device = device
+        self._analyzer = analyzer
+
+    def getDevice(self):
+        return self._device
+
+    def getASCIIStringDescriptor(self, descriptor):
+        if descriptor == 1:
+            return 'Standard-Compliant'
+        return None
+
+    def claimInterface(self, interface):
+        pass
+
+    def releaseInterface(self, interface):
+        pass
+
+    def getTransfer(self, iso_packets=0):
+        return FakeUSBTransfer(self._analyzer)
+
+    def bulkWrite(self, endpoint, data, timeout=0):
+        _executeBulkCommand(self._analyzer, data)
+        return len(data)
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        if endpoint == 1:
+            return self._analyzer.read(length)
+        # Data FIFO is always empty before capture starts.
+        raise usb1.USBErrorTimeout()
+
+    def controlWrite(self, request_type, request, value, index, data,
+            timeout=0):
+        self._analyzer.command(value >> 8, value & 0xff, data)
+        return len(data)
+
+    def controlRead(self, request_type, request, value, index, length,
+            timeout=0):
+        self._analyzer.command(value >> 8, value & 0xff, '')
+        return self._analyzer.read(length)
+
+class FakeUSBContext(object):
+    """
+    Mimics usb1.USBContext, with a single simulated analyser.
+    """
+    def __init__(self, path, vendor_id, device_id, rate=0, jitter=0,
+            compliant=False, fifo_size=FIFO_SIZE):
+        """
+        path (string)
+            Capture file the simulated analyser streams.
+        vendor_id, device_id (int)
+            Simulated analyser USB identifiers.
+        compliant (bool)
+            Whether simulated analyser runs Free Software firmware.
+        See FakeAnalyzer for other arguments.
+        """
+        self.vendor_id = vendor_id
+        self.device_id = device_id
+        self._source = openCapture(path)
+        self.analyzer = FakeAnalyzer(
+            self._source,
+            rate=rate,
+            jitter=jitter,
+            fifo_size=fifo_size,
+        )
+        self._device = FakeUSBDevice(self, compliant)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._source.close()
+
+    def getDeviceList(self, skip_on_access_error=False,
+            skip_on_error=False):
+        return [self._device]
+
+    def openByVendorIDAndProductID(self, vendor_id, product_id,
+            skip_on_access_error=False, skip_on_error=False):
+        if vendor_id == self.vendor_id and product_id == self.device_id:
+            return self._device.open()
+        return None
+
+    def handleEvents(self):
+        """
+        Complete due transfers, waiting for one to be due if needed.
+        """
+        poll = self.analyzer.poll
+        completed, delay = poll(time.time())
+        if not completed:
+            time.sleep(MAX_WAIT if delay is None else min(delay, MAX_WAIT))
+            poll(time.time())
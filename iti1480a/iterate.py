@@ -0,0 +1,164 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Generator API over captures, for scripts which do not want to implement
+aggregators.
+
+Capture data is read in large blocks and pushed to a decoding pipeline whose
+outputs are queued, then yielded before next block is read, so memory usage
+is bounded by what a block decodes to.
+
+Example:
+  from iti1480a.iterate import iterTransactions
+  from iti1480a.parser import MESSAGE_TRANSACTION, decode
+  for tic, message_type, data in iterTransactions('captured.usb'):
+      if message_type == MESSAGE_TRANSACTION:
+          print tic, [decode(x)['name'] for x in data]
+"""
+from collections import deque
+from iti1480a.parser import ReorderedStream, Packetiser, \
+    TransactionAggregator, PipeAggregator, Endpoint0TransferAggregator, \
+    BaseAggregator, NoopAggregator, ParsingDone, MESSAGE_PACKET
+from iti1480a.compressed import openCapture
+
+READ_SIZE = 1024 * 1024
+
+class _QueueAggregator(BaseAggregator):
+    """
+    Pipeline end, queueing (tic, message type, data) triplets.
+    """
+    def __init__(self, queue):
+        self._append = queue.append
+
+    def push(self, *args):
+        self._append(args)
+
+def _iterate(source, build, read_size, accept):
+    """
+    source (string, file)
+        Capture path or file-like object.
+    build (callable)
+        Receives a queue, returns pipeline head, whose outputs are appended
+        to the queue.
+    """
+    if hasattr(source, 'read'):
+        infile = source
+        close = lambda: None
+    else:
+        infile = openCapture(source)
+        close = infile.close
+    try:
+        queue = deque()
+        stream = build(queue)
+        push = stream.push
+        read = infile.read
+        popleft = queue.popleft
+        running = True
+        while running:
+            data = read(read_size)
+            if data:
+                try:
+                    push(data)
+                except ParsingDone:
+                    running = False
+            else:
+                running = False
+            if not running:
+                stream.stop()
+            while queue:
+                item = popleft()
+                if accept is None or accept(*item):
+                    yield item
+    finally:
+        close()
+
+def iterEvents(source, read_size=READ_SIZE, accept=None):
+    """
+    Yield capture events, as (tic, packet type, data) triplets.
+
+    source (string, file)
+        Capture path, or file-like object with a read method. Compressed
+        captures are only supported when given as a path.
+    read_size (int)
+        Amount of capture data read at a time.
+    accept (callable)
+        Receives each triplet as 3 parameters, returns whether it should be
+        yielded.
+    """
+    def build(queue):
+        return ReorderedStream(_QueueAggregator(queue))
+    return _iterate(source, build, read_size, accept)
+
+def iterPackets(source, read_size=READ_SIZE, accept=None, tic=0,
+        resync=False):
+    """
+    Yield USB packets and bus events, as (tic, message type, data) triplets.
+    Packets have MESSAGE_PACKET type, and data is a list of (tic, byte)
+    pairs.
+    tic (int), resync (bool)
+        When source does not start at capture beginning (ex: it starts at a
+        compressed capture frame), the tic count it starts at, and True.
+    See iterEvents for other parameters.
+    """
+    def build(queue):
+        append = queue.append
+        return ReorderedStream(Packetiser(
+            NoopAggregator(
+                lambda packet: append((packet[0][0], MESSAGE_PACKET, packet)),
+            ),
+            lambda *args: append(args),
+            resync=resync,
+        ), tic)
+    return _iterate(source, build, read_size, accept)
+
+def iterTransactions(source, read_size=READ_SIZE, accept=None):
+    """
+    Yield USB transactions and bus events, as (tic, message type, data)
+    triplets, as received by iti1480a-display.
+    See iterEvents for parameters.
+    """
+    def build(queue):
+        sink = _QueueAggregator(queue)
+        to_top = lambda *args: queue.append(args)
+        return ReorderedStream(Packetiser(
+            TransactionAggregator(sink, to_top),
+            to_top,
+        ))
+    return _iterate(source, build, read_size, accept)
+
+def iterTransfers(source, read_size=READ_SIZE, accept=None):
+    """
+    Yield endpoint 0 transfers, other endpoints transactions and bus events,
+    as (tic, message type, data) triplets.
+    Endpoint 0 transfers are only yielded once complete, so they may come
+    after later events.
+    See iterEvents for parameters.
+    """
+    def build(queue):
+        sink = _QueueAggregator(queue)
+        to_top = lambda *args: queue.append(args)
+        def newPipe(address, endpoint):
+            if endpoint == 0:
+                return Endpoint0TransferAggregator(sink, to_top)
+            return sink
+        return ReorderedStream(Packetiser(
+            TransactionAggregator(
+                PipeAggregator(sink, to_top, lambda address: sink, newPipe),
+                to_top,
+            ),
+            to_top,
+        ))
+    return _iterate(source, build, read_size, accept)
@@ -0,0 +1,205 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+End-to-end live latency tracing, from USB transfer completion in capture to
+decoding stages output.
+
+Capture records the host time each transfer was received in a clock log
+(see iti1480a.clock) with a 0 interval. While decoding, that log is read as
+it grows. Each chunk of capture data pushed to the decoding pipeline gets the
+time the transfer holding its first byte was received, and each stage
+records, once per chunk, how long after that time it produced output.
+
+As the pipeline is synchronous, a stage latency includes the time spent in
+all stages before it.
+"""
+from collections import deque
+import json
+import time
+from iti1480a.metrics import LatencyHistogram
+
+LATENCY_BUCKET_LIST = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5,
+)
+
+class ClockFollower(object):
+    """
+    Read a clock log while it is being written.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._partial = ''
+        self._record_list = deque()
+
+    def _readNew(self):
+        readline = self._stream.readline
+        append = self._record_list.append
+        while True:
+            line = readline()
+            if not line:
+                break
+            if not line.endswith('\n'):
+                # Writer is in the middle of this line.
+                self._partial += line
+                break
+            line = self._partial + line
+            self._partial = ''
+            now, offset = line.split()
+            append((float(now), int(offset)))
+
+    def getTime(self, offset):
+        """
+        Return the time at which the byte at given capture data offset was
+        received, or None if not known (yet).
+        Offsets must be requested in increasing order.
+        """
+        record_list = self._record_list
+        while True:
+            # Record offsets are data amounts received so far, so byte at
+            # offset belongs to first record whose offset is strictly larger.
+            while record_list and record_list[0][1] <= offset:
+                record_list.popleft()
+            if record_list:
+                return record_list[0][0]
+            before = len(record_list)
+            self._readNew()
+            if len(record_list) == before:
+                return None
+
+class _ProbeAggregator(object):
+    """
+    Aggregator proxy recording latency on push.
+    """
+    def __init__(self, record, aggregator):
+        self._record = record
+        self._push = aggregator.push
+        self.stop = aggregator.stop
+
+    def push(self, *args, **kw):
+        self._record()
+        return self._push(*args, **kw)
+
+class LatencyTracer(object):
+    """
+    Per-stage latency histograms.
+    """
+    def __init__(self, clock_follower, stage_list=(),
+            bucket_list=LATENCY_BUCKET_LIST):
+        """
+        clock_follower (ClockFollower)
+        stage_list (list of strings)
+            Stage names, in pipeline order, for reports. Stages not listed
+            are reported after these, in wrapping order.
+        bucket_list (tuple of floats)
+            Histogram bucket upper bounds, in seconds.
+        """
+        self._clock_follower = clock_follower
+        self._bucket_list = bucket_list
+        self._stage_list = []
+        self._histogram_dict = {}
+        self._max_dict = {}
+        self._stamp = None
+        self._pending = set()
+        for name in stage_list:
+            self._getRecorder(name)
+
+    def startChunk(self, offset):
+        """
+        Tell tracer a chunk starting at given capture data offset is about to
+        be pushed to the pipeline.
+        """
+        self._stamp = stamp = self._clock_follower.getTime(offset)
+        # Mutated in place, as recorders hold a reference to it.
+        pending = self._pending
+        pending.clear()
+        if stamp is not None:
+            pending.update(self._stage_list)
+
+    def _getRecorder(self, name):
+        if name not in self._histogram_dict:
+            self._stage_list.append(name)
+            self._histogram_dict[name] = LatencyHistogram(self._bucket_list)
+            self._max_dict[name] = 0
+        histogram = self._histogram_dict[name]
+        pending = self._pending
+        def record():
+            if name in pending:
+                pending.discard(name)
+                latency = time.time() - self._stamp
+                histogram.record(latency)
+                if latency > self._max_dict[name]:
+                    self._max_dict[name] = latency
+        return record
+
+    def wrap(self, name, push):
+        """
+        Return a wrapper for given callable, recording name stage latency.
+        """
+        record = self._getRecorder(name)
+        def wrapper(*args, **kw):
+            record()
+            return push(*args, **kw)
+        return wrapper
+
+    def wrapAggregator(self, name, aggregator):
+        """
+        Return a proxy for given aggregator, recording name stage latency.
+        """
+        return _ProbeAggregator(self._getRecorder(name), aggregator)
+
+    def asDict(self):
+        result = {}
+        for name in self._stage_list:
+            histogram = self._histogram_dict[name]
+            result[name] = {
+                'count': histogram.count,
+                'sum': histogram.total,
+                'max': self._max_dict[name],
+                'buckets': histogram.getCumulativeList(),
+            }
+        return result
+
+    def dump(self, stream):
+        """
+        Write per-stage latencies as JSON.
+        """
+        json.dump(self.asDict(), stream)
+        stream.write('\n')
+
+    def report(self, write):
+        """
+        Write a human-readable per-stage latency report.
+        """
+        bound_list = self._bucket_list
+        write('Latency (s)  ' + ' '.join(
+            '%7s' % ('<=%g' % (x, )) for x in bound_list
+        ) + '     >%g   count    mean     max\n' % (bound_list[-1], ))
+        for name in self._stage_list:
+            histogram = self._histogram_dict[name]
+            count = histogram.count
+            line = '%-12s ' % (name, )
+            previous = 0
+            for _, cumulated in histogram.getCumulativeList():
+                line += '%6.2f%% ' % (
+                    (cumulated - previous) * 100. / count if count else 0,
+                )
+                previous = cumulated
+            line += '%7i %7.4f %7.4f\n' % (
+                count,
+                histogram.total / count if count else 0,
+                self._max_dict[name],
+            )
+            write(line)
@@ -0,0 +1,231 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Per-stage decoding pipeline memory profiling, using tracemalloc. It is not
+part of Python 2.7: it is provided by pytracemalloc, which requires an
+interpreter built with its patch.
+
+Enabled by setting ITI1480A_MEMPROFILE environment variable to the interval,
+in seconds, between reports. When ITI1480A_MEMPROFILE_DUMP is also set, each
+report is also appended there as one JSON line.
+
+Stage (aggregator class) and pipe (per address and endpoint aggregator)
+methods are called through wrappers compiled with a per-stage (or per-pipe)
+file name, so every allocation traceback tells which stage and pipe were
+running when it happened. Each report gives, per stage and per pipe, the
+memory allocated there and still alive (retained), and the largest retained
+value seen so far (peak).
+Only memory allocated by Python code is visible: GUI tree items internals
+are not accounted for, only the Python objects holding them.
+
+When disabled, stage classes are left untouched, so there is no overhead.
+"""
+import json
+import os
+import sys
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    MEMPROFILE_INTERVAL = float(os.environ.get('ITI1480A_MEMPROFILE') or 0)
+except ValueError:
+    print >>sys.stderr, 'ITI1480A_MEMPROFILE: %r is not a number of ' \
+        'seconds, memory profiling disabled' % (
+            os.environ['ITI1480A_MEMPROFILE'],
+        )
+    MEMPROFILE_INTERVAL = 0
+MEMPROFILE_DUMP = os.environ.get('ITI1480A_MEMPROFILE_DUMP')
+# Stages can be deeply nested, and each nesting level takes 2 frames.
+TRACEBACK_DEPTH = 64
+
+MEMPROFILE = bool(MEMPROFILE_INTERVAL)
+if MEMPROFILE and tracemalloc is None:
+    print >>sys.stderr, 'ITI1480A_MEMPROFILE: tracemalloc is not ' \
+        'available (install pytracemalloc, with its patched interpreter), ' \
+        'memory profiling disabled'
+    MEMPROFILE = False
+
+_STAGE_PREFIX = '<stage '
+_PIPE_PREFIX = '<pipe '
+
+_METHOD_SOURCE = '''
+def wrapper(self, *args, **kw):
+    _check()
+    return _func(self, *args, **kw)
+'''
+_FUNCTION_SOURCE = '''
+def wrapper(*args, **kw):
+    _check()
+    return _func(*args, **kw)
+'''
+
+# Tag to largest retained size seen, per category.
+_peak_dict = {
+    'stages': {},
+    'pipes': {},
+}
+_next_report = [None]
+_stop_depth = [0]
+
+def _check():
+    if time.time() >= _next_report[0]:
+        report(sys.stderr.write)
+
+def _makeWrapper(tag, func, source=_METHOD_SOURCE):
+    namespace = {
+        '_func': func,
+        '_check': _check,
+    }
+    exec compile(source, tag, 'exec') in namespace
+    return namespace['wrapper']
+
+def _start():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEBACK_DEPTH)
+    if _next_report[0] is None:
+        _next_report[0] = time.time() + MEMPROFILE_INTERVAL
+
+def profileMemory(cls):
+    """
+    Tag allocations happening in given aggregator class, if memory
+    profiling is enabled.
+    Subclasses of a profiled class must not be profiled.
+    """
+    if MEMPROFILE:
+        _start()
+        tag = _STAGE_PREFIX + cls.__name__ + '>'
+        cls.push = _makeWrapper(tag, cls.push.im_func)
+        stop = cls.stop.im_func
+        def profiledStop(self):
+            _stop_depth[0] += 1
+            try:
+                return stop(self)
+            finally:
+                _stop_depth[0] -= 1
+                if not _stop_depth[0]:
+                    report(sys.stderr.write)
+        cls.stop = _makeWrapper(tag, profiledStop)
+
+def profilePipes(cls):
+    """
+    Tag allocations happening in each pipe created by given PipeAggregator
+    (sub)class, if memory profiling is enabled.
+    """
+    if MEMPROFILE:
+        _start()
+        getPipe = cls._getPipe.im_func
+        def _getPipe(self, address, endpoint):
+            result = getPipe(self, address, endpoint)
+            if not getattr(result, '_memprofile_tagged', False):
+                try:
+                    result.push = _makeWrapper(
+                        '%s%s.%s>' % (_PIPE_PREFIX, address, endpoint),
+                        result.push,
+                        _FUNCTION_SOURCE,
+                    )
+                    result._memprofile_tagged = True
+                except AttributeError:
+                    # Cannot tag this one, allocations will be reported as
+                    # not in any pipe.
+                    pass
+            return result
+        cls._getPipe = _getPipe
+
+def _getInnermostTag(traceback, prefix):
+    # Traceback is sorted from the most recent frame.
+    for frame in traceback:
+        if frame.filename.startswith(prefix):
+            return frame.filename[len(prefix):-1]
+    return None
+
+def asDict():
+    """
+    Take a snapshot and return per-stage and per-pipe retained and peak
+    allocations, in bytes.
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    retained_dict = {
+        'stages': {},
+        'pipes': {},
+    }
+    for statistic in snapshot.statistics('traceback'):
+        for category, prefix in (
+                    ('stages', _STAGE_PREFIX),
+                    ('pipes', _PIPE_PREFIX),
+                ):
+            tag = _getInnermostTag(statistic.traceback, prefix)
+            if tag is not None:
+                category_dict = retained_dict[category]
+                size, count = category_dict.get(tag, (0, 0))
+                category_dict[tag] = (
+                    size + statistic.size,
+                    count + statistic.count,
+                )
+    result = {
+        'time': time.time(),
+        'current': current,
+        'peak': peak,
+    }
+    for category, category_dict in retained_dict.iteritems():
+        peak_dict = _peak_dict[category]
+        category_result = result[category] = {}
+        for tag in set(category_dict).union(peak_dict):
+            size, count = category_dict.get(tag, (0, 0))
+            peak_dict[tag] = max(peak_dict.get(tag, 0), size)
+            category_result[tag] = {
+                'retained': size,
+                'blocks': count,
+                'peak': peak_dict[tag],
+            }
+    return result
+
+def report(write):
+    """
+    Write a human-readable memory usage summary, and append it to
+    ITI1480A_MEMPROFILE_DUMP if set.
+    """
+    _next_report[0] = time.time() + MEMPROFILE_INTERVAL
+    result = asDict()
+    write('Traced memory: %i bytes (peak: %i bytes)\n' % (
+        result['current'],
+        result['peak'],
+    ))
+    for category, title in (('stages', 'Stage'), ('pipes', 'Pipe')):
+        category_result = result[category]
+        if not category_result:
+            continue
+        write('%-30s %14s %10s %14s\n' % (
+            title, 'Retained (B)', 'Blocks', 'Peak (B)',
+        ))
+        for tag, entry in sorted(
+                    category_result.iteritems(),
+                    key=lambda x: x[1]['retained'],
+                    reverse=True,
+                ):
+            write('%-30s %14i %10i %14i\n' % (
+                tag,
+                entry['retained'],
+                entry['blocks'],
+                entry['peak'],
+            ))
+    if MEMPROFILE_DUMP:
+        with open(MEMPROFILE_DUMP, 'a') as dump:
+            json.dump(result, dump, sort_keys=True)
+            dump.write('\n')
@@ -0,0 +1,253 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Capture health metrics, to tell whether host keeps up with the analyser.
+
+Metrics are periodically exported either as JSON lines (one object per
+capture per export) or as a Prometheus textfile (for node_exporter's textfile
+collector).
+"""
+from bisect import bisect_left
+import json
+import os
+import time
+
+# Histogram bucket upper bounds, in seconds.
+LATENCY_BUCKET_LIST = (
+    0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+)
+
+FORMAT_JSON = 'json'
+FORMAT_PROMETHEUS = 'prometheus'
+FORMAT_LIST = (FORMAT_JSON, FORMAT_PROMETHEUS)
+
+# Default delay between exports, in seconds.
+EXPORT_INTERVAL = 5
+
+class LatencyHistogram(object):
+    """
+    Fixed-bucket duration histogram.
+    """
+    def __init__(self, bucket_list=LATENCY_BUCKET_LIST):
+        self._bucket_list = bucket_list
+        # Last bucket is for values above all bounds.
+        self._count_list = [0] * (len(bucket_list) + 1)
+        self.count = 0
+        self.total = 0
+
+    def record(self, duration):
+        self._count_list[bisect_left(self._bucket_list, duration)] += 1
+        self.count += 1
+        self.total += duration
+
+    def getCumulativeList(self):
+        """
+        Return a list of 2-tuples: bucket upper bound (None for infinity)
+        and number of values less than or equal to it.
+        """
+        result = []
+        cumulated = 0
+        for bound, count in zip(
+                    self._bucket_list + (None, ),
+                    self._count_list,
+                ):
+            cumulated += count
+            result.append((bound, cumulated))
+        return result
+
+class CaptureMetrics(object):
+    """
+    Metrics for one analyser capture.
+    """
+    def __init__(self, name, reader_list=()):
+        """
+        name (string)
+            Identifies capture in exported metrics.
+        reader_list (list of usb1.USBTransfer)
+            Capture data transfers, to count the ones in flight.
+        """
+        self.name = name
+        self.reader_list = reader_list
+        self.start = self._last_time = time.time()
+        self._last_size = 0
+        self.capture_size = 0
+        self.transfer_count = 0
+        self.callback_latency = LatencyHistogram()
+        self.write_latency = LatencyHistogram()
+        self.throughput = 0
+        self.fifo_stopped = False
+        self.fifo_stop_throughput = None
+
+    def wrapWrite(self, write):
+        """
+        Return a wrapper for given write function, recording its latency.
+        """
+        record = self.write_latency.record
+        def measuredWrite(data):
+            start = time.time()
+            try:
+                return write(data)
+            finally:
+                record(time.time() - start)
+        return measuredWrite
+
+    def recordTransfer(self, size, duration):
+        """
+        Record a completed transfer, and the time spent processing it.
+        """
+        self.capture_size += size
+        self.transfer_count += 1
+        self.callback_latency.record(duration)
+
+    def captureStopped(self, fifo):
+        """
+        Record capture end. When fifo is true, analyser stopped because its
+        FIFO overflowed: host did not fetch data fast enough.
+        """
+        if fifo and not self.fifo_stopped:
+            self.fifo_stopped = True
+            self.fifo_stop_throughput = self._updateThroughput()
+
+    def _updateThroughput(self):
+        now = time.time()
+        elapsed = now - self._last_time
+        if elapsed > 0:
+            self.throughput = (self.capture_size - self._last_size) / elapsed
+            self._last_time = now
+            self._last_size = self.capture_size
+        return self.throughput
+
+    def getInFlightCount(self):
+        return sum(1 for x in self.reader_list if x.isSubmitted())
+
+    def asDict(self):
+        self._updateThroughput()
+        return {
+            'capture': self.name,
+            'time': time.time(),
+            'uptime': time.time() - self.start,
+            'bytes': self.capture_size,
+            'bytes_per_second': self.throughput,
+            'transfers': self.transfer_count,
+            'in_flight': self.getInFlightCount(),
+            'callback_latency': self.callback_latency.getCumulativeList(),
+            'callback_latency_sum': self.callback_latency.total,
+            'write_latency': self.write_latency.getCumulativeList(),
+            'write_latency_sum': self.write_latency.total,
+            'fifo_stopped': self.fifo_stopped,
+            'fifo_stop_bytes_per_second': self.fifo_stop_throughput,
+        }
+
+class MetricsExporter(object):
+    """
+    Periodically export metrics of all captures, plus event loop metrics.
+    """
+    def __init__(self, path, format=FORMAT_JSON, interval=EXPORT_INTERVAL):
+        if format not in FORMAT_LIST:
+            raise ValueError('Unknown format %r' % (format, ))
+        self._path = path
+        self._format = format
+        self._interval = interval
+        self._next = time.time() + interval
+        self.capture_list = []
+        self.handle_events_time = 0
+        self.handle_events_count = 0
+
+    def recordHandleEvents(self, duration):
+        """
+        Record time spent in one libusb event handling call.
+        """
+        self.handle_events_time += duration
+        self.handle_events_count += 1
+
+    def maybeExport(self):
+        """
+        Export metrics if export interval elapsed.
+        """
+        now = time.time()
+        if now >= self._next:
+            self._next = now + self._interval
+            self.export()
+
+    def export(self):
+        if self._format == FORMAT_JSON:
+            self._exportJSON()
+        else:
+            self._exportPrometheus()
+
+    def _exportJSON(self):
+        with open(self._path, 'a') as out:
+            for capture in self.capture_list:
+                entry = capture.asDict()
+                entry['handle_events_seconds'] = self.handle_events_time
+                entry['handle_events_count'] = self.handle_events_count
+                out.write(json.dumps(entry) + '\n')
+
+    def _exportPrometheus(self):
+        line_list = [
+            '# TYPE iti1480a_handle_events_seconds_total counter',
+            'iti1480a_handle_events_seconds_total %f' % (
+                self.handle_events_time,
+            ),
+            '# TYPE iti1480a_handle_events_total counter',
+            'iti1480a_handle_events_total %i' % (self.handle_events_count, ),
+        ]
+        append = line_list.append
+        entry_list = [x.asDict() for x in self.capture_list]
+        for metric, metric_type, key in (
+                    ('capture_bytes_total', 'counter', 'bytes'),
+                    ('capture_bytes_per_second', 'gauge', 'bytes_per_second'),
+                    ('capture_transfers_total', 'counter', 'transfers'),
+                    ('capture_transfers_in_flight', 'gauge', 'in_flight'),
+                    ('capture_fifo_stopped', 'gauge', 'fifo_stopped'),
+                    ('capture_fifo_stop_bytes_per_second', 'gauge',
+                        'fifo_stop_bytes_per_second'),
+                    ('capture_callback_latency_seconds', 'histogram',
+                        'callback_latency'),
+                    ('capture_write_latency_seconds', 'histogram',
+                        'write_latency'),
+                ):
+            append('# TYPE iti1480a_%s %s' % (metric, metric_type))
+            for entry in entry_list:
+                label = 'capture="%s"' % (
+                    entry['capture'].replace('\\', '\\\\').replace('"', '\\"'),
+                )
+                value = entry[key]
+                if metric_type == 'histogram':
+                    for bound, count in value:
+                        append('iti1480a_%s_bucket{%s,le="%s"} %i' % (
+                            metric,
+                            label,
+                            '+Inf' if bound is None else repr(bound),
+                            count,
+                        ))
+                    append('iti1480a_%s_sum{%s} %f' % (
+                        metric,
+                        label,
+                        entry[key + '_sum'],
+                    ))
+                    append('iti1480a_%s_count{%s} %i' % (
+                        metric,
+                        label,
+                        value[-1][1],
+                    ))
+                elif value is not None:
+                    append('iti1480a_%s{%s} %s' % (metric, label, float(value)))
+        # Textfile collector may read at any time: replace file atomically.
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as out:
+            out.write('\n'.join(line_list) + '\n')
+        os.rename(temp_path, self._path)
@@ -14,6 +14,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import os
+import re
 from struct import unpack
 from cStringIO import StringIO
 from ply.yacc import yacc
@@ -25,6 +26,8 @@ import platform
 
 # Monkey-patch for ply.yacc defining startPush and push methods.
 from . import incremental_yacc
+from .stageprofile import profileStage
+from .memprofile import profileMemory, profilePipes
 
 _DEBUG = bool(os.environ.get('ITI1480A_DEBUG'))
 PYPY = platform.python_implementation() == 'PyPy'
@@ -183,6 +186,9 @@ LENGTH_SHIFT = 4
 LENGTH_MASK = 0x3
 # Number of tics contained in first packet byte
 TIC_HEAD_MASK = 0xf
+# Consecutive well-formed packets needed to consider decoding is aligned on
+# packet boundaries, when starting at an arbitrary point in a capture.
+RESYNC_PACKET_COUNT = 64
 
 TIME_INITIAL_MULTIPLIER = 100.0 / 6 # 16.666...
 
@@ -221,6 +227,29 @@ def short_tic_to_time(tic):
         return '%i ms, %i us' % (mili, micro)
     return '%i us, %i ns' % (micro, nano)
 
+_TIME_MATCH = re.compile(
+    r'^(?:(\d+):)?(\d+)(?:\.(\d+))?(?:\'(\d+))?(?:"(\d+)n?)?$'
+).match
+
+def time_to_tic(value):
+    """
+    Convert a time, either in tic_to_time notation (leading fields may be
+    omitted, trailing fields may be omitted starting from micro-seconds: ex
+    "01:23.456", "23.456'789") or in seconds (ex: "83.4567"), into a tic
+    count.
+    Raises ValueError on invalid values.
+    """
+    match = _TIME_MATCH(value.strip())
+    if match is None:
+        raise ValueError('Invalid time: %r' % (value, ))
+    minute, second, fraction, micro, nano = match.groups()
+    if (micro or nano) and len(fraction or '') != 3:
+        raise ValueError('Invalid time: %r' % (value, ))
+    nanosecond = (int(minute or 0) * 60 + int(second)) * 1000000000 + \
+        int((fraction or '').ljust(9, '0')[:9]) + \
+        int(micro or 0) * 1000 + int(nano or 0)
+    return int(nanosecond / TIME_INITIAL_MULTIPLIER)
+
 TIC_TO_MICROSECOND = TIME_INITIAL_MULTIPLIER / 1000
 
 def tic_to_us(tic):
@@ -282,26 +311,33 @@ CRC16_POLYNOMIAL = 0b1000000000000101
 CRC16_RESIDUAL   = 0b1000000000001101
 _CRC16_POLYNOMIAL = _swap16(CRC16_POLYNOMIAL)
 
+# Remainder after shifting a whole byte in, for each remainder & byte xor
+# value, so CRCs are computed one byte at a time.
+def _getCRCTable(polynomial):
+    result = []
+    for value in xrange(256):
+        for _ in xrange(8):
+            xor_poly = value & 1
+            value >>= 1
+            if xor_poly:
+                value ^= polynomial
+        result.append(value)
+    return result
+_CRC5_TABLE = _getCRCTable(_CRC5_POLYNOMIAL)
+_CRC16_TABLE = _getCRCTable(_CRC16_POLYNOMIAL)
+
 def crc5(data):
     remainder = 0x1f
     for _, byte in data:
-        for _ in xrange(8):
-            xor_poly = (byte ^ remainder) & 1
-            remainder >>= 1
-            byte >>= 1
-            if xor_poly:
-                remainder ^= _CRC5_POLYNOMIAL
+        # Remainder fits in a byte, so nothing is left after shifting.
+        remainder = _CRC5_TABLE[byte ^ remainder]
     return _swap5(remainder)
 
 def crc16(data):
     remainder = 0xffff
+    table = _CRC16_TABLE
     for _, byte in data:
-        for _ in xrange(8):
-            xor_poly = (byte ^ remainder) & 1
-            remainder >>= 1
-            byte >>= 1
-            if xor_poly:
-                remainder ^= _CRC16_POLYNOMIAL
+        remainder = (remainder >> 8) ^ table[(byte ^ remainder) & 0xff]
     return _swap16(remainder)
 
 # Standard USB PIDs.
@@ -415,6 +451,8 @@ MESSAGE_LS_EOP = 6
 MESSAGE_FS_EOP = 7
 MESSAGE_INCOMPLETE = 8
 MESSAGE_FS_TO_CHIRP = 9
+# Not produced by aggregators, for Packetiser output outside of pipelines.
+MESSAGE_PACKET = 10
 
 TOKEN_TYPE_OUT = 'OUT'
 TOKEN_TYPE_ACK = 'ACK'
@@ -997,8 +1035,9 @@ class Packetiser(BaseAggregator):
     _high_speed_device = False # Device operating speed
     _full_speed_device = False # Device connected as FS
     _reset_start_high_speed = False
+    _resync = False
 
-    def __init__(self, to_next, to_top, verbose=False):
+    def __init__(self, to_next, to_top, verbose=False, resync=False):
         """
         to_next (BaseAggregator)
             "push" is called with a list of 2-tuples:
@@ -1010,6 +1049,9 @@ class Packetiser(BaseAggregator):
             - event type (MESSAGE_RAW, MESSAGE_RESET)
             - event
         verbose (bool)
+        resync (bool)
+            Whether data starts at an arbitrary point in a capture, so data
+            bytes must be ignored until next RxCmd.
         """
         self._type_dict = {
             TYPE_EVENT: self._event,
@@ -1021,6 +1063,7 @@ class Packetiser(BaseAggregator):
         self._data_list = []
         self._reset_queue = []
         self._verbose = verbose
+        self._resync = resync
 
     def _to_top(self, *args, **kw):
         if self._reset_start_tic is None:
@@ -1071,6 +1114,22 @@ class Packetiser(BaseAggregator):
             self._reset_start_tic = None
         self._type_dict[packet_type](tic, data)
 
+    def resync(self):
+        """
+        Data pushed from now on does not follow data pushed so far (ex: some
+        was lost): drop any incomplete packet, and ignore data bytes until
+        next RxCmd.
+        """
+        self._data_list = []
+        self._rxactive = False
+        self._resync = True
+        if self._reset_start_tic is not None:
+            # Reset end was lost, emit what it held back.
+            for args, kw in self._reset_queue:
+                self._real_to_top(*args, **kw)
+            del self._reset_queue[:]
+            self._reset_start_tic = None
+
     def stop(self):
         # TODO: flush any pending reset ? requires knowing last tic before
         # stop was called
@@ -1107,12 +1166,15 @@ class Packetiser(BaseAggregator):
             raise ParsingDone
 
     def _data(self, tic, data):
+        if self._resync:
+            return
         assert self._rxactive
         self._data_list.append((tic, data))
 
     def _rxcmd(self, tic, data):
         # TODO:
         # - RxError
+        self._resync = False
         rxactive = data & RXCMD_RX_ACTIVE
         if self._rxactive and not rxactive and self._data_list:
             self._to_next.push(self._data_list)
@@ -1142,27 +1204,69 @@ class ReorderedStream(BaseAggregator):
     """
     Transfor a serie of data chunks in .usb file order into tic count, type
     and data values.
-    Incomplete chunk tail is preserved to be decoded with next data block.
+    Incomplete chunk tail is preserved to be decoded with next data block,
+    so chunks may be of any length.
     """
-    def __init__(self, out):
+    def __init__(self, out, tic=0, resync=False):
         """
         out (BaseAggregator)
             "push" receives 3 parameters:
             - tic count (arbitrarily long integer)
             - type (TYPE_EVENT, TYPE_DATA or TYPE_RXCMD)
             - data (1-byte integer)
+        tic (int)
+            Tic count at the beginning of the first chunk. Useful when
+            decoding starts in the middle of a capture.
+        resync (bool)
+            Whether first chunk may not start on a packet boundary (see
+            resync method).
         """
         self._remain = ()
+        # Odd trailing byte of last chunk.
+        self._odd = ''
         self._out = out
-        self._tic = 0
+        self._tic = tic
+        # Number of well-formed packets to decode before emitting any.
+        self._resync_count = RESYNC_PACKET_COUNT if resync else 0
+
+    def getTic(self):
+        """
+        Return the tic count reached at the end of data pushed so far.
+        """
+        return self._tic
+
+    def isAligned(self):
+        """
+        Whether data pushed so far ends on a packet boundary, ie no incomplete
+        chunk tail is pending.
+        """
+        return not self._remain and not self._odd
+
+    def resync(self):
+        """
+        Data pushed from now on does not follow data pushed so far (ex: some
+        was lost), and may not start on a packet boundary. It must start on
+        a 16-bits word boundary of the original stream.
+        As the format has no synchronisation marker, packets are decoded
+        without being emitted until RESYNC_PACKET_COUNT consecutive ones were
+        well-formed, decoding restarting one word later on malformed ones.
+        Tics elapsed in lost data are not accounted for.
+        """
+        self._remain = ()
+        self._odd = ''
+        self._resync_count = RESYNC_PACKET_COUNT
 
     def push(self, data):
         """
         data (string)
             File chunk to process.
         """
+        if self._odd:
+            data = self._odd + data
+            self._odd = ''
         if len(data) % 2:
-            raise ValueError('data len must be even')
+            self._odd = data[-1]
+            data = data[:-1]
         out = self._out.push
         tic = self._tic
         if LITTLE_ENDIAN and not PYPY:
@@ -1174,7 +1278,9 @@ class ReorderedStream(BaseAggregator):
                 unpack('<H', read(2))[0]
                 for x in xrange(0, len(data) - 1, 2)
             )
-        next_data = itertools.chain(self._remain, reader).next
+        resync_count = self._resync_count
+        iterator = itertools.chain(self._remain, reader)
+        next_data = iterator.next
         while True:
             try:
                 p1 = next_data()
@@ -1203,7 +1309,6 @@ class ReorderedStream(BaseAggregator):
                     payload = None
             else:
                 payload = p1 & 0xff
-            tic += tic_count
             if packet_type:
                 if payload is None:
                     try:
@@ -1216,12 +1321,36 @@ class ReorderedStream(BaseAggregator):
                         else:
                             raise ValueError(packet_len)
                         break
-                    assert payload & 0xff == 0, hex(payload)
+                    if payload & 0xff:
+                        assert resync_count, hex(payload)
+                        # Not on a packet boundary, retry one word later.
+                        iterator = itertools.chain(
+                            (p2, payload) if packet_len == 3 else (payload, ),
+                            iterator,
+                        )
+                        next_data = iterator.next
+                        resync_count = RESYNC_PACKET_COUNT
+                        continue
                     payload >>= 8
-                out(tic, packet_type, payload)
+                tic += tic_count
+                if resync_count:
+                    resync_count -= 1
+                else:
+                    out(tic, packet_type, payload)
+            elif payload != 0:
+                assert resync_count, payload
+                # Not on a packet boundary, retry one word later.
+                iterator = itertools.chain(
+                    (p2, ) if packet_len > 1 else (),
+                    iterator,
+                )
+                next_data = iterator.next
+                resync_count = RESYNC_PACKET_COUNT
+                continue
             else:
-                assert payload == 0
+                tic += tic_count
             self._tic = tic
+        self._resync_count = resync_count
 
     def stop(self):
         self._out.stop()
@@ -1231,3 +1360,37 @@ if _DEBUG:
     NOOP = lambda *args, **kw: None
     _Endpoint0TransferAggregator(NOOP, NOOP).stop()
     _TransactionAggregator(NOOP, NOOP).stop()
+
+# Per-stage profiling, enabled by ITI1480A_PROFILE environment variable.
+def _getYaccQueueSize(aggregator):
+    return len(aggregator._thread._parser.symstack)
+
+def _getReorderedStreamBufferSize(stream):
+    # In bytes, as there is no queue: only the start of an incomplete packet
+    # is kept for next push.
+    return len(stream._remain) * 2 + len(stream._odd)
+
+profileStage(ReorderedStream, _getReorderedStreamBufferSize)
+profileStage(
+    Packetiser,
+    lambda x: len(x._data_list) + len(x._reset_queue),
+)
+profileStage(TransactionAggregator, _getYaccQueueSize)
+profileStage(
+    PipeAggregator,
+    lambda x: len(x._hub_dict) + sum(len(y) for y in x._pipe_dict.itervalues()),
+)
+profileStage(Endpoint0TransferAggregator, _getYaccQueueSize)
+
+# Per-stage memory profiling, enabled by ITI1480A_MEMPROFILE environment
+# variable.
+for _stage in (
+            ReorderedStream,
+            Packetiser,
+            TransactionAggregator,
+            PipeAggregator,
+            Endpoint0TransferAggregator,
+        ):
+    profileMemory(_stage)
+del _stage
+profilePipes(PipeAggregator)
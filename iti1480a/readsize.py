@@ -0,0 +1,48 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Read size adapting to input backlog.
+
+Reading in large chunks amortises per-chunk costs, which matters when
+decoding falls behind, but decoding a large chunk delays output of its first
+events, which matters when following a live capture. So read size is
+doubled whenever a read fills it (more data is likely waiting), and halved
+whenever a read returns much less (input is keeping up with decoding).
+"""
+
+MIN_READ_SIZE = 4 * 1024
+MAX_READ_SIZE = 1024 * 1024
+
+class AdaptiveReadSize(object):
+    """
+    Read size, to update with the length of each read result.
+    """
+    def __init__(self, minimum=MIN_READ_SIZE, maximum=MAX_READ_SIZE):
+        self._minimum = minimum
+        self._maximum = maximum
+        self.size = minimum
+
+    def update(self, length):
+        """
+        Adapt read size to the length of data last read.
+        Returns new read size.
+        """
+        size = self.size
+        if length >= size:
+            self.size = size = min(size * 2, self._maximum)
+        elif length < size // 4:
+            self.size = size = max(size // 2, self._minimum)
+        return size
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Replay a capture with its original timing, to feed live consumers
+(iti1480a-display -f, GUI) as if an analyser was capturing.
+
+Each chunk is emitted once the time it covers has elapsed, according to the
+tic count decoded from capture data. Consumer lag is how long after that
+time a consumer got the data:
+- for stdout, how long writes were blocked because the reader did not empty
+  the pipe
+- for shared-memory ring consumers, how old the oldest data they did not
+  read yet is.
+"""
+from bisect import bisect_right
+import errno
+import os
+import sys
+import time
+from iti1480a.parser import ReorderedStream, NoopAggregator, \
+    TIME_INITIAL_MULTIPLIER
+from iti1480a.compressed import openCapture, CompressedReader, isCompressed, \
+    MAGIC
+from iti1480a.ring import RingWriter, RING_SIZE
+
+# Tic duration, in seconds.
+TIC_DURATION = TIME_INITIAL_MULTIPLIER / 1e9
+CHUNK_SIZE = 4096
+# Delay between lag reports, in seconds.
+REPORT_INTERVAL = 1
+
+class ConsumerLag(object):
+    """
+    Per-consumer lag statistics, in seconds.
+    """
+    def __init__(self):
+        self.last = 0
+        self.max = 0
+        self._total = 0
+        self._count = 0
+
+    def record(self, lag):
+        lag = max(lag, 0)
+        self.last = lag
+        self.max = max(self.max, lag)
+        self._total += lag
+        self._count += 1
+
+    def getAverage(self):
+        if not self._count:
+            return 0
+        return self._total / self._count
+
+def replay(read, write, speed=1, chunk_size=CHUNK_SIZE, ring=None,
+        report=None, report_interval=REPORT_INTERVAL):
+    """
+    Replay capture data.
+
+    read (callable)
+        Capture data source.
+    write (callable, None)
+        Where to write replayed data.
+    speed (float)
+        Replay speed, relative to original timing. 0 to replay as fast as
+        possible.
+    chunk_size (int)
+        Amount of data read at a time, which bounds timing accuracy.
+    ring (iti1480a.ring.RingWriter, None)
+        Also write replayed data to this ring, and report its consumer lag.
+    report (callable, None)
+        Called periodically with a dict of consumer name to ConsumerLag.
+    report_interval (float)
+        Delay between report calls, in seconds.
+
+    Returns final dict of consumer name to ConsumerLag.
+    """
+    tracker = ReorderedStream(NoopAggregator(lambda *args: None))
+    track = tracker.push
+    lag_dict = {}
+    if write is not None:
+        lag_dict['stdout'] = stdout_lag = ConsumerLag()
+    # End offset and due time of each emitted chunk, to tell how old
+    # ring consumer position is. Chunks older than ring capacity are dropped,
+    # as consumers cannot be further behind.
+    offset_list = []
+    due_list = []
+    offset = 0
+    start = time.time()
+    next_report = start + report_interval
+    while True:
+        data = read(chunk_size)
+        if not data:
+            break
+        track(data)
+        if speed:
+            due = start + tracker.getTic() * TIC_DURATION / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            due = time.time()
+        if write is not None:
+            write(data)
+            stdout_lag.record(time.time() - due)
+        if ring is not None:
+            ring.write(data)
+            offset += len(data)
+            offset_list.append(offset)
+            due_list.append(due)
+        now = time.time()
+        if ring is not None and now >= next_report:
+            drop = bisect_right(offset_list, offset - ring.getCapacity())
+            del offset_list[:drop]
+            del due_list[:drop]
+            _recordRingLag(ring, offset_list, due_list, lag_dict, now)
+        if report is not None and now >= next_report:
+            next_report = now + report_interval
+            report(lag_dict)
+    if ring is not None:
+        _recordRingLag(ring, offset_list, due_list, lag_dict, time.time())
+    return lag_dict
+
+def _recordRingLag(ring, offset_list, due_list, lag_dict, now):
+    # Nothing written yet, consumers cannot be behind.
+    head = offset_list[-1] if offset_list else 0
+    for pid, behind in ring.getConsumerList():
+        index = bisect_right(offset_list, head - behind)
+        if index < len(due_list):
+            lag = now - due_list[index]
+        else:
+            lag = 0
+        name = 'pid %i' % (pid, )
+        try:
+            consumer_lag = lag_dict[name]
+        except KeyError:
+            lag_dict[name] = consumer_lag = ConsumerLag()
+        consumer_lag.record(lag)
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option(
+        '-i', '--infile', default='-',
+        help='Capture to replay (default: stdin)',
+    )
+    parser.add_option(
+        '-o', '--outfile',
+        help='Data destination. Default: stdout, unless --ring is given. '
+        '"-" for stdout.',
+    )
+    parser.add_option(
+        '-r', '--ring',
+        help='Also write data to a shared-memory ring created at this path, '
+        'for iti1480a-display --ring',
+    )
+    parser.add_option(
+        '--ring-size', type='int', default=RING_SIZE,
+        help='Ring capacity, in bytes. Default: %default',
+    )
+    parser.add_option(
+        '-s', '--speed', type='float', default=1,
+        help='Replay speed relative to original timing (ex: 2, 10). 0 to '
+        'replay as fast as possible. Default: %default',
+    )
+    parser.add_option(
+        '--chunk-size', type='int', default=CHUNK_SIZE,
+        help='Amount of data emitted at a time. Default: %default',
+    )
+    parser.add_option(
+        '--report-interval', type='float', default=REPORT_INTERVAL,
+        help='Delay between consumer lag reports on stderr, in seconds. '
+        'Default: %default',
+    )
+    parser.add_option(
+        '-q', '--quiet', action='store_true',
+        help='Only report consumer lag at the end of replay',
+    )
+    (options, args) = parser.parse_args()
+    if options.infile == '-':
+        infile = sys.stdin
+        head = infile.read(len(MAGIC))
+        if isCompressed(head):
+            read = CompressedReader(infile, head).read
+        else:
+            pending_list = [head]
+            def read(size):
+                data = pending_list.pop() if pending_list else ''
+                return data + infile.read(size - len(data))
+    else:
+        try:
+            read = openCapture(options.infile).read
+        except IOError:
+            print >>sys.stderr, 'Could not open --infile %r' % (
+                options.infile,
+            )
+            sys.exit(1)
+    if options.outfile is None and options.ring is not None:
+        write = None
+    elif options.outfile in (None, '-'):
+        write = os.fdopen(sys.stdout.fileno(), 'w', 0).write
+    else:
+        try:
+            write = open(options.outfile, 'wb', 0).write
+        except IOError:
+            print >>sys.stderr, 'Could not open --outfile %r' % (
+                options.outfile,
+            )
+            sys.exit(1)
+    if options.ring is None:
+        ring = None
+    else:
+        ring = RingWriter(options.ring, options.ring_size)
+    def report(lag_dict):
+        for name, lag in sorted(lag_dict.iteritems()):
+            sys.stderr.write(
+                '%s: %.3fs behind (average %.3fs, max %.3fs)\n' % (
+                    name,
+                    lag.last,
+                    lag.getAverage(),
+                    lag.max,
+                ),
+            )
+    try:
+        lag_dict = replay(
+            read,
+            write,
+            speed=options.speed,
+            chunk_size=options.chunk_size,
+            ring=ring,
+            report=None if options.quiet else report,
+            report_interval=options.report_interval,
+        )
+    except IOError, exc:
+        # Consumer exited.
+        if exc.errno != errno.EPIPE:
+            raise
+    except KeyboardInterrupt:
+        pass
+    else:
+        sys.stderr.write('Replay done\n')
+        report(lag_dict)
+    finally:
+        if ring is not None:
+            ring.close()
+
+if __name__ == '__main__':
+    main()
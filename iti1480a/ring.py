@@ -0,0 +1,262 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Shared-memory ring buffer, to stream live capture data to several decoders.
+
+The ring is a file (ideally on a tmpfs, like /dev/shm) mapped in memory by the
+writer and all readers. The writer never waits for readers: a reader which
+falls behind by more than the ring capacity loses data (see RingOverrun).
+
+File structure:
+  Header (HEADER_SIZE bytes):
+    MAGIC
+    capacity (uint64)
+    head: total number of bytes ever written (uint64)
+    closed: non-zero once writer is done (uint64)
+    reserved: what head will be once current write is done (uint64),
+      published before writing data, so readers can detect data being
+      overwritten while they copy it
+    CONSUMER_COUNT consumer slots, each:
+      pid (uint64), 0 when slot is free
+      tail: total number of bytes read by this consumer (uint64)
+  Data (capacity bytes): byte at stream position p is at data offset
+    p % capacity.
+All integers are little-endian.
+
+As capture data is a stream of variable-length packets, a reader which lost
+data resumes at an arbitrary point, possibly in the middle of a packet: the
+decoding pipeline must be told to resynchronise (see ReorderedStream.resync
+and Packetiser.resync).
+"""
+import errno
+import fcntl
+import mmap
+import os
+import time
+from struct import pack_into, unpack_from, calcsize
+
+MAGIC = 'ITI1480\x02'
+HEADER_FORMAT = '<8sQQQQ'
+HEADER_LEN = calcsize(HEADER_FORMAT)
+HEAD_OFFSET = 16
+CLOSED_OFFSET = 24
+RESERVED_OFFSET = 32
+SLOT_FORMAT = '<QQ'
+SLOT_LEN = calcsize(SLOT_FORMAT)
+CONSUMER_COUNT = 16
+HEADER_SIZE = 4096
+assert HEADER_LEN + CONSUMER_COUNT * SLOT_LEN <= HEADER_SIZE
+
+RING_SIZE = 64 * 1024 * 1024
+# Delay between two checks for new data when ring is empty, in seconds.
+POLL_INTERVAL = 0.001
+
+class RingOverrun(Exception):
+    """
+    Raised by RingReader.read when writer overwrote data before it was read.
+    Reading position is moved to the oldest available data, so reading can
+    continue.
+    """
+    def __init__(self, lost):
+        super(RingOverrun, self).__init__('Lost %i bytes' % (lost, ))
+        self.lost = lost
+
+def _readUInt64(buf, offset):
+    # Writer may be updating the value while we read it: read until stable.
+    value = unpack_from('<Q', buf, offset)[0]
+    while True:
+        check = unpack_from('<Q', buf, offset)[0]
+        if check == value:
+            return value
+        value = check
+
+class RingWriter(object):
+    """
+    File-like object writing to a newly-created ring.
+    """
+    def __init__(self, path, capacity=RING_SIZE):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + capacity)
+            self._map = buf = mmap.mmap(fd, HEADER_SIZE + capacity)
+        finally:
+            os.close(fd)
+        pack_into(HEADER_FORMAT, buf, 0, MAGIC, capacity, 0, 0, 0)
+        self._capacity = capacity
+        self._head = 0
+
+    def write(self, data):
+        buf = self._map
+        capacity = self._capacity
+        length = len(data)
+        head = self._head
+        # Announce overwritten area before overwriting it.
+        pack_into('<Q', buf, RESERVED_OFFSET, head + length)
+        if length > capacity:
+            data = data[-capacity:]
+            head += length - capacity
+        offset = head % capacity
+        first = min(len(data), capacity - offset)
+        start = HEADER_SIZE + offset
+        buf[start:start + first] = data[:first]
+        if first < len(data):
+            buf[HEADER_SIZE:HEADER_SIZE + len(data) - first] = data[first:]
+        self._head = head = self._head + length
+        # Publish only once data is in place.
+        pack_into('<Q', buf, HEAD_OFFSET, head)
+
+    def flush(self):
+        pass
+
+    def getCapacity(self):
+        """
+        Return ring data capacity, in bytes.
+        """
+        return self._capacity
+
+    def getConsumerList(self):
+        """
+        Return the list of registered consumers, as 2-tuples of pid and
+        number of bytes behind writer.
+        """
+        buf = self._map
+        result = []
+        for index in xrange(CONSUMER_COUNT):
+            pid, tail = unpack_from(
+                SLOT_FORMAT,
+                buf,
+                HEADER_LEN + index * SLOT_LEN,
+            )
+            if pid:
+                result.append((pid, self._head - tail))
+        return result
+
+    def close(self):
+        pack_into('<Q', self._map, CLOSED_OFFSET, 1)
+        self._map.close()
+
+class RingReader(object):
+    """
+    File-like object reading from an existing ring.
+    """
+    def __init__(self, path, poll_interval=POLL_INTERVAL):
+        fd = os.open(path, os.O_RDWR)
+        try:
+            size = os.fstat(fd).st_size
+            self._map = buf = mmap.mmap(fd, size)
+            magic, capacity, head, _, _ = unpack_from(HEADER_FORMAT, buf, 0)
+            if magic != MAGIC:
+                raise ValueError('Not a ring: %r' % (path, ))
+            # Serialise slot allocation between readers.
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                for index in xrange(CONSUMER_COUNT):
+                    slot_offset = HEADER_LEN + index * SLOT_LEN
+                    pid, _ = unpack_from(SLOT_FORMAT, buf, slot_offset)
+                    if not pid or not self._isAlive(pid):
+                        break
+                else:
+                    raise ValueError('No free consumer slot')
+                # Start from the oldest available data.
+                self._tail = tail = max(head - capacity, 0)
+                pack_into(SLOT_FORMAT, buf, slot_offset, os.getpid(), tail)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+        self._capacity = capacity
+        self._slot_offset = slot_offset
+        self._poll_interval = poll_interval
+
+    @staticmethod
+    def _isAlive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, exc:
+            return exc.errno != errno.ESRCH
+        return True
+
+    def read(self, size):
+        """
+        Return up to size bytes, waiting for data if none is available.
+        Returns an empty string once writer closed the ring and all data was
+        read.
+        """
+        buf = self._map
+        capacity = self._capacity
+        tail = self._tail
+        while True:
+            head = _readUInt64(buf, HEAD_OFFSET)
+            # After an overrun caused by a write larger than capacity, tail
+            # is ahead of head until that write is done.
+            if head > tail:
+                break
+            if _readUInt64(buf, CLOSED_OFFSET):
+                # Head may have moved just before close.
+                head = _readUInt64(buf, HEAD_OFFSET)
+                if head <= tail:
+                    return ''
+                break
+            time.sleep(self._poll_interval)
+        if head - tail > capacity:
+            lost = head - capacity - tail
+            self._setTail(head - capacity)
+            raise RingOverrun(lost)
+        length = min(size, head - tail)
+        offset = tail % capacity
+        first = min(length, capacity - offset)
+        start = HEADER_SIZE + offset
+        data = buf[start:start + first]
+        if first < length:
+            data += buf[HEADER_SIZE:HEADER_SIZE + length - first]
+        # Writer may have lapped us while we were copying, including with a
+        # write still in progress.
+        reserved = _readUInt64(buf, RESERVED_OFFSET)
+        if reserved - tail > capacity:
+            lost = reserved - capacity - tail
+            self._setTail(reserved - capacity)
+            raise RingOverrun(lost)
+        self._setTail(tail + length)
+        return data
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for data to be available, or for writer to
+        close the ring.
+        Returns whether read would return without waiting.
+        """
+        buf = self._map
+        deadline = time.time() + timeout
+        while _readUInt64(buf, HEAD_OFFSET) <= self._tail and \
+                not _readUInt64(buf, CLOSED_OFFSET):
+            if time.time() >= deadline:
+                return False
+            time.sleep(self._poll_interval)
+        return True
+
+    def tell(self):
+        """
+        Return current reading position in the stream of data ever written.
+        """
+        return self._tail
+
+    def _setTail(self, tail):
+        self._tail = tail
+        pack_into('<Q', self._map, self._slot_offset + 8, tail)
+
+    def close(self):
+        pack_into(SLOT_FORMAT, self._map, self._slot_offset, 0, 0)
+        self._map.close()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Search data packet payloads for byte sequences or regular expressions.
+
+Only packets are decoded (not transactions): data packets are accounted to
+the pipe (address, endpoint and direction) of the token before them, and
+only data which was not NAKed nor STALLed and has a valid CRC is searched.
+Consecutive payloads of a pipe are searched as one byte string, so matches
+can span packets of a transfer. A transfer ends on a SETUP, or on a packet
+shorter than the largest one seen on that pipe. At most span bytes before
+the last packet are kept, so matches longer than this may be missed.
+
+Compressed captures can be searched by several processes, each decoding a
+range of frames (plus one frame, to complete matches spanning ranges), and
+reporting matches in transactions starting in its range, ranges being
+delimited by the first SOF of their first frame.
+"""
+from bisect import bisect_right
+import errno
+import multiprocessing
+import re
+import sys
+from iti1480a.parser import MESSAGE_PACKET, PID_DATA0, PID_DATA1, \
+    PID_DATA2, PID_MDATA, PID_ACK, PID_NYET, PID_NAK, PID_STALL, PID_PRE, \
+    PID_IN, PID_OUT, PID_SETUP, PID_SOF, crc5, crc16, \
+    CRC5_RESIDUAL, CRC16_RESIDUAL, tic_to_time
+from iti1480a.iterate import iterPackets, READ_SIZE
+from iti1480a.compressed import openCapture, CompressedReader
+
+# Bytes kept per pipe to find matches spanning packets.
+SPAN = 4096
+# Frames per task when searching a compressed capture in parallel.
+TASK_FRAMES = 16
+
+_DATA_PID_SET = frozenset((PID_DATA0, PID_DATA1, PID_DATA2, PID_MDATA))
+_TOKEN_PID_SET = frozenset((PID_IN, PID_OUT, PID_SETUP))
+
+def compilePattern(pattern, regex=False):
+    """
+    Return a compiled regular expression for given byte string, or regular
+    expression if regex is true.
+    """
+    if not regex:
+        pattern = re.escape(pattern)
+    return re.compile(pattern, re.DOTALL)
+
+class _Pipe(object):
+    """
+    Last searched payload bytes of a pipe.
+    """
+    def __init__(self):
+        self.reset()
+        self.max_length = 0
+
+    def reset(self):
+        self.data = ''
+        # Offset in data, tic and transaction tic of each payload in data.
+        self.offset_list = []
+        self.tic_list = []
+        self.transaction_tic_list = []
+        # Per pattern index, offset matches must start at or after, to not
+        # be reported twice.
+        self.reported_dict = {}
+
+def searchPackets(packet_iterator, regex_list, span=SPAN):
+    """
+    Yield matches of given compiled regular expressions in payloads of
+    packets from packet_iterator (as produced by iterate.iterPackets).
+    Each match is a dict:
+    - tic: tic of the packet the match starts in
+    - transaction_tic: tic of the token of that packet's transaction
+    - address, endpoint
+    - direction: 'IN' or 'OUT' (SETUP data is OUT)
+    - offset: offset of match start in packet payload
+    - pattern: index of the matched regular expression in regex_list
+    - data: matched bytes
+    """
+    pipe_dict = {}
+    # (transaction tic, pipe key) of last token
+    token = None
+    # (tic, payload, token) of data waiting for a handshake
+    pending = None
+
+    def commit(tic, payload, token):
+        transaction_tic, key = token
+        try:
+            pipe = pipe_dict[key]
+        except KeyError:
+            pipe_dict[key] = pipe = _Pipe()
+        base = len(pipe.data)
+        data = pipe.data + payload
+        offset_list = pipe.offset_list
+        offset_list.append(base)
+        pipe.tic_list.append(tic)
+        pipe.transaction_tic_list.append(transaction_tic)
+        address, endpoint, is_in = key
+        reported_dict = pipe.reported_dict
+        for index, regex in enumerate(regex_list):
+            reported = reported_dict.get(index, 0)
+            for match in regex.finditer(data):
+                start, end = match.span()
+                if end <= base or start == end or start < reported:
+                    continue
+                reported_dict[index] = reported = end
+                payload_index = bisect_right(offset_list, start) - 1
+                yield {
+                    'tic': pipe.tic_list[payload_index],
+                    'transaction_tic': pipe.transaction_tic_list[
+                        payload_index
+                    ],
+                    'address': address,
+                    'endpoint': endpoint,
+                    'direction': 'IN' if is_in else 'OUT',
+                    'offset': start - offset_list[payload_index],
+                    'pattern': index,
+                    'data': match.group(),
+                }
+        length = len(payload)
+        if length < pipe.max_length or not length:
+            pipe.reset()
+            return
+        pipe.max_length = length
+        cut = len(data) - span
+        if cut > 0:
+            data = data[cut:]
+            drop = bisect_right(offset_list, cut) - 1
+            del offset_list[:drop]
+            del pipe.tic_list[:drop]
+            del pipe.transaction_tic_list[:drop]
+            offset_list[:] = [x - cut for x in offset_list]
+            for index, reported in reported_dict.items():
+                reported_dict[index] = max(reported - cut, 0)
+        pipe.data = data
+
+    for tic, message_type, packet in packet_iterator:
+        if message_type != MESSAGE_PACKET:
+            continue
+        pid = packet[0][1] & 0xf
+        if pid in _DATA_PID_SET:
+            if token is None or crc16(packet[1:]) != CRC16_RESIDUAL:
+                pending = None
+            else:
+                pending = (
+                    tic,
+                    str(bytearray(x[1] for x in packet[1:-2])),
+                    token,
+                )
+            continue
+        if pid == PID_PRE:
+            # PRE for low-speed packets, or ERR handshake of a split
+            # transaction, which has no data.
+            continue
+        if pending is not None and pid != PID_NAK and pid != PID_STALL:
+            for match in commit(*pending):
+                yield match
+        pending = None
+        if pid == PID_ACK or pid == PID_NYET or pid == PID_NAK or \
+                pid == PID_STALL:
+            continue
+        if pid in _TOKEN_PID_SET and len(packet) == 3 and \
+                crc5(packet[1:]) == CRC5_RESIDUAL:
+            address = packet[1][1] & 0x7f
+            endpoint = (packet[1][1] >> 7) | ((packet[2][1] & 0x7) << 1)
+            if pid == PID_SETUP:
+                for is_in in (False, True):
+                    pipe = pipe_dict.get((address, endpoint, is_in))
+                    if pipe is not None:
+                        pipe.reset()
+            token = (tic, (address, endpoint, pid == PID_IN))
+        else:
+            # SOF, SPLIT, PING, bad token: no data until next valid token.
+            token = None
+    if pending is not None:
+        for match in commit(*pending):
+            yield match
+
+class _FrameReader(object):
+    """
+    Read a range of compressed capture frames, one frame per read.
+    """
+    def __init__(self, reader, start, stop):
+        self._reader = reader
+        self._index = start
+        self._stop = stop
+
+    def read(self, size=-1):
+        if self._index >= self._stop:
+            return ''
+        self._index += 1
+        return self._reader.readFrame(self._index - 1)
+
+def _iterNotingSOF(packet_iterator, boundary_dict):
+    """
+    Pass packets through, storing in boundary_dict the tic of the first SOF
+    at or after each of its keys.
+    """
+    for item in packet_iterator:
+        tic, message_type, packet = item
+        if message_type == MESSAGE_PACKET and packet[0][1] & 0xf == PID_SOF:
+            for frame_tic, sof_tic in boundary_dict.items():
+                if sof_tic is None and tic >= frame_tic:
+                    boundary_dict[frame_tic] = tic
+        yield item
+
+def _searchFrames(args):
+    path, start, stop, pattern_list, span = args
+    regex_list = [compilePattern(x, y) for x, y in pattern_list]
+    reader = openCapture(path)
+    try:
+        frame_list = reader.getFrameList()
+        frame_count = len(frame_list)
+        start_tic = frame_list[start][2]
+        # Decoding starts at an arbitrary point in frame, so transactions
+        # before first RxCmd are lost: a range starts at the first SOF in its
+        # first frame, which both it and previous range decode.
+        boundary_dict = {start_tic: None}
+        if stop < frame_count:
+            stop_tic = frame_list[stop][2]
+            boundary_dict[stop_tic] = None
+        else:
+            stop_tic = None
+        match_list = list(searchPackets(
+            _iterNotingSOF(
+                iterPackets(
+                    _FrameReader(reader, start, min(stop + 1, frame_count)),
+                    tic=start_tic,
+                    resync=bool(start),
+                ),
+                boundary_dict,
+            ),
+            regex_list,
+            span,
+        ))
+    finally:
+        reader.close()
+    if start:
+        start_tic = boundary_dict[start_tic] or start_tic
+    else:
+        start_tic = 0
+    if stop_tic is not None:
+        stop_tic = boundary_dict[stop_tic] or stop_tic
+    return [
+        x for x in match_list
+        if x['transaction_tic'] >= start_tic and (
+            stop_tic is None or x['transaction_tic'] < stop_tic
+        )
+    ]
+
+def search(path, pattern_list, span=SPAN, jobs=1, read_size=READ_SIZE):
+    """
+    Yield matches (see searchPackets) of given patterns in given capture.
+    pattern_list (list of (string, bool))
+        Pattern, and whether it is a regular expression (a byte string
+        otherwise).
+    jobs (int)
+        Number of processes to search with. Only compressed captures can be
+        searched by more than one process.
+    Matches come in the order they are found, and a match spanning packets
+    is found with its last packet, so it may come after later matches.
+    """
+    if jobs > 1:
+        reader = openCapture(path)
+        try:
+            if isinstance(reader, CompressedReader):
+                frame_count = len(reader.getFrameList())
+            else:
+                frame_count = 0
+        finally:
+            reader.close()
+        if frame_count > TASK_FRAMES:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                for match_list in pool.imap(_searchFrames, [
+                            (path, x, min(x + TASK_FRAMES, frame_count),
+                                pattern_list, span)
+                            for x in xrange(0, frame_count, TASK_FRAMES)
+                        ]):
+                    for match in match_list:
+                        yield match
+            finally:
+                pool.terminate()
+            return
+    for match in searchPackets(
+                iterPackets(path, read_size),
+                [compilePattern(x, y) for x, y in pattern_list],
+                span,
+            ):
+        yield match
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(
+        usage='%prog [options] -i capture pattern options',
+        epilog='Each match is printed with its time, address, endpoint, '
+        'direction, offset in packet payload, pattern number (strings first, '
+        'then hex patterns, then regular expressions) and matched bytes.',
+    )
+    parser.add_option(
+        '-i', '--infile',
+        help='Capture to search',
+    )
+    parser.add_option(
+        '-s', '--string', action='append', default=[],
+        help='Search for this string. Can be repeated.',
+    )
+    parser.add_option(
+        '-x', '--hex', action='append', default=[],
+        help='Search for these bytes, in hexadecimal (ex: 55534243). Can be '
+        'repeated.',
+    )
+    parser.add_option(
+        '-e', '--regex', action='append', default=[],
+        help='Search for this Python regular expression (escape bytes as '
+        '\\xNN). Can be repeated.',
+    )
+    parser.add_option(
+        '--span', type='int', default=SPAN,
+        help='Bytes of previous packets of a transfer kept to find matches '
+        'spanning packets (default: %default)',
+    )
+    parser.add_option(
+        '-j', '--jobs', type='int', default=1,
+        help='Number of processes to search compressed captures with '
+        '(default: %default)',
+    )
+    (options, args) = parser.parse_args()
+    pattern_list = [(x, False) for x in options.string]
+    try:
+        pattern_list.extend((x.decode('hex'), False) for x in options.hex)
+    except TypeError:
+        print >>sys.stderr, 'Invalid --hex value'
+        sys.exit(1)
+    pattern_list.extend((x, True) for x in options.regex)
+    if args or not options.infile or not pattern_list:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    for regex in options.regex:
+        try:
+            compilePattern(regex, True)
+        except re.error, exc:
+            print >>sys.stderr, 'Invalid --regex %r: %s' % (regex, exc)
+            sys.exit(1)
+    write = sys.stdout.write
+    try:
+        for match in search(
+                    options.infile,
+                    pattern_list,
+                    options.span,
+                    options.jobs,
+                ):
+            data = match['data']
+            write('%s @%03i.%02i %-3s %5i #%i %s%s\n' % (
+                tic_to_time(match['tic']),
+                match['address'],
+                match['endpoint'],
+                match['direction'],
+                match['offset'],
+                match['pattern'],
+                data[:32].encode('hex'),
+                '...' if len(data) > 32 else '',
+            ))
+    except IOError, exc:
+        if exc.errno != errno.EPIPE:
+            raise
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
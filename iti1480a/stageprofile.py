@@ -0,0 +1,148 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Per-stage decoding pipeline profiling.
+
+Enabled by setting ITI1480A_PROFILE environment variable to a non-empty
+value. When ITI1480A_PROFILE_DUMP is also set, statistics are also written
+there as JSON.
+
+For each stage (aggregator class), counts pushes received (in) and pushes
+it made to other profiled stages (out), the time spent in the stage itself
+(excluding time spent in stages it pushed to), and the size of its internal
+queue after each push (for ReorderedStream, bytes kept for next push).
+Summary is printed on stderr when the outermost stop() call returns.
+
+When disabled, stage classes are left untouched, so there is no overhead.
+"""
+import json
+import os
+import sys
+import time
+
+PROFILE = bool(os.environ.get('ITI1480A_PROFILE'))
+PROFILE_DUMP = os.environ.get('ITI1480A_PROFILE_DUMP')
+
+class StageStatistics(object):
+    def __init__(self, name):
+        self.name = name
+        self.in_count = 0
+        self.out_count = 0
+        self.self_time = 0
+        self.queue_max = 0
+        self.queue_total = 0
+
+    def asDict(self):
+        return {
+            'in': self.in_count,
+            'out': self.out_count,
+            'self_time': self.self_time,
+            'queue_max': self.queue_max,
+            'queue_average': (
+                float(self.queue_total) / self.in_count
+                if self.in_count else 0
+            ),
+        }
+
+# Stage statistics, in registration order.
+_stage_list = []
+# Stack of [StageStatistics, time spent in callees] for pushes in progress.
+_call_stack = []
+
+def _wrapPush(push, stats, getQueueSize):
+    stack = _call_stack
+    _time = time.time
+    def profiledPush(self, *args, **kw):
+        if stack:
+            stack[-1][0].out_count += 1
+        stats.in_count += 1
+        frame = [stats, 0]
+        stack.append(frame)
+        start = _time()
+        try:
+            return push(self, *args, **kw)
+        finally:
+            elapsed = _time() - start
+            stack.pop()
+            stats.self_time += elapsed - frame[1]
+            if stack:
+                stack[-1][1] += elapsed
+            if getQueueSize is not None:
+                size = getQueueSize(self)
+                stats.queue_total += size
+                if size > stats.queue_max:
+                    stats.queue_max = size
+    return profiledPush
+
+def _wrapStop(stop, stats):
+    def profiledStop(self):
+        outermost = not _call_stack
+        # Pushes made while stopping count as this stage output.
+        frame = [stats, 0]
+        _call_stack.append(frame)
+        start = time.time()
+        try:
+            return stop(self)
+        finally:
+            elapsed = time.time() - start
+            _call_stack.pop()
+            stats.self_time += elapsed - frame[1]
+            if _call_stack:
+                _call_stack[-1][1] += elapsed
+            if outermost:
+                report(sys.stderr.write)
+                if PROFILE_DUMP:
+                    with open(PROFILE_DUMP, 'w') as dump:
+                        json.dump(asDict(), dump)
+                        dump.write('\n')
+    return profiledStop
+
+def profileStage(cls, getQueueSize=None):
+    """
+    Profile given aggregator class, if profiling is enabled.
+    Subclasses of a profiled class must not be profiled.
+
+    getQueueSize (callable)
+        Receives stage instance, returns the number of items it is holding.
+    """
+    if PROFILE:
+        stats = StageStatistics(cls.__name__)
+        _stage_list.append(stats)
+        cls.push = _wrapPush(cls.push.im_func, stats, getQueueSize)
+        cls.stop = _wrapStop(cls.stop.im_func, stats)
+
+def asDict():
+    return dict((x.name, x.asDict()) for x in _stage_list)
+
+def report(write):
+    """
+    Write a human-readable summary of stage statistics.
+    """
+    write('%-30s %10s %10s %10s %10s %10s\n' % (
+        'Stage', 'In', 'Out', 'Self (s)', 'Queue max', 'Queue avg',
+    ))
+    for stats in _stage_list:
+        if not stats.in_count:
+            continue
+        entry = stats.asDict()
+        write('%-30s %10i %10i %10.3f %10i %10.2f\n' % (
+            stats.name,
+            entry['in'],
+            entry['out'],
+            entry['self_time'],
+            entry['queue_max'],
+            entry['queue_average'],
+        ))
@@ -0,0 +1,304 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Per-endpoint traffic statistics, computed in a single pass without
+rendering anything.
+
+Statistics is a PipeAggregator receiving both transactions and bus events
+(so it can be given as to_next and to_top of TransactionAggregator and
+Packetiser), and counting per address and endpoint:
+- transactions, and incomplete transactions
+- bytes moved in each direction (payload of transactions which were not
+  NAKed nor STALLed, and had no CRC error)
+- handshakes (ACK, NAK, STALL, NYET)
+- packets with a CRC error
+- bytes moved per time interval, for throughput over time
+Like PipeAggregator, split transactions are accounted to the hub they are
+addressed to, with a None endpoint. Address-less transactions (SOF) are
+accounted with a None address.
+"""
+from iti1480a.parser import PipeAggregator, BaseAggregator, crc5, crc16, \
+    CRC5_RESIDUAL, CRC16_RESIDUAL, HANDSHAKE_LIST, TIC_TO_SECOND, \
+    MESSAGE_TRANSACTION, MESSAGE_INCOMPLETE, MESSAGE_RAW, MESSAGE_RESET, \
+    MESSAGE_TRANSACTION_ERROR, MESSAGE_LS_EOP, MESSAGE_FS_EOP, \
+    MESSAGE_FS_TO_CHIRP, TOKEN_TYPE_IN, TOKEN_TYPE_OUT, TOKEN_TYPE_SETUP, \
+    TOKEN_TYPE_PING, TOKEN_TYPE_SOF, TOKEN_TYPE_SSPLIT, TOKEN_TYPE_CSPLIT, \
+    TOKEN_TYPE_DATA0, TOKEN_TYPE_DATA1, TOKEN_TYPE_DATA2, TOKEN_TYPE_MDATA, \
+    TOKEN_TYPE_NAK, TOKEN_TYPE_STALL
+
+# Default throughput interval, in seconds.
+INTERVAL = 1
+
+EVENT_NAME_DICT = {
+    MESSAGE_RAW: 'raw',
+    MESSAGE_RESET: 'reset',
+    MESSAGE_TRANSACTION_ERROR: 'transaction_error',
+    MESSAGE_LS_EOP: 'ls_eop',
+    MESSAGE_FS_EOP: 'fs_eop',
+    MESSAGE_FS_TO_CHIRP: 'fs_to_chirp',
+}
+
+_DATA_TOKEN_SET = frozenset((
+    TOKEN_TYPE_DATA0,
+    TOKEN_TYPE_DATA1,
+    TOKEN_TYPE_DATA2,
+    TOKEN_TYPE_MDATA,
+))
+_CRC5_TOKEN_SET = frozenset((
+    TOKEN_TYPE_IN,
+    TOKEN_TYPE_OUT,
+    TOKEN_TYPE_SETUP,
+    TOKEN_TYPE_PING,
+    TOKEN_TYPE_SOF,
+    TOKEN_TYPE_SSPLIT,
+    TOKEN_TYPE_CSPLIT,
+))
+_HANDSHAKE_SET = frozenset(HANDSHAKE_LIST)
+_REFUSED_SET = frozenset((TOKEN_TYPE_NAK, TOKEN_TYPE_STALL))
+
+class EndpointStatistics(BaseAggregator):
+    """
+    Statistics of transactions pushed to one pipe.
+    """
+    first_tic = None
+    last_tic = None
+
+    def __init__(self, interval_tic):
+        self._interval_tic = interval_tic
+        self.transaction_count = 0
+        self.incomplete_count = 0
+        self.in_bytes = 0
+        self.out_bytes = 0
+        self.crc_error_count = 0
+        self.handshake_dict = dict.fromkeys(HANDSHAKE_LIST, 0)
+        # Interval index to number of bytes moved.
+        self.interval_dict = {}
+
+    def push(self, tic, message_type, data):
+        if message_type == MESSAGE_INCOMPLETE:
+            self.incomplete_count += 1
+        else:
+            self.transaction_count += 1
+        if self.first_tic is None:
+            self.first_tic = tic
+        self.last_tic = tic
+        payload = 0
+        crc_error = False
+        handshake = None
+        is_in = False
+        for token_type, packet in data:
+            if token_type in _DATA_TOKEN_SET:
+                payload += max(len(packet) - 3, 0)
+                if crc16(packet[1:]) != CRC16_RESIDUAL:
+                    self.crc_error_count += 1
+                    crc_error = True
+            elif token_type in _HANDSHAKE_SET:
+                handshake = token_type
+            elif token_type in _CRC5_TOKEN_SET:
+                if token_type == TOKEN_TYPE_IN:
+                    is_in = True
+                if crc5(packet[1:]) != CRC5_RESIDUAL:
+                    self.crc_error_count += 1
+                    crc_error = True
+        if handshake is not None:
+            self.handshake_dict[handshake] += 1
+        if payload and not crc_error and handshake not in _REFUSED_SET:
+            if is_in:
+                self.in_bytes += payload
+            else:
+                self.out_bytes += payload
+            interval_dict = self.interval_dict
+            index = tic // self._interval_tic
+            interval_dict[index] = interval_dict.get(index, 0) + payload
+
+    def getRatio(self, handshake):
+        """
+        Return the proportion of complete transactions ended by given
+        handshake.
+        """
+        if not self.transaction_count:
+            return 0.
+        return self.handshake_dict[handshake] / float(self.transaction_count)
+
+    def _iterIntervals(self):
+        """
+        Yield, for each interval in which bytes were moved, its start (in tics),
+        the number of bytes moved and its duration (in tics) clipped to first
+        and last transaction.
+        """
+        interval_tic = self._interval_tic
+        first_tic = self.first_tic
+        last_tic = self.last_tic
+        for index, length in sorted(self.interval_dict.iteritems()):
+            start = index * interval_tic
+            yield start, length, (
+                min(start + interval_tic, last_tic) - max(start, first_tic)
+            )
+
+    def getThroughputList(self):
+        """
+        Return a list of (interval start, bytes per second), in seconds, for
+        intervals in which bytes were moved.
+        Rate is computed over the part of the interval between first and last
+        transaction, so it is comparable with mean throughput.
+        """
+        return [
+            (start * TIC_TO_SECOND, length / (duration * TIC_TO_SECOND))
+            for start, length, duration in self._iterIntervals()
+            if duration > 0
+        ]
+
+    def getPeakThroughput(self):
+        """
+        Return the highest bytes per second over a whole interval, or mean
+        throughput if higher (ex: when transactions span less than an
+        interval).
+        Partially-covered intervals are ignored, as they can be arbitrarily
+        short.
+        """
+        interval_tic = self._interval_tic
+        return max([self.getMeanThroughput()] + [
+            length / (duration * TIC_TO_SECOND)
+            for _, length, duration in self._iterIntervals()
+            if duration == interval_tic
+        ])
+
+    def getMeanThroughput(self):
+        """
+        Return bytes moved per second between first and last transaction.
+        """
+        if self.first_tic is None or self.last_tic == self.first_tic:
+            return 0.
+        return (self.in_bytes + self.out_bytes) / (
+            (self.last_tic - self.first_tic) * TIC_TO_SECOND
+        )
+
+    def asDict(self):
+        result = {
+            'transactions': self.transaction_count,
+            'incomplete': self.incomplete_count,
+            'in_bytes': self.in_bytes,
+            'out_bytes': self.out_bytes,
+            'crc_errors': self.crc_error_count,
+            'first_tic': self.first_tic,
+            'last_tic': self.last_tic,
+            'mean_throughput': self.getMeanThroughput(),
+            'peak_throughput': self.getPeakThroughput(),
+            'throughput': self.getThroughputList(),
+        }
+        for handshake in HANDSHAKE_LIST:
+            result[handshake.lower()] = self.handshake_dict[handshake]
+            result[handshake.lower() + '_ratio'] = self.getRatio(handshake)
+        return result
+
+class Statistics(PipeAggregator):
+    """
+    Compute per-address and per-endpoint statistics.
+    push receives transactions and bus events, as given to TransactionAggregator
+    to_next and to_top, and Packetiser to_top.
+    """
+    def __init__(self, interval=INTERVAL):
+        """
+        interval (float)
+            Throughput interval, in seconds.
+        """
+        interval_tic = max(int(interval / TIC_TO_SECOND), 1)
+        # (address, endpoint) to EndpointStatistics
+        self.endpoint_dict = endpoint_dict = {}
+        def newPipe(address, endpoint=None):
+            endpoint_dict[(address, endpoint)] = result = EndpointStatistics(
+                interval_tic,
+            )
+            return result
+        super(Statistics, self).__init__(
+            newPipe(None),
+            None,
+            newPipe,
+            newPipe,
+        )
+        self.event_dict = dict.fromkeys(EVENT_NAME_DICT.itervalues(), 0)
+        self._transaction_push = super(Statistics, self).push
+
+    def push(self, tic, message_type, data):
+        if message_type == MESSAGE_TRANSACTION or \
+                message_type == MESSAGE_INCOMPLETE:
+            self._transaction_push(tic, message_type, data)
+        else:
+            self.event_dict[EVENT_NAME_DICT[message_type]] += 1
+
+    def stop(self):
+        # Statistics are complete as soon as data is pushed.
+        pass
+
+    def asDict(self):
+        """
+        Return statistics as a JSON-serialisable dict.
+        """
+        endpoint_list = []
+        for (address, endpoint), statistics in sorted(
+                    self.endpoint_dict.iteritems(),
+                ):
+            if statistics.first_tic is None:
+                continue
+            entry = statistics.asDict()
+            entry['address'] = address
+            entry['endpoint'] = endpoint
+            endpoint_list.append(entry)
+        return {
+            'endpoints': endpoint_list,
+            'events': self.event_dict,
+        }
+
+    def report(self, write):
+        """
+        Write statistics as a human-readable table.
+        """
+        write(
+            '%-7s %5s %12s %10s %12s %12s %6s %6s %6s %6s %8s %12s %12s\n' % (
+                'Address', 'EP', 'Transactions', 'Incomplete', 'In (B)',
+                'Out (B)', 'ACK%', 'NAK%', 'STALL%', 'NYET%', 'CRC err',
+                'Mean (B/s)', 'Peak (B/s)',
+            )
+        )
+        for (address, endpoint), statistics in sorted(
+                    self.endpoint_dict.iteritems(),
+                ):
+            if statistics.first_tic is None:
+                continue
+            write(
+                '%-7s %5s %12i %10i %12i %12i %6.1f %6.1f %6.1f %6.1f %8i '
+                '%12.0f %12.0f\n' % (
+                    '-' if address is None else address,
+                    ('-' if address is None else 'hub') if endpoint is None
+                        else endpoint,
+                    statistics.transaction_count,
+                    statistics.incomplete_count,
+                    statistics.in_bytes,
+                    statistics.out_bytes,
+                    statistics.getRatio('ACK') * 100,
+                    statistics.getRatio('NAK') * 100,
+                    statistics.getRatio('STALL') * 100,
+                    statistics.getRatio('NYET') * 100,
+                    statistics.crc_error_count,
+                    statistics.getMeanThroughput(),
+                    statistics.getPeakThroughput(),
+                )
+            )
+        write('Events: %s\n' % (
+            ', '.join(
+                '%s=%i' % x for x in sorted(self.event_dict.iteritems())
+            ),
+        ))
@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Synthetic capture generation.
+
+CaptureEncoder is the inverse of ReorderedStream: it turns tic counts, types
+and payloads into .usb file data. BusEncoder builds on it to emit USB packets
+the way the analyser sees them (RxCmd with RxActive, data bytes, RxCmd
+without RxActive), and scenario functions produce typical bus traffic.
+"""
+from struct import pack
+import sys
+from iti1480a.parser import BaseAggregator, TYPE_SHIFT, LENGTH_SHIFT, \
+    TYPE_TIME_DELTA, TYPE_EVENT, TYPE_DATA, TYPE_RXCMD, crc5, \
+    CRC5_RESIDUAL, PID_OUT, PID_ACK, PID_DATA0, PID_PING, PID_SOF, \
+    PID_NYET, PID_SPLIT, PID_IN, PID_NAK, PID_DATA1, PID_PRE, PID_SETUP, \
+    RXCMD_RX_ACTIVE, RXCMD_LINESTATE_FS_J, RXCMD_LINESTATE_SE0, \
+    EVENT_CAPTURE_STARTED, EVENT_CAPTURE_STOPPED_USER, \
+    EVENT_FS_DEVICE_CONNECTION, EVENT_DEVICE_CHIRP, EVENT_HOST_CHIRP, \
+    MIN_RESET_TIC
+
+# Largest tic increment a packet can hold: 4 bits in packet head, plus 8 bits
+# per extra byte. Time-delta packets cannot have 3 extra bytes.
+MAX_TIC_DELTA = (1 << 28) - 1
+MAX_TIME_DELTA = (1 << 20) - 1
+
+# RxCmd VBUS value when a device is powered.
+RXCMD_VBUS_VALID = 0x0c
+
+# Tics per byte on the wire (ULPI clock is 60MHz).
+HS_BYTE_TICS = 1
+FS_BYTE_TICS = 40
+LS_BYTE_TICS = 320
+# Tics between (micro)frame starts.
+HS_MICROFRAME_TICS = 7500
+FS_FRAME_TICS = 60000
+# Tics between the end of a packet and the start of the next one.
+INTER_PACKET_TICS = 16
+
+SPLIT_ENDPOINT_TYPE_CONTROL = 0
+SPLIT_ENDPOINT_TYPE_BULK = 2
+SPLIT_ENDPOINT_TYPE_INTERRUPT = 3
+
+def encodePacket(tic_delta, packet_type, payload=0):
+    """
+    Return given packet in .usb file order.
+
+    tic_delta (int)
+        Tics elapsed since previous packet.
+    packet_type (TYPE_TIME_DELTA, TYPE_EVENT, TYPE_DATA, TYPE_RXCMD)
+    payload (int)
+        1-byte value. Must be 0 for TYPE_TIME_DELTA.
+    """
+    if tic_delta < 0x10:
+        length = 0
+    elif tic_delta < 0x1000:
+        length = 1
+    elif tic_delta < 0x100000:
+        length = 2
+    elif tic_delta <= MAX_TIC_DELTA and packet_type != TYPE_TIME_DELTA:
+        length = 3
+    else:
+        raise ValueError('Tic delta too large: %i' % (tic_delta, ))
+    head = (
+        (packet_type << TYPE_SHIFT) |
+        (length << LENGTH_SHIFT) |
+        (tic_delta & 0xf)
+    ) << 8
+    if length == 0:
+        word_list = [head | payload]
+    else:
+        word_list = [head | ((tic_delta >> 4) & 0xff)]
+        if length == 1:
+            if packet_type != TYPE_TIME_DELTA:
+                word_list.append(payload << 8)
+        elif length == 2:
+            word_list.append((((tic_delta >> 12) & 0xff) << 8) | payload)
+        else:
+            word_list.append(
+                (((tic_delta >> 12) & 0xff) << 8) |
+                ((tic_delta >> 20) & 0xff)
+            )
+            word_list.append(payload << 8)
+    return pack('<%iH' % (len(word_list), ), *word_list)
+
+class CaptureEncoder(BaseAggregator):
+    """
+    Inverse of ReorderedStream: receives tic counts, types and payloads,
+    writes .usb file data.
+    """
+    def __init__(self, write, tic=0):
+        """
+        write (callable)
+            Receives .usb file data.
+        tic (int)
+            Tic count at the beginning of the capture.
+        """
+        self._write = write
+        self._tic = tic
+
+    def getTic(self):
+        return self._tic
+
+    def push(self, tic, packet_type, payload):
+        """
+        tic (int)
+            Absolute tic count, must not be smaller than previous one.
+        packet_type (TYPE_EVENT, TYPE_DATA, TYPE_RXCMD)
+        payload (int)
+        """
+        delta = tic - self._tic
+        if delta < 0:
+            raise ValueError('Tic going backward: %i < %i' % (tic, self._tic))
+        while delta > MAX_TIC_DELTA:
+            self._write(encodePacket(MAX_TIME_DELTA, TYPE_TIME_DELTA))
+            delta -= MAX_TIME_DELTA
+        self._write(encodePacket(delta, packet_type, payload))
+        self._tic = tic
+
+def _getPID(pid):
+    return pid | ((pid ^ 0xf) << 4)
+
+_crc5_cache = {}
+def _withCRC5(byte_list, crc_index, crc_shift=3):
+    """
+    Complete byte at crc_index with the CRC5 of given bytes.
+    """
+    key = tuple(byte_list)
+    try:
+        return list(_crc5_cache[key])
+    except KeyError:
+        pass
+    # Brute force: at most 32 tries, and results are cached.
+    for crc in xrange(32):
+        result = list(byte_list)
+        result[crc_index] |= crc << crc_shift
+        if crc5([(None, x) for x in result[1:]]) == CRC5_RESIDUAL:
+            _crc5_cache[key] = result
+            return list(result)
+    raise ValueError('No CRC5 found')
+
+def crc16Bytes(data):
+    """
+    Return USB CRC16 of given byte values, as a 2-item list in wire order.
+    """
+    crc = 0xffff
+    for byte in data:
+        crc ^= byte
+        for _ in xrange(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xa001
+            else:
+                crc >>= 1
+    crc ^= 0xffff
+    return [crc & 0xff, crc >> 8]
+
+def tokenPacket(pid, address, endpoint):
+    return _withCRC5(
+        [
+            _getPID(pid),
+            address | ((endpoint & 1) << 7),
+            endpoint >> 1,
+        ],
+        2,
+    )
+
+def sofPacket(frame):
+    return _withCRC5(
+        [_getPID(PID_SOF), frame & 0xff, (frame >> 8) & 0x7],
+        2,
+    )
+
+def dataPacket(pid, data):
+    """
+    data (list of ints)
+    """
+    return [_getPID(pid)] + data + crc16Bytes(data)
+
+def handshakePacket(pid):
+    return [_getPID(pid)]
+
+def splitPacket(complete, hub_address, port, low_speed, end,
+        endpoint_type):
+    return _withCRC5(
+        [
+            _getPID(PID_SPLIT),
+            hub_address | (0x80 if complete else 0),
+            port | (0x80 if low_speed else 0),
+            (1 if end else 0) | (endpoint_type << 1),
+        ],
+        3,
+    )
+
+class BusEncoder(object):
+    """
+    Emit USB bus activity as seen by the analyser.
+    """
+    def __init__(self, write, byte_tics=HS_BYTE_TICS):
+        """
+        write (callable)
+            Receives .usb file data.
+        byte_tics (int)
+            Tics per byte on the wire, depends on bus speed.
+        """
+        self._encoder = encoder = CaptureEncoder(write)
+        self._push = encoder.push
+        self.byte_tics = byte_tics
+        self.tic = 0
+        self._frame = 0
+        self._next_frame_tic = None
+        self._frame_tics = None
+
+    def idle(self, tics):
+        self.tic += tics
+
+    def event(self, event):
+        self._push(self.tic, TYPE_EVENT, event)
+        self.tic += 1
+
+    def rxcmd(self, value):
+        self._push(self.tic, TYPE_RXCMD, value)
+        self.tic += 1
+
+    def packet(self, byte_list, byte_tics=None):
+        """
+        Emit a USB packet, given as a list of byte values.
+        byte_tics overrides bus speed (ex: low-speed packets after PRE).
+        """
+        if byte_tics is None:
+            byte_tics = self.byte_tics
+        push = self._push
+        tic = self.tic
+        push(tic, TYPE_RXCMD,
+            RXCMD_RX_ACTIVE | RXCMD_VBUS_VALID | RXCMD_LINESTATE_FS_J)
+        for byte in byte_list:
+            tic += byte_tics
+            push(tic, TYPE_DATA, byte)
+        tic += byte_tics
+        push(tic, TYPE_RXCMD, RXCMD_VBUS_VALID | RXCMD_LINESTATE_FS_J)
+        self.tic = tic + INTER_PACKET_TICS
+
+    def startFrames(self, frame_tics):
+        """
+        Emit a SOF every frame_tics, from now on.
+        """
+        self._frame_tics = frame_tics
+        self._next_frame_tic = self.tic
+
+    def maybeSOF(self):
+        """
+        Emit SOFs which are due, jumping idle time if needed.
+        """
+        if self._frame_tics is None:
+            return
+        while self.tic >= self._next_frame_tic:
+            if self.tic > self._next_frame_tic + self._frame_tics:
+                # Idle bus, jump to next due SOF.
+                self.tic = self._next_frame_tic
+            self.packet(sofPacket(self._frame >> 3
+                if self._frame_tics == HS_MICROFRAME_TICS else self._frame))
+            self._frame = (self._frame + 1) & (
+                0x3fff if self._frame_tics == HS_MICROFRAME_TICS else 0x7ff
+            )
+            self._next_frame_tic += self._frame_tics
+
+    def waitNextFrame(self):
+        """
+        Stay idle until next SOF, and emit it.
+        """
+        self.tic = max(self.tic, self._next_frame_tic)
+        self.maybeSOF()
+
+    def reset(self, high_speed=False):
+        """
+        Emit a bus reset, followed by device detection.
+        """
+        self.rxcmd(RXCMD_VBUS_VALID | RXCMD_LINESTATE_SE0)
+        self.idle(int(MIN_RESET_TIC) + 1)
+        if high_speed:
+            self.event(EVENT_DEVICE_CHIRP)
+            self.event(EVENT_HOST_CHIRP)
+        self.rxcmd(RXCMD_VBUS_VALID | RXCMD_LINESTATE_FS_J)
+        if self._next_frame_tic is not None:
+            self._next_frame_tic = self.tic
+
+    def transaction(self, *packet_list):
+        """
+        Emit due SOFs, then given packets.
+        """
+        self.maybeSOF()
+        for byte_list in packet_list:
+            self.packet(byte_list)
+
+def _payload(length, seed):
+    return [(seed + x) & 0xff for x in xrange(length)]
+
+def scenarioHSBulk(bus, count):
+    """
+    High-speed bulk storm: back-to-back 512 bytes OUT and IN transactions on
+    a mass-storage-like device, with occasional NYET and PING.
+    """
+    bus.event(EVENT_DEVICE_CHIRP)
+    bus.event(EVENT_HOST_CHIRP)
+    bus.startFrames(HS_MICROFRAME_TICS)
+    toggle_out = toggle_in = 0
+    for index in xrange(count):
+        data = _payload(512, index)
+        if index % 2:
+            bus.transaction(
+                tokenPacket(PID_IN, 5, 1),
+                dataPacket((PID_DATA0, PID_DATA1)[toggle_in], data),
+                handshakePacket(PID_ACK),
+            )
+            toggle_in ^= 1
+        else:
+            if index % 16 == 0:
+                bus.transaction(
+                    tokenPacket(PID_PING, 5, 2),
+                    handshakePacket(PID_ACK),
+                )
+            bus.transaction(
+                tokenPacket(PID_OUT, 5, 2),
+                dataPacket((PID_DATA0, PID_DATA1)[toggle_out], data),
+                handshakePacket(PID_NYET if index % 8 == 0 else PID_ACK),
+            )
+            toggle_out ^= 1
+
+def scenarioSplit(bus, count):
+    """
+    Full- and low-speed devices behind a high-speed hub: interrupt IN and
+    bulk OUT split transactions.
+    """
+    bus.event(EVENT_DEVICE_CHIRP)
+    bus.event(EVENT_HOST_CHIRP)
+    bus.startFrames(HS_MICROFRAME_TICS)
+    for index in xrange(count):
+        low_speed = index % 3 == 0
+        address = 7 if low_speed else 6
+        port = 2 if low_speed else 1
+        if index % 2:
+            bus.transaction(
+                splitPacket(False, 3, port, low_speed, False,
+                    SPLIT_ENDPOINT_TYPE_INTERRUPT),
+                tokenPacket(PID_IN, address, 1),
+            )
+            bus.waitNextFrame()
+            bus.transaction(
+                splitPacket(True, 3, port, low_speed, False,
+                    SPLIT_ENDPOINT_TYPE_INTERRUPT),
+                tokenPacket(PID_IN, address, 1),
+                handshakePacket(PID_NYET),
+            )
+            bus.transaction(
+                splitPacket(True, 3, port, low_speed, False,
+                    SPLIT_ENDPOINT_TYPE_INTERRUPT),
+                tokenPacket(PID_IN, address, 1),
+                dataPacket(PID_DATA0, _payload(8, index)),
+            )
+        else:
+            data = dataPacket(PID_DATA0, _payload(64, index))
+            bus.transaction(
+                splitPacket(False, 3, port, low_speed, False,
+                    SPLIT_ENDPOINT_TYPE_BULK),
+                tokenPacket(PID_OUT, address, 2),
+                data,
+            )
+            bus.waitNextFrame()
+            bus.transaction(
+                splitPacket(True, 3, port, low_speed, False,
+                    SPLIT_ENDPOINT_TYPE_BULK),
+                tokenPacket(PID_OUT, address, 2),
+                handshakePacket(PID_ACK),
+            )
+
+def scenarioPRE(bus, count):
+    """
+    Low-speed device behind a full-speed hub: PRE-prefixed interrupt IN
+    polling, mostly NAK'ed, and low-speed OUT.
+    """
+    bus.byte_tics = FS_BYTE_TICS
+    bus.event(EVENT_FS_DEVICE_CONNECTION)
+    bus.startFrames(FS_FRAME_TICS)
+    pre = handshakePacket(PID_PRE)
+    for index in xrange(count):
+        bus.waitNextFrame()
+        bus.packet(pre)
+        if index % 16 == 0:
+            bus.packet(tokenPacket(PID_OUT, 4, 2), LS_BYTE_TICS)
+            bus.packet(pre)
+            bus.packet(dataPacket(PID_DATA0, _payload(1, index)),
+                LS_BYTE_TICS)
+            bus.packet(handshakePacket(PID_ACK), LS_BYTE_TICS)
+            continue
+        bus.packet(tokenPacket(PID_IN, 4, 1), LS_BYTE_TICS)
+        if index % 8:
+            bus.packet(handshakePacket(PID_NAK), LS_BYTE_TICS)
+        else:
+            bus.packet(dataPacket(PID_DATA1, _payload(8, index)),
+                LS_BYTE_TICS)
+            bus.packet(pre)
+            bus.packet(handshakePacket(PID_ACK), LS_BYTE_TICS)
+
+def _controlIn(bus, address, setup, data, max_packet=64):
+    bus.transaction(
+        tokenPacket(PID_SETUP, address, 0),
+        dataPacket(PID_DATA0, setup),
+        handshakePacket(PID_ACK),
+    )
+    toggle = 1
+    while True:
+        chunk = data[:max_packet]
+        data = data[max_packet:]
+        bus.transaction(
+            tokenPacket(PID_IN, address, 0),
+            handshakePacket(PID_NAK),
+        )
+        bus.transaction(
+            tokenPacket(PID_IN, address, 0),
+            dataPacket((PID_DATA0, PID_DATA1)[toggle], chunk),
+            handshakePacket(PID_ACK),
+        )
+        toggle ^= 1
+        if len(chunk) < max_packet:
+            break
+    bus.transaction(
+        tokenPacket(PID_OUT, address, 0),
+        dataPacket(PID_DATA1, []),
+        handshakePacket(PID_ACK),
+    )
+
+def _controlOut(bus, address, setup):
+    bus.transaction(
+        tokenPacket(PID_SETUP, address, 0),
+        dataPacket(PID_DATA0, setup),
+        handshakePacket(PID_ACK),
+    )
+    bus.transaction(
+        tokenPacket(PID_IN, address, 0),
+        dataPacket(PID_DATA1, []),
+        handshakePacket(PID_ACK),
+    )
+
+DEVICE_DESCRIPTOR = [
+    0x12, 0x01, 0x00, 0x02, 0x00, 0x00, 0x00, 0x40, 0xc0, 0x16, 0xa9, 0x07,
+    0x00, 0x01, 0x01, 0x02, 0x00, 0x01,
+]
+CONFIGURATION_DESCRIPTOR = [
+    0x09, 0x02, 0x20, 0x00, 0x01, 0x01, 0x00, 0x80, 0x32,
+    0x09, 0x04, 0x00, 0x00, 0x02, 0xff, 0x00, 0x00, 0x00,
+    0x07, 0x05, 0x81, 0x02, 0x40, 0x00, 0x00,
+    0x07, 0x05, 0x02, 0x02, 0x40, 0x00, 0x00,
+]
+
+def scenarioEnumeration(bus, count):
+    """
+    Full-speed device enumeration: reset, descriptor reads, address and
+    configuration, repeated count times.
+    """
+    bus.byte_tics = FS_BYTE_TICS
+    bus.startFrames(FS_FRAME_TICS)
+    for index in xrange(count):
+        address = index % 126 + 1
+        bus.reset()
+        bus.event(EVENT_FS_DEVICE_CONNECTION)
+        _controlIn(bus, 0, [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00],
+            DEVICE_DESCRIPTOR)
+        _controlOut(bus, 0, [0x00, 0x05, address, 0x00, 0x00, 0x00, 0x00,
+            0x00])
+        _controlIn(bus, address, [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x12,
+            0x00], DEVICE_DESCRIPTOR)
+        _controlIn(bus, address, [0x80, 0x06, 0x00, 0x02, 0x00, 0x00, 0xff,
+            0x00], CONFIGURATION_DESCRIPTOR)
+        _controlOut(bus, address, [0x00, 0x09, 0x01, 0x00, 0x00, 0x00, 0x00,
+            0x00])
+
+def scenarioNAKPolling(bus, count):
+    """
+    Full-speed interrupt IN polling, almost always NAK'ed.
+    """
+    bus.byte_tics = FS_BYTE_TICS
+    bus.event(EVENT_FS_DEVICE_CONNECTION)
+    bus.startFrames(FS_FRAME_TICS)
+    for index in xrange(count):
+        for endpoint in (1, 3):
+            if index % 64:
+                bus.transaction(
+                    tokenPacket(PID_IN, 2, endpoint),
+                    handshakePacket(PID_NAK),
+                )
+            else:
+                bus.transaction(
+                    tokenPacket(PID_IN, 2, endpoint),
+                    dataPacket(PID_DATA0, _payload(4, index)),
+                    handshakePacket(PID_ACK),
+                )
+        bus.waitNextFrame()
+
+def scenarioSOFIdle(bus, count):
+    """
+    Idle high-speed bus: only SOFs.
+    """
+    bus.event(EVENT_DEVICE_CHIRP)
+    bus.event(EVENT_HOST_CHIRP)
+    bus.startFrames(HS_MICROFRAME_TICS)
+    for _ in xrange(count):
+        bus.waitNextFrame()
+
+SCENARIO_DICT = {
+    'hs-bulk': scenarioHSBulk,
+    'split': scenarioSplit,
+    'pre': scenarioPRE,
+    'enumeration': scenarioEnumeration,
+    'nak-polling': scenarioNAKPolling,
+    'sof-idle': scenarioSOFIdle,
+}
+
+def generate(scenario, count, write):
+    """
+    Write a whole capture of given scenario, with capture start and stop
+    events.
+
+    scenario (string)
+        Key of SCENARIO_DICT.
+    count (int)
+        Scenario repetitions.
+    write (callable)
+        Receives .usb file data.
+    """
+    bus = BusEncoder(write)
+    bus.event(EVENT_CAPTURE_STARTED)
+    bus.rxcmd(RXCMD_VBUS_VALID | RXCMD_LINESTATE_FS_J)
+    SCENARIO_DICT[scenario](bus, count)
+    bus.event(EVENT_CAPTURE_STOPPED_USER)
+
+def generateString(scenario, count):
+    """
+    Return a whole capture of given scenario as a string.
+    """
+    result = []
+    generate(scenario, count, result.append)
+    return ''.join(result)
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(
+        usage='%prog [options] scenario\nScenarios: ' +
+        ', '.join(sorted(SCENARIO_DICT)),
+    )
+    parser.add_option(
+        '-n', '--count', type='int', default=1000,
+        help='Number of scenario repetitions. Default: %default',
+    )
+    parser.add_option(
+        '-o', '--outfile', default='-',
+        help='Data destination (default: stdout)',
+    )
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in SCENARIO_DICT:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    if options.outfile == '-':
+        out = sys.stdout
+    else:
+        out = open(options.outfile, 'wb')
+    generate(args[0], options.count, out.write)
+    out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Per-(micro)frame bus utilisation, per device and endpoint.
+
+Packets are read from the capture once, and only their tic, bus time,
+address and endpoint are kept, in compact arrays. SOF packets delimit
+(micro)frames, numbered from their frame number and the number of SOFs seen
+with the same frame number. All packets are then assigned to their
+(micro)frame and accounted per (micro)frame and endpoint with a few numpy
+operations over whole arrays, so numpy is required.
+
+Packet bus time is the time between its first and last byte, plus one byte
+and SYNC & EOP duration. Inter-packet gaps are not accounted for.
+Data and handshake packets are accounted to the endpoint of the token
+before them. SOF packets are accounted with -1 address and endpoint, and
+SPLIT packets with their hub address and -1 endpoint.
+
+The USB 2.0 specification allows periodic (isochronous and interrupt)
+transfers to use at most 80% of high-speed microframes and 90% of full-speed
+frames. Capture does not tell endpoint types, so periodic endpoints must be
+given to check this limit.
+"""
+from array import array
+import csv
+import sys
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from iti1480a.parser import TRANSACTION_DECODER_DICT, TOKEN_TYPE_SOF, \
+    MESSAGE_PACKET, PID_SOF, PID_SPLIT, PID_IN, PID_OUT, PID_SETUP, \
+    PID_PING, TIC_TO_MICROSECOND, tic_to_time
+from iti1480a.iterate import iterPackets, READ_SIZE
+
+_decodeSOF = TRANSACTION_DECODER_DICT[TOKEN_TYPE_SOF]
+_TOKEN_PID_SET = frozenset((PID_IN, PID_OUT, PID_SETUP, PID_PING))
+
+# Frames shorter than this (in tics) are high-speed microframes (125us),
+# full-speed frames being 1ms long.
+HS_FRAME_MAX_TICS = 500 / TIC_TO_MICROSECOND
+HS_PERIODIC_LIMIT = 0.8
+FS_PERIODIC_LIMIT = 0.9
+# SYNC and EOP length, in bytes: 32 + 8 bits in high speed, 8 + 3 bits
+# otherwise.
+HS_OVERHEAD_BYTES = 5
+FS_OVERHEAD_BYTES = 11 / 8.
+# Above this many tics per byte, bus is not high speed.
+HS_MAX_BYTE_TICS = 2
+# Number of worst (micro)frames summarised.
+WORST_COUNT = 10
+
+# Endpoint key: address in [-1, 127], endpoint in [-1, 15].
+_ENDPOINT_RANGE = 17
+_KEY_RANGE = _ENDPOINT_RANGE * 129
+
+def _getEndpointKey(address, endpoint):
+    return (address + 1) * _ENDPOINT_RANGE + endpoint + 1
+
+def collect(source, read_size=READ_SIZE):
+    """
+    Read packets from given capture, and return a dict of arrays:
+    - sof_tic, frame, microframe: one entry per SOF
+    - tic, duration, key: one entry per packet, key being made of address
+      and endpoint (see _getEndpointKey)
+    """
+    sof_tic_list = array('d')
+    frame_list = array('i')
+    microframe_list = array('i')
+    tic_list = array('d')
+    duration_list = array('d')
+    key_list = array('i')
+    sof_key = _getEndpointKey(-1, -1)
+    key = sof_key
+    previous_frame = None
+    microframe = 0
+    byte_tics = 1
+    for tic, message_type, packet in iterPackets(source, read_size):
+        if message_type != MESSAGE_PACKET:
+            continue
+        length = len(packet)
+        if length > 1:
+            byte_tics = (packet[-1][0] - tic) / (length - 1.)
+        if byte_tics > HS_MAX_BYTE_TICS:
+            overhead = FS_OVERHEAD_BYTES
+        else:
+            overhead = HS_OVERHEAD_BYTES
+        pid = packet[0][1] & 0xf
+        if pid == PID_SOF:
+            # Truncated SOFs still start a (micro)frame, but their frame
+            # number is unknown, like on CRC errors.
+            if length == 3:
+                decoded = _decodeSOF(packet)
+                frame = -1 if decoded['crc_error'] else decoded['frame']
+            else:
+                frame = -1
+            if frame == previous_frame:
+                microframe += 1
+            else:
+                microframe = 0
+            previous_frame = frame
+            sof_tic_list.append(tic)
+            frame_list.append(frame)
+            microframe_list.append(microframe)
+            # Packets after SOF and before next token are not endpoint
+            # traffic.
+            key = sof_key
+        elif pid in _TOKEN_PID_SET and length == 3:
+            key = _getEndpointKey(
+                packet[1][1] & 0x7f,
+                (packet[1][1] >> 7) | ((packet[2][1] & 0x7) << 1),
+            )
+        elif pid == PID_SPLIT and length > 1:
+            key = _getEndpointKey(packet[1][1] & 0x7f, -1)
+        tic_list.append(tic)
+        duration_list.append((length + overhead) * byte_tics)
+        key_list.append(key)
+    return {
+        'sof_tic': sof_tic_list,
+        'frame': frame_list,
+        'microframe': microframe_list,
+        'tic': tic_list,
+        'duration': duration_list,
+        'key': key_list,
+    }
+
+def analyse(collected, periodic_list=()):
+    """
+    Compute per-(micro)frame utilisation from collect result.
+    periodic_list (list of (address, endpoint))
+        Endpoints whose traffic is periodic.
+    Returns a dict of numpy arrays:
+    - sof_tic, frame, microframe, length (tics), busy (tics), utilisation
+      (busy / length), periodic (periodic busy / length): one entry per
+      (micro)frame
+    - row_index ((micro)frame index), row_address, row_endpoint, row_busy:
+      one entry per (micro)frame and endpoint
+    Last (micro)frame has no known length, and is not included.
+    Packets before first SOF are not included.
+    """
+    sof_tic = numpy.frombuffer(collected['sof_tic'], dtype=numpy.float64)
+    frame_count = max(len(sof_tic) - 1, 0)
+    tic = numpy.frombuffer(collected['tic'], dtype=numpy.float64)
+    duration = numpy.frombuffer(collected['duration'], dtype=numpy.float64)
+    key = numpy.frombuffer(collected['key'], dtype=numpy.int32).astype(
+        numpy.int64,
+    )
+    index = numpy.searchsorted(sof_tic, tic, side='right') - 1
+    keep = (index >= 0) & (index < frame_count)
+    index = index[keep]
+    duration = duration[keep]
+    key = key[keep]
+    length = numpy.diff(sof_tic)
+    busy = numpy.bincount(index, weights=duration, minlength=frame_count)
+    periodic_key_list = [
+        _getEndpointKey(address, endpoint)
+        for address, endpoint in periodic_list
+    ]
+    if periodic_key_list:
+        is_periodic = numpy.in1d(key, periodic_key_list)
+        periodic = numpy.bincount(
+            index[is_periodic],
+            weights=duration[is_periodic],
+            minlength=frame_count,
+        )
+    else:
+        periodic = numpy.zeros(frame_count)
+    row_key, row_inverse = numpy.unique(
+        index * _KEY_RANGE + key,
+        return_inverse=True,
+    )
+    row_index, row_endpoint_key = numpy.divmod(row_key, _KEY_RANGE)
+    row_address, row_endpoint = numpy.divmod(row_endpoint_key, _ENDPOINT_RANGE)
+    if frame_count:
+        safe_length = numpy.where(length > 0, length, 1)
+    else:
+        safe_length = length
+    return {
+        'sof_tic': sof_tic[:frame_count],
+        'frame': numpy.frombuffer(
+            collected['frame'],
+            dtype=numpy.int32,
+        )[:frame_count],
+        'microframe': numpy.frombuffer(
+            collected['microframe'],
+            dtype=numpy.int32,
+        )[:frame_count],
+        'length': length,
+        'busy': busy,
+        'utilisation': busy / safe_length,
+        'periodic': periodic / safe_length,
+        'row_index': row_index,
+        'row_address': row_address - 1,
+        'row_endpoint': row_endpoint - 1,
+        'row_busy': numpy.bincount(row_inverse, weights=duration),
+    }
+
+def getPeriodicLimit(result):
+    """
+    Return periodic utilisation limit for captured bus speed.
+    """
+    length = result['length']
+    if len(length) and numpy.median(length) < HS_FRAME_MAX_TICS:
+        return HS_PERIODIC_LIMIT
+    return FS_PERIODIC_LIMIT
+
+def writeCSV(result, outfile):
+    """
+    Write one row per (micro)frame and endpoint.
+    """
+    writer = csv.writer(outfile)
+    writer.writerow((
+        'sof_tic', 'frame', 'microframe', 'length', 'address', 'endpoint',
+        'busy', 'utilisation',
+    ))
+    sof_tic = result['sof_tic']
+    frame = result['frame']
+    microframe = result['microframe']
+    length = result['length']
+    for index, address, endpoint, busy in zip(
+                result['row_index'].tolist(),
+                result['row_address'].tolist(),
+                result['row_endpoint'].tolist(),
+                result['row_busy'].tolist(),
+            ):
+        frame_length = length[index]
+        writer.writerow((
+            int(sof_tic[index]),
+            frame[index],
+            microframe[index],
+            int(frame_length),
+            address,
+            endpoint,
+            '%.1f' % busy,
+            '%.4f' % (busy / frame_length if frame_length else 0),
+        ))
+
+def summarise(result, write, worst_count=WORST_COUNT):
+    """
+    Write a human-readable summary: overall utilisation, periodic limit
+    violations and worst (micro)frames with their largest users.
+    """
+    utilisation = result['utilisation']
+    if not len(utilisation):
+        write('No complete (micro)frame in capture\n')
+        return
+    limit = getPeriodicLimit(result)
+    periodic = result['periodic']
+    write('(Micro)frames: %i, utilisation: mean %.1f%%, max %.1f%%\n' % (
+        len(utilisation),
+        utilisation.mean() * 100,
+        utilisation.max() * 100,
+    ))
+    write('Periodic utilisation: max %.1f%%, above %i%% in %i (micro)frames\n'
+        % (
+            periodic.max() * 100,
+            limit * 100,
+            (periodic > limit).sum(),
+        )
+    )
+    row_index = result['row_index']
+    row_busy = result['row_busy']
+    write('Worst (micro)frames:\n')
+    for index in numpy.argsort(utilisation)[::-1][:worst_count].tolist():
+        length = result['length'][index]
+        start, stop = numpy.searchsorted(row_index, (index, index + 1))
+        user_list = sorted(
+            zip(
+                row_busy[start:stop].tolist(),
+                result['row_address'][start:stop].tolist(),
+                result['row_endpoint'][start:stop].tolist(),
+            ),
+            reverse=True,
+        )
+        write('  %s %4i.%i %5.1f%% (periodic %5.1f%%): %s\n' % (
+            tic_to_time(int(result['sof_tic'][index])),
+            result['frame'][index],
+            result['microframe'][index],
+            utilisation[index] * 100,
+            periodic[index] * 100,
+            ', '.join(
+                ('SOF' if address == -1 else
+                    '%i.%s' % (address, 'hub' if endpoint == -1 else endpoint)
+                ) + ' %.1f%%' % (busy / length * 100)
+                for busy, address, endpoint in user_list[:3]
+            ),
+        ))
+
+def _parseEndpoint(value):
+    address, endpoint = value.split('.')
+    return int(address), int(endpoint)
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] -i capture')
+    parser.add_option(
+        '-i', '--infile',
+        help='Capture to analyse',
+    )
+    parser.add_option(
+        '-o', '--outfile',
+        help='Write per-(micro)frame and endpoint utilisation to this file',
+    )
+    parser.add_option(
+        '-f', '--format', type='choice', choices=('csv', 'npz'),
+        default='csv',
+        help='--outfile format: csv (one row per (micro)frame and endpoint) '
+        'or npz (all arrays). Default: %default',
+    )
+    parser.add_option(
+        '-p', '--periodic', action='append', default=[],
+        help='Address and endpoint of a periodic (isochronous or interrupt) '
+        'endpoint, as address.endpoint (ex: 2.1). Can be repeated.',
+    )
+    parser.add_option(
+        '-n', '--worst', type='int', default=WORST_COUNT,
+        help='Number of worst (micro)frames to summarise (default: %default)',
+    )
+    (options, args) = parser.parse_args()
+    if args or not options.infile:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    if numpy is None:
+        print >>sys.stderr, 'numpy is required'
+        sys.exit(1)
+    try:
+        periodic_list = [_parseEndpoint(x) for x in options.periodic]
+    except ValueError:
+        print >>sys.stderr, 'Invalid --periodic value, expected ' \
+            'address.endpoint'
+        sys.exit(1)
+    result = analyse(collect(options.infile), periodic_list)
+    if options.outfile:
+        if options.format == 'npz':
+            numpy.savez_compressed(options.outfile, **result)
+        else:
+            with open(options.outfile, 'wb') as outfile:
+                writeCSV(result, outfile)
+    summarise(result, sys.stdout.write, options.worst)
+
+if __name__ == '__main__':
+    main()
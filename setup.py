@@ -26,12 +26,21 @@ setup(
     url='http://github.com/vpelletier/ITI1480A-linux',
     license='GPLv2+',
     platforms=['any'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
+    test_suite='tests',
     entry_points={
         'console_scripts': [
             'spt2hex=iti1480a.spt2hex:main',
             'iti1480a-capture=iti1480a.capture:main',
             'iti1480a-display=iti1480a.display:main',
+            'iti1480a-captured=iti1480a.daemon:main',
+            'iti1480a-capturectl=iti1480a.daemon:control',
+            'iti1480a-replay=iti1480a.replay:main',
+            'iti1480a-synthetic=iti1480a.synthetic:main',
+            'iti1480a-benchmark=iti1480a.benchmark:main',
+            'iti1480a-export=iti1480a.export:main',
+            'iti1480a-utilisation=iti1480a.utilisation:main',
+            'iti1480a-search=iti1480a.search:main',
         ],
     },
     classifiers=[
@@ -0,0 +1,132 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Compressed capture tests.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from iti1480a.compressed import CompressedWriter, CompressedReader, \
+    openCapture, CODEC_ZLIB, TRAILER_LEN
+from iti1480a.parser import ReorderedStream, NoopAggregator
+from iti1480a.synthetic import generateString
+
+FRAME_SIZE = 4096
+
+def _decode(data, tic=0):
+    result = []
+    stream = ReorderedStream(
+        NoopAggregator(lambda *args: result.append(args)),
+        tic,
+    )
+    stream.push(data)
+    stream.stop()
+    return result
+
+class CompressedTests(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'test.usbz')
+        self._data = data = generateString('enumeration', 10)
+        writer = CompressedWriter(
+            open(self._path, 'wb'),
+            CODEC_ZLIB,
+            FRAME_SIZE,
+        )
+        # Frames are only cut after a write ending on a packet boundary, so
+        # make small writes.
+        for offset in xrange(0, len(data), 6):
+            writer.write(data[offset:offset + 6])
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def testRoundTrip(self):
+        reader = openCapture(self._path)
+        self.assertTrue(isinstance(reader, CompressedReader))
+        self.assertEqual(reader.getRawSize(), len(self._data))
+        result = []
+        while True:
+            chunk = reader.read(1234)
+            if not chunk:
+                break
+            result.append(chunk)
+        reader.close()
+        self.assertEqual(''.join(result), self._data)
+
+    def testNonSeekable(self):
+        infile = open(self._path, 'rb')
+        head = infile.read(8)
+        reader = CompressedReader(infile, head)
+        self.assertEqual(reader.read(), self._data)
+        reader.close()
+
+    def _checkFrameList(self, reader):
+        data = self._data
+        frame_list = reader.getFrameList()
+        self.assertTrue(len(frame_list) > 2)
+        self.assertEqual(frame_list[0][:3], (0, frame_list[0][1], 0))
+        raw_offset = 0
+        for index, (frame_offset, raw_len, _, _) in enumerate(frame_list):
+            self.assertEqual(frame_offset, raw_offset)
+            self.assertEqual(
+                reader.readFrame(index),
+                data[raw_offset:raw_offset + raw_len],
+            )
+            raw_offset += raw_len
+        self.assertEqual(raw_offset, len(data))
+        return frame_list
+
+    def testFrameIndex(self):
+        reader = openCapture(self._path)
+        data = self._data
+        reference = _decode(data)
+        frame_list = self._checkFrameList(reader)
+        for index, (raw_offset, _, tic, _) in enumerate(frame_list):
+            # Frames start on packet boundaries, at known tic counts: decoding
+            # from any of them gives the same events as decoding from capture
+            # start.
+            self.assertEqual(reader.findFrame(tic), index)
+            if index + 1 < len(frame_list):
+                self.assertEqual(
+                    reader.findFrame(frame_list[index + 1][2] - 1),
+                    index,
+                )
+            self.assertEqual(reader.seekFrame(index), tic)
+            self.assertEqual(reader.read(), data[raw_offset:])
+            result = _decode(data[raw_offset:], tic)
+            self.assertEqual(reference[-len(result):], result)
+        self.assertEqual(reader.findFrame(-1), 0)
+        self.assertEqual(reader.findFrame(1 << 62), len(frame_list) - 1)
+        reader.close()
+
+    def testMissingIndex(self):
+        # Writer did not exit cleanly: index is rebuilt from frame headers.
+        reader = openCapture(self._path)
+        frame_list = reader.getFrameList()
+        reader.close()
+        with open(self._path, 'r+b') as capture:
+            capture.seek(-TRAILER_LEN, 2)
+            capture.truncate()
+        reader = openCapture(self._path)
+        self.assertEqual(self._checkFrameList(reader), frame_list)
+        self.assertEqual(reader.read(), self._data)
+        reader.close()
+
+if __name__ == '__main__':
+    unittest.main()
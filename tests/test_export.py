@@ -0,0 +1,68 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Export tests.
+"""
+from cStringIO import StringIO
+import unittest
+from iti1480a.parser import MESSAGE_TRANSACTION, MESSAGE_INCOMPLETE, \
+    PID_IN, PID_OUT, PID_DATA0, PID_ACK, RXCMD_LINESTATE_FS_J
+from iti1480a.synthetic import BusEncoder, RXCMD_VBUS_VALID, tokenPacket, \
+    dataPacket, handshakePacket
+from iti1480a.export import iterTransactionRows
+
+class IterTransactionRowsTests(unittest.TestCase):
+    def _rows(self, *transaction_list):
+        result = []
+        bus = BusEncoder(result.append)
+        bus.rxcmd(RXCMD_VBUS_VALID | RXCMD_LINESTATE_FS_J)
+        for packet_list in transaction_list:
+            bus.transaction(*packet_list)
+        return [
+            row[1:-1] for row, _ in iterTransactionRows(
+                StringIO(''.join(result)),
+            )
+        ]
+
+    def _testTruncatedToken(self, pid):
+        row_list = self._rows(
+            (
+                tokenPacket(pid, 1, 2)[:2],
+                handshakePacket(PID_ACK),
+            ),
+            (
+                tokenPacket(PID_OUT, 1, 2),
+                dataPacket(PID_DATA0, [1, 2, 3]),
+                handshakePacket(PID_ACK),
+            ),
+        )
+        self.assertEqual(
+            row_list[0],
+            (MESSAGE_INCOMPLETE, pid, -1, -1, 0, 0, True),
+        )
+        self.assertEqual(
+            row_list[-1],
+            (MESSAGE_TRANSACTION, PID_OUT, 1, 2, 3, PID_ACK, False),
+        )
+
+    def testTruncatedIN(self):
+        self._testTruncatedToken(PID_IN)
+
+    def testTruncatedOUT(self):
+        self._testTruncatedToken(PID_OUT)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Parser tests.
+"""
+import unittest
+from iti1480a.parser import ReorderedStream, NoopAggregator
+from iti1480a.synthetic import generateString
+
+class ReorderedStreamTests(unittest.TestCase):
+    @staticmethod
+    def _decode(data, chunk_size):
+        result = []
+        stream = ReorderedStream(
+            NoopAggregator(lambda *args: result.append(args)),
+        )
+        for offset in xrange(0, len(data), chunk_size):
+            stream.push(data[offset:offset + chunk_size])
+        stream.stop()
+        return result
+
+    def testOddChunks(self):
+        for scenario in ('enumeration', 'hs-bulk'):
+            data = generateString(scenario, 10)
+            self.assertFalse(len(data) % 2)
+            reference = self._decode(data, len(data))
+            self.assertTrue(reference)
+            for chunk_size in (1, 3, 16383):
+                self.assertEqual(
+                    self._decode(data, chunk_size),
+                    reference,
+                    (scenario, chunk_size),
+                )
+
+if __name__ == '__main__':
+    unittest.main()
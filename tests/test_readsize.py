@@ -0,0 +1,42 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+AdaptiveReadSize tests.
+"""
+import unittest
+from iti1480a.readsize import AdaptiveReadSize
+
+class AdaptiveReadSizeTests(unittest.TestCase):
+    def testGrowShrink(self):
+        read_size = AdaptiveReadSize(16, 128)
+        self.assertEqual(read_size.size, 16)
+        # Full reads double size, up to maximum.
+        self.assertEqual(read_size.update(16), 32)
+        self.assertEqual(read_size.update(32), 64)
+        self.assertEqual(read_size.update(64), 128)
+        self.assertEqual(read_size.update(128), 128)
+        # Slightly short reads keep size.
+        self.assertEqual(read_size.update(100), 128)
+        self.assertEqual(read_size.update(32), 128)
+        # Much shorter reads halve size, down to minimum.
+        self.assertEqual(read_size.update(31), 64)
+        self.assertEqual(read_size.update(0), 32)
+        self.assertEqual(read_size.update(0), 16)
+        self.assertEqual(read_size.update(0), 16)
+        self.assertEqual(read_size.size, 16)
+
+if __name__ == '__main__':
+    unittest.main()
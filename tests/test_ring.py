@@ -0,0 +1,220 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Shared-memory ring tests, and decoding resynchronisation after overruns.
+"""
+import os
+import random
+import shutil
+from struct import pack_into
+import tempfile
+import unittest
+from iti1480a.ring import RingWriter, RingReader, RingOverrun, \
+    RESERVED_OFFSET
+from iti1480a.parser import ReorderedStream, Packetiser, \
+    TransactionAggregator, NoopAggregator, ParsingDone
+from iti1480a.synthetic import generateString
+
+# Decodings through an overrun ring, each from a different random sequence of
+# writes and reads.
+RESYNC_RUN_COUNT = 50
+
+def _data(length):
+    return ''.join(chr(x & 0xff) for x in xrange(length))
+
+class RingTests(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'test.ring')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def testRoundTrip(self):
+        writer = RingWriter(self._path, 64)
+        reader = RingReader(self._path)
+        data = _data(1000)
+        result = []
+        # Writes and reads of various sizes, wrapping around ring end.
+        for offset in xrange(0, len(data), 50):
+            writer.write(data[offset:offset + 50])
+            result.append(reader.read(30))
+            result.append(reader.read(30))
+        writer.close()
+        while True:
+            chunk = reader.read(30)
+            if not chunk:
+                break
+            result.append(chunk)
+        self.assertEqual(''.join(result), data)
+        self.assertEqual(reader.tell(), len(data))
+        reader.close()
+
+    def testConsumerList(self):
+        writer = RingWriter(self._path, 64)
+        reader = RingReader(self._path)
+        writer.write(_data(40))
+        reader.read(10)
+        self.assertEqual(writer.getConsumerList(), [(os.getpid(), 30)])
+        reader.close()
+        self.assertEqual(writer.getConsumerList(), [])
+        writer.close()
+
+    def testOverrun(self):
+        writer = RingWriter(self._path, 64)
+        reader = RingReader(self._path)
+        data = _data(200)
+        writer.write(data[:100])
+        writer.write(data[100:])
+        self.assertRaises(RingOverrun, reader.read, 100)
+        # Reading continues from the oldest available data.
+        self.assertEqual(reader.tell(), 200 - 64)
+        self.assertEqual(reader.read(100), data[-64:])
+        writer.close()
+        reader.close()
+
+    def testOverrunLost(self):
+        writer = RingWriter(self._path, 64)
+        reader = RingReader(self._path)
+        writer.write(_data(100))
+        try:
+            reader.read(100)
+        except RingOverrun, exc:
+            self.assertEqual(exc.lost, 100 - 64)
+        else:
+            self.fail('RingOverrun not raised')
+        writer.close()
+        reader.close()
+
+    def testOverrunDuringRead(self):
+        writer = RingWriter(self._path, 64)
+        reader = RingReader(self._path)
+        writer.write(_data(60))
+        # Writer announced a write overwriting unread data, and may be
+        # copying it while reader copies.
+        pack_into('<Q', writer._map, RESERVED_OFFSET, 60 + 10)
+        self.assertRaises(RingOverrun, reader.read, 60)
+        self.assertEqual(reader.tell(), 70 - 64)
+        writer.close()
+        reader.close()
+
+    def testLateReader(self):
+        writer = RingWriter(self._path, 64)
+        writer.write(_data(100))
+        reader = RingReader(self._path)
+        # Start of data was already overwritten.
+        self.assertEqual(reader.tell(), 100 - 64)
+        self.assertEqual(reader.read(100), _data(100)[-64:])
+        writer.close()
+        reader.close()
+
+class ResyncTests(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'test.ring')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    @staticmethod
+    def _decode(data, resync=False, chunk_size=4096):
+        result = []
+        stream = ReorderedStream(
+            NoopAggregator(lambda *args: result.append(args)),
+            resync=resync,
+        )
+        for offset in xrange(0, len(data), chunk_size):
+            stream.push(data[offset:offset + chunk_size])
+        stream.stop()
+        return [x[1:] for x in result]
+
+    def testReorderedStreamResync(self):
+        # Decoding from an arbitrary word emits an exact suffix of what
+        # decoding from capture start emits (tics excepted, as they are
+        # relative).
+        rng = random.Random(0)
+        for scenario in ('enumeration', 'hs-bulk', 'split'):
+            data = generateString(scenario, 20)
+            reference = self._decode(data)
+            for _ in xrange(10):
+                offset = rng.randrange(0, len(data) - 2000) & ~1
+                result = self._decode(
+                    data[offset:],
+                    True,
+                    rng.choice((7, 4096)),
+                )
+                self.assertTrue(result)
+                self.assertEqual(reference[-len(result):], result)
+
+    def _decodeThroughRing(self, data, rng):
+        writer = RingWriter(self._path, 4096)
+        reader = RingReader(self._path)
+        transaction_list = []
+        packetiser = Packetiser(
+            TransactionAggregator(
+                NoopAggregator(
+                    lambda *args: transaction_list.append(args),
+                ),
+                lambda *args: None,
+            ),
+            lambda *args: None,
+        )
+        stream = ReorderedStream(packetiser)
+        overrun_count = 0
+        skip_byte = False
+        offset = 0
+        try:
+            while offset < len(data) or reader.tell() < offset:
+                if offset < len(data):
+                    chunk = data[offset:offset + rng.randint(1, 3000)]
+                    writer.write(chunk)
+                    offset += len(chunk)
+                if rng.random() < .5 and offset < len(data):
+                    # Reader lags behind.
+                    continue
+                try:
+                    chunk = reader.read(rng.randint(1, 5000))
+                except RingOverrun:
+                    overrun_count += 1
+                    stream.resync()
+                    packetiser.resync()
+                    skip_byte = reader.tell() % 2
+                    continue
+                if skip_byte:
+                    chunk = chunk[1:]
+                    skip_byte = False
+                stream.push(chunk)
+            stream.stop()
+        except ParsingDone:
+            pass
+        writer.close()
+        reader.close()
+        return overrun_count, transaction_list
+
+    def testPipelineResyncAfterOverrun(self):
+        # Decoding must survive resuming at arbitrary points.
+        data = generateString('enumeration', 20)
+        rng = random.Random(0)
+        for _ in xrange(RESYNC_RUN_COUNT):
+            overrun_count, transaction_list = self._decodeThroughRing(
+                data,
+                rng,
+            )
+            self.assertTrue(overrun_count)
+            self.assertTrue(transaction_list)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# Copyright (C) 2016  Vincent Pelletier <plr.vincent@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+searchPackets tests.
+"""
+import unittest
+from iti1480a.parser import MESSAGE_PACKET, PID_OUT, PID_DATA0, PID_ACK
+from iti1480a.synthetic import tokenPacket, dataPacket, handshakePacket
+from iti1480a.search import searchPackets, compilePattern
+
+def _packet(byte_list):
+    return [(0, x) for x in byte_list]
+
+class SearchPacketsTests(unittest.TestCase):
+    def _search(self, payload_list, pattern_list):
+        packet_list = []
+        tic = 0
+        for payload in payload_list:
+            for byte_list in (
+                        tokenPacket(PID_OUT, 1, 2),
+                        dataPacket(PID_DATA0, [ord(x) for x in payload]),
+                        handshakePacket(PID_ACK),
+                    ):
+                packet_list.append((tic, MESSAGE_PACKET, _packet(byte_list)))
+                tic += 1
+        return [
+            (x['pattern'], x['offset'], x['data'])
+            for x in searchPackets(
+                packet_list,
+                [compilePattern(x) for x in pattern_list],
+            )
+        ]
+
+    def testMultiplePatterns(self):
+        # Second pattern matches before the end of first pattern's match.
+        self.assertEqual(
+            sorted(self._search(['XY....AB'], ['AB', 'XY'])),
+            [(0, 6, 'AB'), (1, 0, 'XY')],
+        )
+
+    def testMultiplePatternsAcrossPackets(self):
+        # Matches spanning packets are reported once per pattern.
+        self.assertEqual(
+            sorted(self._search(['..XY..AB', '..XY..AB'], ['AB', 'XY'])),
+            [(0, 6, 'AB'), (0, 6, 'AB'), (1, 2, 'XY'), (1, 2, 'XY')],
+        )
+
+if __name__ == '__main__':
+    unittest.main()
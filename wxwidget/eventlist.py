@@ -0,0 +1,149 @@
+from bisect import bisect_right, insort
+import wx
+from iti1480a.parser import tic_to_time
+
+# Number of rendered events to keep, so redrawing does not render again.
+RENDER_CACHE_SIZE = 1024
+INDENT = '    '
+
+def _flatten(child_list, depth, append):
+    for child in child_list:
+        append((depth, child))
+        _flatten(child[3], depth + 1, append)
+
+class EventList(wx.ListCtrl):
+    """
+    Virtual event list: rows are only rendered when displayed, so the number
+    of events does not impact widget count.
+
+    Events are stored as a render callable and its arguments. Render returns a
+    (caption, column data, absolute tic, child list) tuple, child list
+    containing tuples of the same form.
+    Activating an event lists all its descendants, indented, below it.
+    Activating it (or one of its descendants) again hides them.
+    """
+    def __init__(self, parent, id=-1):
+        super(EventList, self).__init__(parent, id, style=wx.LC_REPORT |
+            wx.LC_VIRTUAL | wx.LC_HRULES | wx.LC_SINGLE_SEL)
+        self._event_list = []
+        self._render_cache = {}
+        # Expanded event indexes (sorted), their descendants as
+        # (depth, rendered) pairs, and the row each expanded event is at.
+        self._expanded_list = []
+        self._expanded_dict = {}
+        self._expanded_row_list = []
+        self._extra_row_count = 0
+        self._image_list = None
+        self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.onActivated)
+
+    def setImageList(self, image_list, folder_closed, folder_opened, leaf):
+        """
+        Set image list and indexes of images for events with hidden
+        children, events with visible children, and events without children.
+        """
+        self.SetImageList(image_list, wx.IMAGE_LIST_SMALL)
+        # Keep a reference, as SetImageList does not.
+        self._image_list = image_list
+        self._folder_closed = folder_closed
+        self._folder_opened = folder_opened
+        self._leaf = leaf
+
+    def append(self, render, args):
+        """
+        Append an event. Call flush to display it.
+        """
+        self._event_list.append((render, args))
+
+    def flush(self):
+        """
+        Update row count after events were appended.
+        """
+        self.SetItemCount(len(self._event_list) + self._extra_row_count)
+
+    def _render(self, index):
+        cache = self._render_cache
+        try:
+            return cache[index]
+        except KeyError:
+            pass
+        if len(cache) >= RENDER_CACHE_SIZE:
+            cache.clear()
+        render, args = self._event_list[index]
+        cache[index] = result = render(*args)
+        return result
+
+    def _locate(self, row):
+        """
+        Return event index for given row, and descendant index (None if row
+        is the event itself).
+        """
+        expanded_row_list = self._expanded_row_list
+        position = bisect_right(expanded_row_list, row) - 1
+        if position < 0:
+            return row, None
+        index = self._expanded_list[position]
+        offset = row - expanded_row_list[position]
+        if offset == 0:
+            return index, None
+        child_count = len(self._expanded_dict[index])
+        if offset <= child_count:
+            return index, offset - 1
+        return index + offset - child_count, None
+
+    def _getRow(self, row):
+        index, child = self._locate(row)
+        if child is None:
+            return 0, self._render(index), index in self._expanded_dict
+        depth, rendered = self._expanded_dict[index][child]
+        return depth, rendered, True
+
+    def OnGetItemText(self, row, column):
+        depth, (caption, data, absolute_tic, _), _ = self._getRow(row)
+        if column == 0:
+            return tic_to_time(absolute_tic)
+        if column == 1:
+            return INDENT * depth + caption
+        try:
+            return data[column - 2]
+        except IndexError:
+            return ''
+
+    def OnGetItemImage(self, row):
+        _, rendered, expanded = self._getRow(row)
+        if not rendered[3]:
+            return self._leaf
+        if expanded:
+            return self._folder_opened
+        return self._folder_closed
+
+    def onActivated(self, event):
+        index, _ = self._locate(event.GetIndex())
+        expanded_list = self._expanded_list
+        expanded_dict = self._expanded_dict
+        if index in expanded_dict:
+            del expanded_dict[index]
+            expanded_list.remove(index)
+        else:
+            child_list = []
+            _flatten(self._render(index)[3], 1, child_list.append)
+            if not child_list:
+                return
+            expanded_dict[index] = child_list
+            insort(expanded_list, index)
+        expanded_row_list = self._expanded_row_list = []
+        extra_row_count = 0
+        for expanded in expanded_list:
+            if expanded == index:
+                row = expanded + extra_row_count
+            expanded_row_list.append(expanded + extra_row_count)
+            extra_row_count += len(expanded_dict[expanded])
+        if index not in expanded_dict:
+            row = index + sum(
+                len(expanded_dict[x]) for x in expanded_list if x < index
+            )
+        self._extra_row_count = extra_row_count
+        self.flush()
+        self.Refresh()
+        # Activated row may have been a hidden descendant.
+        self.Select(row)
+        self.Focus(row)
@@ -5,12 +5,9 @@
 import wx
 
 # begin wxGlade: extracode
-# TODO: use wxWidget 2.9 wxTreeCtrl
-from wx.gizmos import TreeListCtrl
-# TODO: use wxWidget 2.9 wxTreeCtrl
-from wx.gizmos import TreeListCtrl
-# TODO: use wxWidget 2.9 wxTreeCtrl
-from wx.gizmos import TreeListCtrl
+from eventlist import EventList
+from eventlist import EventList
+from eventlist import EventList
 # end wxGlade
 
 
@@ -48,9 +45,9 @@ class wxITI1480AMainFrame(wx.Frame):
         self.toolbar.AddLabelTool(wx.ID_STOP, "Stop", wx.Bitmap("images/player_stop.png", wx.BITMAP_TYPE_ANY), wx.NullBitmap, wx.ITEM_NORMAL, "Terminate capture", "")
         # Tool Bar end
         self.device_notebook = wx.Notebook(self, -1, style=0)
-        self.capture_list = TreeListCtrl(self.device_notebook, -1, style=wx.TR_HIDE_ROOT | wx.TR_NO_BUTTONS | wx.TR_ROW_LINES | wx.TR_FULL_ROW_HIGHLIGHT)
-        self.bus_list = TreeListCtrl(self.device_notebook, -1, style=wx.TR_HIDE_ROOT | wx.TR_NO_BUTTONS | wx.TR_ROW_LINES | wx.TR_FULL_ROW_HIGHLIGHT)
-        self.error_list = TreeListCtrl(self.device_notebook, -1, style=wx.TR_HIDE_ROOT | wx.TR_NO_BUTTONS | wx.TR_ROW_LINES | wx.TR_FULL_ROW_HIGHLIGHT)
+        self.capture_list = EventList(self.device_notebook, -1)
+        self.bus_list = EventList(self.device_notebook, -1)
+        self.error_list = EventList(self.device_notebook, -1)
 
         self.__set_properties()
         self.__do_layout()
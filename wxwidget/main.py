@@ -1,24 +1,31 @@
 #!/usr/bin/env python
+import errno
 import os
+import shutil
 import wx
 import threading
 import signal
 import subprocess
 import sys
-from cStringIO import StringIO
+import tempfile
 from collections import deque
 
-# TODO: use wxWidget 2.9 wxTreeCtrl
-from wx.gizmos import TreeListCtrl
-
 from gui import wxITI1480AMainFrame
-from iti1480a.parser import tic_to_time, short_tic_to_time, \
+from eventlist import EventList
+from iti1480a.parser import short_tic_to_time, \
     ReorderedStream, MESSAGE_RAW, MESSAGE_RESET, MESSAGE_TRANSACTION, \
     decode, TOKEN_TYPE_ACK, TOKEN_TYPE_NAK, TOKEN_TYPE_STALL, \
     TOKEN_TYPE_NYET, Packetiser, TransactionAggregator, PipeAggregator, \
     Endpoint0TransferAggregator, MESSAGE_TRANSFER, ParsingDone, \
     TOKEN_TYPE_PRE_ERR, BaseAggregator, MESSAGE_TRANSACTION_ERROR, \
-    MESSAGE_TRANSFER_ERROR
+    MESSAGE_TRANSFER_ERROR, MESSAGE_INCOMPLETE
+from iti1480a.compressed import openCapture, CompressedReader
+from iti1480a.stageprofile import profileStage
+from iti1480a.memprofile import profileMemory
+from iti1480a.cache import openCache, CACHE_DIR, CHANNEL_TRANSACTION, \
+    CHANNEL_TRANSACTION_ERROR, CHANNEL_PACKETISER
+from iti1480a.readsize import AdaptiveReadSize
+from iti1480a.ring import RingReader, RingOverrun
 
 def maybeCallAfter(func, *args, **kw):
     if wx.Thread_IsMain():
@@ -27,6 +34,10 @@ def maybeCallAfter(func, *args, **kw):
         wx.CallAfter(func, *args, **kw)
 
 class Capture(object):
+    """
+    Run a capture, spooling captured data to a temporary file (in TMPDIR if
+    set), so it does not have to fit in memory.
+    """
     _subprocess = None
     _open_thread = None
     paused = False
@@ -43,17 +54,24 @@ class Capture(object):
         )
         self._open_thread = read_thread = threading.Thread(
             target=self._callback,
-            args=(self._read, ), kwargs={'read_buf': 16})
+            args=(self._read, ))
         read_thread.daemon = True
-        # XXX: should probably rather use an on-disk temp file...
-        self.data = StringIO()
+        if self.data is not None:
+            # Deletes previous capture spool file.
+            self.data.close()
+        self.data = tempfile.NamedTemporaryFile(
+            prefix='iti1480a-',
+            suffix='.usb',
+        )
         read_thread.start()
 
     def _read(self, size):
         subprocess = self._subprocess
         if subprocess is None:
             return ''
-        data = subprocess.stdout.read(size)
+        # Unlike file.read, return whatever is available instead of waiting
+        # for size bytes, so captured data gets displayed without delay.
+        data = os.read(subprocess.stdout.fileno(), size)
         self.data.write(data)
         return data
 
@@ -72,6 +90,46 @@ class Capture(object):
         self._subprocess.wait()
         self._open_thread = self._subprocess = None
 
+    def save(self, path):
+        """
+        Save captured data to given path.
+        Once capture is stopped, spool file is hard-linked when possible, so no
+        data is copied. While it runs, data captured so far is copied, as a
+        link would keep growing.
+        """
+        data = self.data
+        data.flush()
+        if self._subprocess is not None:
+            # Whole 16-bit words only, so saved capture can be decoded.
+            size = data.tell() & ~1
+            with open(data.name, 'rb') as infile:
+                with open(path, 'wb') as outfile:
+                    while size:
+                        chunk = infile.read(min(size, 1024 * 1024))
+                        if not chunk:
+                            break
+                        outfile.write(chunk)
+                        size -= len(chunk)
+            return
+        temp_path = '%s.%i.tmp' % (path, os.getpid())
+        try:
+            os.link(data.name, temp_path)
+        except OSError, exc:
+            # Spool file is on another filesystem, or filesystem does not
+            # support hard links: copy.
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP):
+                raise
+            with open(data.name, 'rb') as infile:
+                with open(path, 'wb') as outfile:
+                    shutil.copyfileobj(infile, outfile, 1024 * 1024)
+        else:
+            # Like the copy above, replace any existing file.
+            os.rename(temp_path, path)
+            if os.path.lexists(temp_path):
+                # path already was a link to spool file, so rename did
+                # nothing.
+                os.unlink(temp_path)
+
 class EventListManagerBase(BaseAggregator):
     # XXX: horrible API
     def __init__(self, app, device, endpoint, addBaseTreeItem, event_list=None):
@@ -80,16 +138,16 @@ class EventListManagerBase(BaseAggregator):
         self._event_list = event_list
         self.__addBaseTreeItem = addBaseTreeItem
 
-    def _addBaseTreeItem(self, *args, **kw):
+    def _addBaseTreeItem(self, *args):
         if self._event_list is None:
-            maybeCallAfter(self._realAddBaseTreeItem, args, kw)
+            maybeCallAfter(self._realAddBaseTreeItem, args)
         else:
-            self._realAddBaseTreeItem(args, kw)
+            self._realAddBaseTreeItem(args)
 
-    def _realAddBaseTreeItem(self, args, kw):
+    def _realAddBaseTreeItem(self, args):
         if self._event_list is None:
             self._event_list = self._app.getPipeEventList(*self._pipe)
-        self.__addBaseTreeItem(self._event_list, *args, **kw)
+        self.__addBaseTreeItem(self._event_list, *args)
 
     def push(self, tic, transaction_type, data):
         raise NotImplementedError
@@ -100,26 +158,34 @@ class HubEventListManager(EventListManagerBase):
 
 class EndpointEventListManager(EventListManagerBase):
     def push(self, tic, transaction_type, data):
+        # Decoded when displayed.
+        self._addBaseTreeItem(self._render, (tic, transaction_type, data))
+
+    @classmethod
+    def _render(cls, tic, transaction_type, data):
         is_error = transaction_type in (MESSAGE_TRANSFER_ERROR, MESSAGE_TRANSACTION_ERROR)
         if is_error:
             caption, data =  data
         if transaction_type in (MESSAGE_TRANSFER, MESSAGE_TRANSFER_ERROR):
-            _decode = self._decode
+            _decode = cls._decode
             child_list = []
             append = child_list.append
             for _, packets in data:
                 append(_decode(packets))
         elif transaction_type in (MESSAGE_TRANSACTION,
-                MESSAGE_TRANSACTION_ERROR):
-            child_list = [self._decode(data)]
+                MESSAGE_TRANSACTION_ERROR, MESSAGE_INCOMPLETE):
+            child_list = [cls._decode(data)]
         first_child = child_list[0]
         device, endpoint, interface, _, speed, payload = first_child[1]
         if is_error:
             status = 'Incomplete'
+        elif transaction_type == MESSAGE_INCOMPLETE:
+            caption = first_child[0]
+            status = 'Incomplete'
         else:
             caption = first_child[0]
             status = child_list[-1][1][3]
-        self._addBaseTreeItem(caption, (device, endpoint, interface, status, speed, payload), first_child[2], child_list)
+        return caption, (device, endpoint, interface, status, speed, payload), first_child[2], child_list
 
     @staticmethod
     def _decode(packets):
@@ -142,18 +208,46 @@ class EndpointEventListManager(EventListManagerBase):
                 payload += (' '.join('%02x' % (ord(x), )
                     for x in item['data']))
         return (start['name'], (str(start['address']), str(
-            start['endpoint']), interface, status, speed, payload), start['tic'], (
+            start['endpoint']), interface, status, speed, payload), start['tic'], tuple(
             (x['name'], ('', '', '', '', '',
                 ' '.join('%02x' % (ord(y), ) for y in x.get('data', ''))
                 ), x['tic'], ()) for x in decoded
         ))
 
-CHUNK_SIZE = 16 * 1024
+def renderRaw(tic, data):
+    return data, (), tic, ()
+
+def renderReset(tic, data):
+    return 'Reset (%s)' % (short_tic_to_time(data), ), (), tic, ()
+
+def renderSOF(tic, data):
+    return 'SOF %i' % (decode(data[0])['frame'], ), (), tic, ()
+
+def renderIncomplete(tic, data):
+    # Packets of a transaction which lost its start, ex: after a ring overrun.
+    child_list = []
+    for packet in data:
+        try:
+            name = decode(packet)['name']
+        except IndexError:
+            name = 'Truncated'
+        child_list.append((name, (), tic, ()))
+    return 'Incomplete', (), tic, child_list
+
+# Minimum delay between displays of decoded events, in milliseconds.
+REFRESH_INTERVAL = 100
+
+profileStage(HubEventListManager)
+profileStage(EndpointEventListManager)
+profileMemory(HubEventListManager)
+profileMemory(EndpointEventListManager)
+
 class ITI1480AMainFrame(wxITI1480AMainFrame):
     _statusbar_size_changed = False
 
     def __init__(self, *args, **kw):
         loadfile = kw.pop('loadfile', None)
+        ring = kw.pop('ring', None)
         cwd = os.getcwd()
         os.chdir(os.path.dirname(__file__))
         super(ITI1480AMainFrame, self).__init__(*args, **kw)
@@ -179,12 +273,18 @@ class ITI1480AMainFrame(wxITI1480AMainFrame):
         self.statusbar.Bind(wx.EVT_IDLE, self.onIdleStatusbar)
         self._repositionGauge()
         self._capture = Capture(self._openFile)
+        # Event list flushers of running opens.
+        self._refresh_set = set()
+        self._refresh_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onRefreshTimer, self._refresh_timer)
         self._device_dict = {}
         self._initEventList(self.capture_list)
         self._initEventList(self.bus_list)
         self._initEventList(self.error_list)
         if loadfile is not None:
             self.openFile(loadfile)
+        elif ring is not None:
+            self.openRing(ring)
 
     def _enableCapture(self, enable):
         self._enableId(4, enable) # Start
@@ -240,13 +340,13 @@ class ITI1480AMainFrame(wxITI1480AMainFrame):
                     ('Speed', 40),
                     ('Payload', 300),
                 ]:
-            tree.AddColumn(column_name, width=width)
-        tree.SetMainColumn(1)
-        tree.AddRoot('')
-        tree.SetImageList(self.image_list)
+            tree.InsertColumn(tree.GetColumnCount(), column_name,
+                width=width)
+        tree.setImageList(self.image_list, self._folderClosed,
+            self._folderOpened, self._file)
 
     def _newEventList(self, parent):
-        tree = TreeListCtrl(parent, -1, style=wx.TR_HIDE_ROOT | wx.TR_NO_BUTTONS | wx.TR_ROW_LINES | wx.TR_FULL_ROW_HIGHLIGHT)
+        tree = EventList(parent, -1)
         self._initEventList(tree)
         return tree
 
@@ -286,9 +386,7 @@ class ITI1480AMainFrame(wxITI1480AMainFrame):
     def onSave(self, event):
         dialog = self._saveDialog
         if dialog.ShowModal() == wx.ID_OK:
-            # XXX: very naive implementation.
-            with open(dialog.GetPath(), 'w') as out:
-                out.write(self._capture.data.getvalue())
+            self._capture.save(dialog.GetPath())
 
     def onOpen(self, event):
         dialog = self._openDialog
@@ -297,70 +395,95 @@ class ITI1480AMainFrame(wxITI1480AMainFrame):
             self.openFile(dialog.GetPath())
 
     def openFile(self, path):
-        stream = open(path)
+        stream = openCapture(path)
         gauge = self.load_gauge
         gauge.SetValue(0)
-        stream.seek(0, 2)
-        gauge.SetRange(stream.tell())
-        stream.seek(0)
+        if isinstance(stream, CompressedReader):
+            gauge.SetRange(stream.getRawSize())
+        else:
+            stream.seek(0, 2)
+            gauge.SetRange(stream.tell())
+            stream.seek(0)
         gauge.Show(True)
         open_thread = threading.Thread(target=self._openFile,
-            args=(stream.read, ), kwargs={'use_gauge': True})
+            args=(stream.read, ), kwargs={
+                'use_gauge': True,
+                'capture_path': path,
+            })
         open_thread.daemon = True
         open_thread.start()
 
-    def _openFile(self, read, use_gauge=False, read_buf=CHUNK_SIZE):
-        def addTreeItem(parent, event_list, caption, data, absolute_tic,
-                child_list):
-            SetItemText = event_list.SetItemText
-            SetItemImage = event_list.SetItemImage
-            tree_item = event_list.AppendItem(parent, caption)
-            SetItemText(tree_item, tic_to_time(absolute_tic), 0)
-            for column, caption in enumerate(data, 2):
-                SetItemText(tree_item, caption, column)
-            if child_list:
-                SetItemImage(tree_item, self._folderClosed,
-                    which=wx.TreeItemIcon_Normal)
-                SetItemImage(tree_item, self._folderOpened,
-                    which=wx.TreeItemIcon_Expanded)
-            else:
-                SetItemImage(tree_item, self._file,
-                    which=wx.TreeItemIcon_Normal)
-            for (child_caption, child_data, child_absolute_tic,
-                    grand_child_list) in child_list:
-                addTreeItem(tree_item, event_list, child_caption, child_data,
-                    child_absolute_tic, grand_child_list)
+    def openRing(self, path):
+        """
+        Follow a running capture through the shared-memory ring at given
+        path, as created by iti1480a-capture --ring.
+        """
+        ring = RingReader(path)
+        open_thread = threading.Thread(target=self._openFile,
+            args=(ring.read, ), kwargs={
+                'ring': ring,
+            })
+        open_thread.daemon = True
+        open_thread.start()
+
+    def _startRefresh(self, refresh):
+        assert wx.Thread_IsMain()
+        if not self._refresh_set:
+            self._refresh_timer.Start(REFRESH_INTERVAL)
+        self._refresh_set.add(refresh)
+
+    def _stopRefresh(self, refresh):
+        assert wx.Thread_IsMain()
+        self._refresh_set.remove(refresh)
+        if not self._refresh_set:
+            self._refresh_timer.Stop()
+        refresh()
+
+    def onRefreshTimer(self, event):
+        for refresh in self._refresh_set:
+            refresh()
+
+    def _openFile(self, read, use_gauge=False, capture_path=None,
+            ring=None):
+        # Decoded events are queued, and periodically added to event lists
+        # from main thread, so UI updates are batched and their rate capped
+        # however fast events are decoded.
         tree_list = deque()
 
         def flushTreeList():
             pop = tree_list.popleft
+            updated_set = set()
             while True:
                 try:
-                    args, kw = pop()
+                    event_list, render, args = pop()
                 except IndexError:
                     break
-                addTreeItem(args[0].GetRootItem(), *args, **kw)
+                event_list.append(render, args)
+                updated_set.add(event_list)
+            for event_list in updated_set:
+                event_list.flush()
 
-        def addBaseTreeItem(*args, **kw):
-            need_reschedule = not tree_list
-            tree_list.append((args, kw))
-            if need_reschedule:
-                maybeCallAfter(flushTreeList)
+        def addBaseTreeItem(event_list, render, args):
+            tree_list.append((event_list, render, args))
+        maybeCallAfter(self._startRefresh, flushTreeList)
 
         def captureEvent(tic, event_type, data):
             if event_type == MESSAGE_RAW:
-                addBaseTreeItem(self.capture_list, data, (), tic, ())
+                addBaseTreeItem(self.capture_list, renderRaw, (tic, data))
             elif event_type == MESSAGE_RESET:
-                addBaseTreeItem(self.bus_list, 'Reset (%s)' % (short_tic_to_time(data), ), (), tic, ())
+                addBaseTreeItem(self.bus_list, renderReset, (tic, data))
             else:
                 raise NotImplementedError(event_type)
         captureEvent.stop = lambda: None
         captureEvent.push = captureEvent
 
         def busEvent(tic, event_type, data):
+            if event_type == MESSAGE_INCOMPLETE:
+                addBaseTreeItem(self.error_list, renderIncomplete, (tic, data))
+                return
             assert event_type == MESSAGE_TRANSACTION, event_type
             assert len(data) == 1, data
-            addBaseTreeItem(self.bus_list, 'SOF %i' % (decode(data[0])['frame'], ), (), tic, ())
+            addBaseTreeItem(self.bus_list, renderSOF, (tic, data))
         busEvent.stop = lambda: None
         busEvent.push = busEvent
 
@@ -379,30 +502,87 @@ class ITI1480AMainFrame(wxITI1480AMainFrame):
                 result = Endpoint0TransferAggregator(result, error_push)
             return result
 
-        update_delta = self.load_gauge.GetRange() / 100
-        read_length = last_update = 0
-        stream = ReorderedStream(
-            Packetiser(
-                TransactionAggregator(
-                    PipeAggregator(
-                        busEvent,
-                        error_push,
-                        newHub,
-                        newPipe,
-                    ),
-                    error_push,
-                ),
-                captureEvent,
-            )
+        pipe_aggregator = PipeAggregator(
+            busEvent,
+            error_push,
+            newHub,
+            newPipe,
         )
-        parse = stream.push
+        transaction_sink = pipe_aggregator
+        transaction_top = error_push
+        packetiser_top = captureEvent
         if use_gauge:
             gauge = self.load_gauge
             SetGaugeValue = gauge.SetValue
+        if capture_path is None or CACHE_DIR is None:
+            recorder = None
+        else:
+            record_iterator, recorder = openCache(capture_path)
+            if record_iterator is not None:
+                # Decoded before, skip decoding.
+                dispatch = {
+                    CHANNEL_TRANSACTION: pipe_aggregator.push,
+                    CHANNEL_TRANSACTION_ERROR: error_push,
+                    CHANNEL_PACKETISER: captureEvent,
+                }
+                for channel, args in record_iterator:
+                    dispatch[channel](*args)
+                pipe_aggregator.stop()
+                maybeCallAfter(self._stopRefresh, flushTreeList)
+                if use_gauge:
+                    maybeCallAfter(gauge.Show, False)
+                return
+            if recorder is not None:
+                transaction_sink = recorder.wrapAggregator(
+                    CHANNEL_TRANSACTION,
+                    pipe_aggregator,
+                )
+                transaction_top = recorder.wrap(
+                    CHANNEL_TRANSACTION_ERROR,
+                    error_push,
+                )
+                packetiser_top = recorder.wrap(
+                    CHANNEL_PACKETISER,
+                    captureEvent,
+                )
+        update_delta = self.load_gauge.GetRange() / 100
+        read_length = last_update = 0
+        # Whether data may not start on a packet boundary, and whether first
+        # data byte must be skipped to start on a word boundary.
+        resync = skip_byte = False
+        if ring is not None and ring.tell():
+            # Capture start was already overwritten, so reading starts at an
+            # arbitrary point.
+            resync = True
+            skip_byte = ring.tell() % 2
+        packetiser = Packetiser(
+            TransactionAggregator(
+                transaction_sink,
+                transaction_top,
+            ),
+            packetiser_top,
+            resync=resync,
+        )
+        stream = ReorderedStream(packetiser, resync=resync)
+        parse = stream.push
+        read_size = AdaptiveReadSize()
         while True:
-            data = read(read_buf)
+            try:
+                data = read(read_size.size)
+            except RingOverrun, exc:
+                print >>sys.stderr, 'Warning: ring overrun: %s, following ' \
+                    'times are early by lost duration' % (exc, )
+                # Reading continues at an arbitrary point.
+                stream.resync()
+                packetiser.resync()
+                skip_byte = ring.tell() % 2
+                continue
             if not data:
                 break
+            read_size.update(len(data))
+            if skip_byte:
+                data = data[1:]
+                skip_byte = False
             if use_gauge:
                 read_length += len(data)
                 if read_length > last_update + update_delta:
@@ -419,19 +599,32 @@ class ITI1480AMainFrame(wxITI1480AMainFrame):
                 parse(data)
             except ParsingDone:
                 break
-        maybeCallAfter(flushTreeList)
         stream.stop()
+        maybeCallAfter(self._stopRefresh, flushTreeList)
+        if recorder is not None:
+            recorder.commit()
         if use_gauge:
             maybeCallAfter(gauge.Show, False)
+        if ring is not None:
+            ring.close()
 
 def main():
-    if len(sys.argv) == 2:
-        loadfile = sys.argv[1]
-    else:
-        loadfile = None
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [capture]')
+    parser.add_option(
+        '-r', '--ring',
+        help='Follow capture from shared-memory ring at this path, as '
+        'created by iti1480a-capture --ring. Ignored if a capture is given.',
+    )
+    (options, args) = parser.parse_args()
+    if len(args) > 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    loadfile = args[0] if args else None
     app = wx.PySimpleApp(0)
     wx.InitAllImageHandlers()
-    main_frame = ITI1480AMainFrame(None, -1, "", loadfile=loadfile)
+    main_frame = ITI1480AMainFrame(None, -1, "", loadfile=loadfile,
+        ring=options.ring)
     app.SetTopWindow(main_frame)
     main_frame.Show()
     app.MainLoop()